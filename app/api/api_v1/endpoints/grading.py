@@ -1,20 +1,45 @@
-from fastapi import APIRouter, BackgroundTasks
-from pydantic import BaseModel
-from typing import List, Optional
+from fastapi import APIRouter, Response, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional, Literal, Dict, Any
+import asyncio
+import json
 import uuid
 import logging
 
 # Import các module
 from app.services.llm_service import llm_service
+from app.services.result_cache import result_cache
+from app.core.config import settings
+from app.core.metrics import metrics
 from app.core.task_runner import task_runner
-from app.core.common import process_upload_files, validate_submission_content 
-# Đảm bảo đã import service bảo mật
-from app.services.prompt_security_service import prompt_security_service
+from app.core.job_store import job_store, ACTIVE_STATUSES
+from app.core.job_events import job_events, TERMINAL_EVENTS
+from app.core.scheduler import PRIORITY_CLASSES, PRIORITY_BULK
+from app.core.common import prepare_grading_input, prepare_assignment_context, file_identity, grading_input_parts
 
 logger = logging.getLogger("grading_endpoint")
 
+# Gửi comment giữ kết nối SSE (proxy hay cắt kết nối im lặng quá lâu)
+SSE_KEEPALIVE_SECONDS = 15
+
 router = APIRouter()
 
+# Worker của task_runner lấy job "grading" từ hàng đợi và gọi llm_service
+task_runner.register_handler(
+    "grading",
+    llm_service.grade_submission,
+    cache_lookup=llm_service.get_cached_grade,
+    circuit_breaker=llm_service.circuit_breaker,
+    fingerprint=llm_service.grading_request_fingerprint,
+    estimate_tokens=llm_service.estimate_grading_tokens,
+    # Parse file đính kèm + vệ sinh + kiểm tra bài làm trong worker, không giữ kết nối HTTP
+    prepare=prepare_grading_input,
+    # File đề / đáp án của batch chấm hàng loạt: parse 1 lần trong worker, dùng chung cho cả batch
+    prepare_context=prepare_assignment_context
+)
+
 # 1. Định nghĩa Data Model
 class GradingRequest(BaseModel):
     # --- Meta ---
@@ -36,78 +61,316 @@ class GradingRequest(BaseModel):
     teacher_instruction: Optional[str] = None
     max_score: float = 10.0
 
+    # --- Options ---
+    use_cache: bool = True  # False -> luôn chấm lại, bỏ qua kết quả đã lưu
+    # "interactive": chấm lại đơn lẻ, được xử lý trước các đợt nộp hàng loạt ("bulk")
+    priority: Literal["bulk", "interactive"] = "bulk"
+
+class BulkSubmission(BaseModel):
+    request_id: Optional[str] = None
+    student_submission_text: Optional[str] = None
+    student_submission_files: Optional[List[str]] = []
+
+class BulkGradingRequest(BaseModel):
+    """Cả 1 bài tập: ngữ cảnh dùng chung gửi 1 lần + danh sách bài làm của sinh viên."""
+    callback_url: str
+    batch_id: Optional[str] = None
+
+    # --- Ngữ cảnh dùng chung (worker parse 1 lần cho cả batch) ---
+    course_id: Optional[str] = None
+    assignment_content: str
+    assignment_attachments: Optional[List[str]] = []
+    reference_answer_text: Optional[str] = None
+    reference_answer_file: Optional[str] = None
+    grading_criteria: Optional[str] = None
+    teacher_instruction: Optional[str] = None
+    max_score: float = 10.0
+
+    submissions: List[BulkSubmission]
+
+    # --- Options ---
+    use_cache: bool = True
+    priority: Literal["bulk", "interactive"] = "bulk"
+    # None -> webhook riêng cho từng sinh viên; N -> 1 webhook cho mỗi N kết quả (+ phần còn lại khi xong)
+    callback_batch_size: Optional[int] = Field(None, ge=1)
+
+def _has_submission(text: Optional[str], files: Optional[List[str]]) -> bool:
+    """Kiểm tra rẻ trên request: có văn bản hoặc ít nhất 1 đường dẫn file (nội dung kiểm tra trong worker)."""
+    return bool((text and text.strip()) or any(isinstance(path, str) and path.strip() for path in files or []))
+
+
 @router.post("/async-batch", status_code=202)
-async def grade_submission_async(
-    payload: GradingRequest, 
-    background_tasks: BackgroundTasks
-):
+async def grade_submission_async(payload: GradingRequest, response: Response):
     # 1. Sinh ID nếu thiếu
     req_id = payload.request_id or str(uuid.uuid4())
     logger.info(f"🚀 [Received Request] ID: {req_id}")
 
-    # =========================================================================
-    # [NEW] BƯỚC BẢO MẬT: KIỂM TRA SUBMISSION TEXT TRƯỚC
-    # =========================================================================
-    
-    raw_sub_text = payload.student_submission_text or ""
-    
-    # Hàm này sẽ trả về văn bản sạch hoặc thông báo lỗi "ERROR: [SECURITY_VIOLATION]..."
-    sanitized_sub_text = prompt_security_service.validate_and_sanitize(raw_sub_text)
-    
-    # Kiểm tra xem có bị thay thế bằng thông báo lỗi không
-    is_text_violation = "ERROR: [SECURITY_VIOLATION]" in sanitized_sub_text
-    
-    s_files_content = ""
-
-    if is_text_violation:
-        logger.warning(f"⚠️ [Security Block] Request {req_id}: Text submission contains prompt injection. Skipping file processing.")
-        # NẾU GIAN LẬN:
-        # 1. Nội dung bài làm chính là thông báo lỗi
-        # 2. Bỏ qua bước đọc file (s_files_content rỗng)
-        s_files_content = "" 
-    else:
-        # NẾU AN TOÀN:
-        # Mới tiến hành đọc file (CPU Bound)
-        # Lưu ý: Trong process_upload_files cần gọi FileParserService (đã tích hợp bảo mật ở bước trước)
-        # để đảm bảo file cũng được kiểm tra.
-        logger.info(f"Request {req_id}: Text clean. Processing attachment files...")
-        s_files_content = await process_upload_files(payload.student_submission_files)
-
-    # =========================================================================
-
-    # 2. Xử lý các file đề bài và đáp án (Vẫn xử lý bình thường)
-    q_files = await process_upload_files(payload.assignment_attachments)
-    
-    r_files_input = [payload.reference_answer_file] if payload.reference_answer_file else []
-    r_files = await process_upload_files(r_files_input)
+    # Backpressure: hàng đợi quá sâu -> 429 + Retry-After để Moodle tự giãn nhịp gửi
+    retry_after = await task_runner.admission_retry_after(req_id, PRIORITY_CLASSES[payload.priority])
+    if retry_after is not None:
+        logger.warning(f"🚦 [Backpressure] Từ chối {req_id}, đề nghị thử lại sau {retry_after}s")
+        raise HTTPException(
+            status_code=429,
+            detail="Hàng đợi chấm bài đang quá tải, vui lòng thử lại sau.",
+            headers={"Retry-After": str(retry_after)}
+        )
 
-    # 3. Validate (Kiểm tra xem có nội dung gì để chấm không)
-    # Lưu ý: sanitized_sub_text lúc này có thể là nội dung bài làm hoặc thông báo lỗi
-    validate_submission_content(sanitized_sub_text, s_files_content)
+    # 2. Chỉ kiểm tra rẻ ở đây; parse file, vệ sinh, kiểm tra nội dung chạy trong worker
+    #    -> thời gian phản hồi không phụ thuộc kích thước file đính kèm
+    if not _has_submission(payload.student_submission_text, payload.student_submission_files):
+        raise HTTPException(400, detail="Yêu cầu không hợp lệ: Thiếu nội dung.")
 
-    # 4. Gom dữ liệu
+    # 3. Gom dữ liệu (văn bản + đường dẫn file, chưa parse)
     grading_data = {
         "course_id": payload.course_id,
-        "question": payload.assignment_content + q_files,
-        # Kết hợp văn bản đã vệ sinh + nội dung file (nếu có)
-        "submission": sanitized_sub_text + s_files_content, 
-        "reference": (payload.reference_answer_text or "") + r_files,
+        "assignment_content": payload.assignment_content,
+        "assignment_attachments": payload.assignment_attachments,
+        "student_submission_text": payload.student_submission_text,
+        "student_submission_files": payload.student_submission_files,
+        "reference_answer_text": payload.reference_answer_text,
+        "reference_answer_file": payload.reference_answer_file,
         "rubric": payload.grading_criteria,
         "teacher_instruction": payload.teacher_instruction,
-        "max_score": payload.max_score
+        "max_score": payload.max_score,
+        "use_cache": payload.use_cache
     }
 
-    # 5. Đẩy vào Background Task
-    background_tasks.add_task(
-        task_runner.run_task_and_callback,
-        processing_function=llm_service.grade_submission,
+    # 4. Ghi vào hàng đợi bền vững (worker sẽ xử lý + gửi webhook)
+    job = await task_runner.enqueue(
+        "grading",
         input_data=grading_data,
         callback_url=payload.callback_url,
-        request_id=req_id
+        request_id=req_id,
+        course_id=payload.course_id,
+        priority=PRIORITY_CLASSES[payload.priority]
     )
 
+    admission = job["admission"]
+    if admission == "completed":
+        # Moodle gửi lại request đã chấm xong -> trả luôn kết quả đã lưu
+        response.status_code = 200
+        return {
+            "status": job["status"],
+            "message": "Request đã được chấm trước đó.",
+            "request_id": req_id,
+            "result": job["result"]
+        }
+
+    messages = {
+        "queued": "Đã tiếp nhận vào hàng đợi.",
+        "duplicate": "Request đang được xử lý, không tạo job mới.",
+        "coalesced": "Bài làm trùng nội dung với 1 job đang chấm, sẽ dùng chung kết quả."
+    }
+    return {
+        "status": job["status"],
+        "message": messages[admission],
+        "request_id": req_id,
+        "coalesced_into": job["coalesced_into"]
+    }
+
+@router.post("/bulk", status_code=202)
+async def grade_assignment_bulk(payload: BulkGradingRequest):
+    """
+    Chấm cả 1 bài tập trong 1 request: đề bài, file đính kèm, đáp án, rubric chỉ gửi 1 lần, lưu thành
+    ngữ cảnh dùng chung (worker parse file 1 lần cho cả batch); mỗi sinh viên là 1 job riêng chỉ tham chiếu context_id.
+    """
+    batch_id = payload.batch_id or str(uuid.uuid4())
+    logger.info(f"🚀 [Received Bulk] Batch: {batch_id} - {len(payload.submissions)} bài làm")
+    if not payload.submissions:
+        raise HTTPException(400, detail="Yêu cầu không hợp lệ: Không có bài làm nào.")
+
+    priority = PRIORITY_CLASSES[payload.priority]
+    if priority == PRIORITY_BULK:
+        # Batch lớn hơn cả ngưỡng hàng đợi thì không bao giờ được nhận -> báo chia nhỏ thay vì 429
+        if settings.JOB_MAX_QUEUE_DEPTH and len(payload.submissions) > settings.JOB_MAX_QUEUE_DEPTH:
+            raise HTTPException(
+                status_code=413,
+                detail=f"Batch quá lớn: tối đa {settings.JOB_MAX_QUEUE_DEPTH} bài làm mỗi request."
+            )
+        # Xét độ sâu hàng đợi sau khi thêm cả batch, không chỉ 1 job
+        retry_after = task_runner.retry_after(
+            await run_in_threadpool(task_runner.queue_estimate), incoming=len(payload.submissions)
+        )
+        if retry_after is not None:
+            metrics.inc("jobs_rejected_total", reason="backpressure")
+            logger.warning(f"🚦 [Backpressure] Từ chối batch {batch_id}, đề nghị thử lại sau {retry_after}s")
+            raise HTTPException(
+                status_code=429,
+                detail="Hàng đợi chấm bài đang quá tải, vui lòng thử lại sau.",
+                headers={"Retry-After": str(retry_after)}
+            )
+
+    # 1. Ngữ cảnh dùng chung: chỉ lưu văn bản + đường dẫn file, worker đầu tiên của batch parse file
+    #    -> thời gian phản hồi không phụ thuộc kích thước file đề / đáp án
+    context = {
+        "course_id": payload.course_id,
+        "assignment_content": payload.assignment_content,
+        "assignment_attachments": payload.assignment_attachments,
+        "reference_answer_text": payload.reference_answer_text,
+        "reference_answer_file": payload.reference_answer_file,
+        "rubric": payload.grading_criteria,
+        "teacher_instruction": payload.teacher_instruction,
+        "max_score": payload.max_score,
+    }
+    # Cùng nội dung (kể cả định danh file) -> cùng context_id (Moodle gửi lại batch không tạo bản sao)
+    _, files = grading_input_parts(context)
+    file_ids = await run_in_threadpool(lambda: [file_identity(path) for path in files])
+    context_id = result_cache.make_key({**context, "files": file_ids})
+    await run_in_threadpool(job_store.save_context, context_id, context)
+
+    # 2. Mỗi sinh viên 1 job (chỉ lưu phần riêng chưa parse + context_id, worker parse bài làm)
+    accepted, rejected = [], []
+    for submission in payload.submissions:
+        req_id = submission.request_id or str(uuid.uuid4())
+        if not _has_submission(submission.student_submission_text, submission.student_submission_files):
+            rejected.append({"request_id": req_id, "error": "Yêu cầu không hợp lệ: Thiếu nội dung."})
+            continue
+        accepted.append((req_id, {
+            "context_id": context_id,
+            "course_id": payload.course_id,
+            "student_submission_text": submission.student_submission_text,
+            "student_submission_files": submission.student_submission_files,
+            "use_cache": payload.use_cache
+        }))
+
+    if not accepted:
+        raise HTTPException(400, detail={"message": "Không có bài làm hợp lệ.", "rejected": rejected})
+
+    # Tạo batch trước khi enqueue: worker có thể xong job đầu tiên ngay lập tức
+    await run_in_threadpool(job_store.create_batch, batch_id, context_id, payload.callback_url, payload.callback_batch_size)
+    jobs = []
+    for req_id, grading_data in accepted:
+        job = await task_runner.enqueue(
+            "grading",
+            input_data=grading_data,
+            callback_url=payload.callback_url,
+            request_id=req_id,
+            course_id=payload.course_id,
+            priority=priority,
+            batch_id=batch_id
+        )
+        jobs.append({
+            "request_id": req_id,
+            "status": job["status"],
+            "admission": job["admission"],
+            "coalesced_into": job["coalesced_into"],
+            # Đã chấm xong trước đó -> trả kết quả ngay (không có trong callback của batch này)
+            "result": job["result"] if job["admission"] == "completed" else None
+        })
+
+    await task_runner.seal_batch(batch_id)
+
     return {
         "status": "queued",
-        "message": "Đã tiếp nhận vào hàng đợi.",
-        "request_id": req_id
-    }
\ No newline at end of file
+        "batch_id": batch_id,
+        "context_id": context_id,
+        "accepted": len(jobs),
+        "jobs": jobs,
+        "rejected": rejected
+    }
+
+@router.get("/queue-stats")
+async def get_queue_stats():
+    """
+    Thông tin hàng đợi gọn nhẹ để Moodle tự điều tiết tốc độ gửi bài.
+    """
+    estimate = await run_in_threadpool(task_runner.queue_estimate)
+    retry_after = task_runner.retry_after(estimate)
+    return {
+        **estimate,
+        "accepting": retry_after is None,
+        "retry_after_seconds": retry_after
+    }
+
+
+def _job_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Trạng thái + mốc thời gian của job (không trả input_data vì có thể rất lớn)."""
+    started_at, finished_at = job["started_at"], job["finished_at"]
+    return {
+        "request_id": job["request_id"],
+        "kind": job["kind"],
+        "status": job["status"],
+        "course_id": job["course_id"],
+        "priority": job["priority"],
+        "attempts": job["attempts"],
+        "coalesced_into": job["coalesced_into"],
+        "estimated_tokens": job["estimated_tokens"],
+        "batch_id": job["batch_id"],
+        "created_at": job["created_at"],
+        "started_at": started_at,
+        "finished_at": finished_at,
+        "queue_wait_seconds": started_at - job["created_at"] if started_at else None,
+        "run_seconds": finished_at - started_at if started_at and finished_at else None,
+        "error": job["error"],
+        "result": job["result"],
+    }
+
+
+async def _get_job_or_404(request_id: str) -> Dict[str, Any]:
+    job = await run_in_threadpool(job_store.get, request_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy job {request_id}")
+    return job
+
+
+@router.get("/jobs/{request_id}")
+async def get_job_status(request_id: str):
+    """Trạng thái, số lần thử và thời gian chờ / xử lý của 1 job."""
+    return _job_view(await _get_job_or_404(request_id))
+
+
+@router.delete("/jobs/{request_id}")
+async def cancel_job(request_id: str):
+    """
+    Hủy job đang chờ hoặc đang chấm. Job đang chấm bị dừng ngay (đóng request Ollama),
+    slot LLM được trả lại cho job khác. Job đã hủy không gửi webhook.
+    """
+    job = await task_runner.cancel(request_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy job {request_id}")
+    if not job["cancelled"]:
+        raise HTTPException(status_code=409, detail=f"Job {request_id} đã kết thúc ({job['status']}), không thể hủy")
+    return {**_job_view(job), "previous_status": job["previous_status"]}
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.get("/jobs/{request_id}/events")
+async def stream_job_events(request_id: str):
+    """
+    Server-Sent Events: snapshot trạng thái ban đầu, sau đó các sự kiện "stage" (queued, running,
+    prompt_built, generating, ...), "token" (feedback đang sinh) và kết thúc bằng done / failed / cancelled.
+    """
+    job = await _get_job_or_404(request_id)
+
+    async def event_stream():
+        # Đăng ký trước khi đọc lại trạng thái để không lỡ sự kiện kết thúc xảy ra ở giữa
+        with job_events.subscribe(request_id) as queue:
+            snapshot = await run_in_threadpool(job_store.get, request_id) or job
+            yield _sse("snapshot", _job_view(snapshot))
+            if snapshot["status"] not in ACTIVE_STATUSES:
+                return
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # Job có thể kết thúc ở tiến trình khác (không qua event bus) -> đối chiếu với store
+                    current = await run_in_threadpool(job_store.get, request_id)
+                    if current is None or current["status"] not in ACTIVE_STATUSES:
+                        yield _sse("snapshot", _job_view(current) if current else {"request_id": request_id})
+                        return
+                    yield ": keep-alive\n\n"
+                    continue
+
+                yield _sse(message["event"], message)
+                if message["event"] in TERMINAL_EVENTS:
+                    return
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
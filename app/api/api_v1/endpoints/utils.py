@@ -1,8 +1,15 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Response
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from app.services.llm_service import llm_service # Import service vừa tạo
 from app.core.config import settings
-import httpx
+from app.core.http_client import http_client_manager
+from app.core.metrics import metrics
+from app.core.task_runner import task_runner
+from app.core.webhook_dispatcher import webhook_dispatcher
+from app.services.result_cache import result_cache
+from app.services.file_parser import file_parser
+from app.services.warmup_service import warmup_manager
 
 router = APIRouter()
 
@@ -25,9 +32,8 @@ async def test_system_connection():
     try:
         # Gọi endpoint gốc của Ollama (thường trả về "Ollama is running")
         # settings.OLLAMA_HOST lấy từ .env (ví dụ: http://ollama:11434)
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{settings.OLLAMA_HOST}/", timeout=5.0)
-            
+        response = await http_client_manager.client.get(f"{settings.OLLAMA_HOST}/", timeout=5.0)
+
         if response.status_code == 200:
             result["ollama_connection"] = "success"
             result["ollama_message"] = response.text.strip() # Thường là "Ollama is running"
@@ -41,8 +47,26 @@ async def test_system_connection():
         # Gợi ý lỗi thường gặp
         result["hint"] = "Kiểm tra xem container Ollama có đang chạy cùng network 'internal_net' không."
 
+    # 3. Trạng thái từng node trong pool (slot, sức khỏe, latency)
+    result["ollama_nodes"] = llm_service.pool.snapshot()
+
+    # 4. Trạng thái circuit breaker (closed / open / half_open)
+    result["circuit_breaker"] = llm_service.circuit_breaker.snapshot()
+
     return result
 
+@router.get("/ready")
+async def readiness(response: Response):
+    """
+    Readiness probe: chỉ trả 200 khi model đã được nạp vào bộ nhớ trên các node Ollama khỏe.
+    """
+    state = warmup_manager.snapshot()
+    if not settings.WARMUP_ENABLED:
+        state["ready"] = True
+    if not state["ready"]:
+        response.status_code = 503
+    return state
+
 class QuestionRequest(BaseModel):
     question: str # Đây là trường để bạn nhập câu hỏi
 
@@ -59,4 +83,18 @@ async def ask_llm(request: QuestionRequest):
         "your_question": request.question,
         "model_used": settings.MODEL_NAME,
         "answer": answer
+    }
+
+@router.get("/metrics")
+async def get_metrics():
+    """
+    Số liệu vận hành nội bộ (counter, gauge, timing) của tiến trình hiện tại.
+    """
+    return {
+        **metrics.snapshot(),
+        "result_cache": result_cache.stats(),
+        "document_cache": file_parser.cache.stats(),
+        # Hai mục dưới đọc SQLite đồng bộ -> chạy trong thread pool
+        "job_queue": await run_in_threadpool(task_runner.stats),
+        "webhooks": await run_in_threadpool(webhook_dispatcher.stats)
     }
\ No newline at end of file
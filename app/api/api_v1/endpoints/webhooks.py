@@ -0,0 +1,34 @@
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List, Optional
+from app.core.webhook_dispatcher import webhook_dispatcher
+
+router = APIRouter()
+
+class ReplayRequest(BaseModel):
+    ids: Optional[List[int]] = None  # Bỏ trống -> gửi lại các bản ghi cũ nhất
+    limit: int = 100
+
+@router.get("/dead-letters")
+async def list_dead_letters(limit: int = 100):
+    """
+    Các webhook đã thử gửi hết số lần mà vẫn thất bại.
+    """
+    # SQLite đồng bộ -> chạy trong thread pool, không chặn event loop
+    return {
+        "total": await run_in_threadpool(webhook_dispatcher.dead_letters.count),
+        "items": await run_in_threadpool(webhook_dispatcher.dead_letters.list, limit)
+    }
+
+@router.post("/dead-letters/replay")
+async def replay_dead_letters(payload: ReplayRequest):
+    """
+    Đưa các webhook trong dead-letter trở lại hàng đợi gửi.
+    """
+    replayed = await webhook_dispatcher.replay(payload.ids, payload.limit)
+    return {"replayed": replayed}
+
+@router.get("/stats")
+async def get_webhook_stats():
+    return await run_in_threadpool(webhook_dispatcher.stats)
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Callable, Optional, Dict, Any
+from app.core.metrics import metrics
+
+logger = logging.getLogger("circuit_breaker")
+
+class CircuitOpenError(Exception):
+    """Backend đang bị ngắt mạch: từ chối ngay thay vì chờ timeout + retry."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker 3 trạng thái:
+    - closed: hoạt động bình thường, đếm lỗi liên tiếp.
+    - open: quá ngưỡng lỗi -> từ chối ngay (CircuitOpenError) trong recovery_timeout giây.
+    - half_open: hết thời gian chờ -> cho phép vài request thăm dò;
+      thành công -> closed, thất bại -> open lại.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        recovery_timeout: float = 30.0,
+        half_open_max_calls: int = 1,
+        is_failure: Optional[Callable[[BaseException], bool]] = None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.is_failure = is_failure or (lambda exc: isinstance(exc, Exception))
+        self._state = self.CLOSED
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._half_open_calls = 0
+        self._state_changed: Optional[asyncio.Event] = None
+
+    @property
+    def state(self) -> str:
+        # open -> half_open khi đã hết thời gian chờ
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    def _transition(self, new_state: str):
+        if new_state == self._state:
+            return
+        logger.warning(f"🔌 [Circuit:{self.name}] {self._state} -> {new_state}")
+        self._state = new_state
+        if new_state == self.OPEN:
+            self._opened_at = time.monotonic()
+        if new_state != self.HALF_OPEN:
+            self._half_open_calls = 0
+        metrics.inc("circuit_breaker_transitions_total", breaker=self.name, state=new_state)
+        metrics.set_gauge("circuit_breaker_open", 1 if new_state == self.OPEN else 0, breaker=self.name)
+        self._notify()
+
+    def _notify(self):
+        # Đánh thức các job đang "đỗ" trong wait_until_available()
+        if self._state_changed is not None:
+            self._state_changed.set()
+            self._state_changed = None
+
+    def before_call(self):
+        state = self.state
+        if state == self.OPEN:
+            metrics.inc("circuit_breaker_rejections_total", breaker=self.name)
+            raise CircuitOpenError(f"Circuit '{self.name}' is open")
+        if state == self.HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                metrics.inc("circuit_breaker_rejections_total", breaker=self.name)
+                raise CircuitOpenError(f"Circuit '{self.name}' is half-open, probe in progress")
+            self._half_open_calls += 1
+
+    def record_success(self):
+        self._consecutive_failures = 0
+        if self._state == self.HALF_OPEN:
+            self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self._consecutive_failures += 1
+        if self._state == self.HALF_OPEN or self._consecutive_failures >= self.failure_threshold:
+            self._transition(self.OPEN)
+
+    def _release_probe(self):
+        if self._state == self.HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+            self._notify()
+
+    @asynccontextmanager
+    async def guard(self):
+        """
+        Bọc 1 lời gọi backend: async with breaker.guard(): ...
+        - Lỗi backend (is_failure) -> tính là thất bại.
+        - Lỗi khác (vd: output sai định dạng) -> backend vẫn phản hồi, tính là thành công.
+        - Bị hủy (CancelledError) -> không thay đổi trạng thái.
+        """
+        self.before_call()
+        try:
+            yield
+        except BaseException as e:
+            if self.is_failure(e):
+                self.record_failure()
+            elif isinstance(e, Exception):
+                self.record_success()
+            else:
+                self._release_probe()
+            raise
+        else:
+            self.record_success()
+
+    @property
+    def is_available(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        return state == self.HALF_OPEN and self._half_open_calls < self.half_open_max_calls
+
+    async def wait_until_available(self):
+        """
+        "Đỗ" job lại cho tới khi backend có thể nhận request (closed hoặc còn lượt thăm dò half-open).
+        """
+        while not self.is_available:
+            if self._state_changed is None:
+                self._state_changed = asyncio.Event()
+            event = self._state_changed
+            timeout = None
+            if self._state == self.OPEN:
+                timeout = max(self.recovery_timeout - (time.monotonic() - self._opened_at), 0.05)
+            try:
+                await asyncio.wait_for(event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        state = self.state
+        retry_in = None
+        if state == self.OPEN:
+            retry_in = max(self.recovery_timeout - (time.monotonic() - self._opened_at), 0.0)
+        return {
+            "name": self.name,
+            "state": state,
+            "consecutive_failures": self._consecutive_failures,
+            "failure_threshold": self.failure_threshold,
+            "recovery_timeout": self.recovery_timeout,
+            "half_open_calls": self._half_open_calls,
+            "retry_in_seconds": retry_in,
+        }
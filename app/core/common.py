@@ -1,8 +1,13 @@
+import asyncio
+import time
 import uuid
 import os
-from typing import Union, List, Optional
+from typing import Union, List, Optional, Dict, Any, Tuple
 from fastapi import HTTPException
+from app.core.config import settings
+from app.core.metrics import metrics
 from app.services.file_parser import file_parser
+from app.services.prompt_security_service import prompt_security_service
 
 import logging
 
@@ -13,43 +18,197 @@ def generate_request_id(request_id: Optional[str] = None) -> str:
         return request_id
     return str(uuid.uuid4())
 
-async def process_upload_files(
-    file_input: Union[List[str], str, None]
-) -> str:
-    combined_text = ""
+def _as_list(file_input: Union[List[str], str, None]) -> List[str]:
     if not file_input:
-        return ""
+        return []
+    files = file_input if isinstance(file_input, list) else [file_input]
+    return [path.strip() for path in files if isinstance(path, str) and path.strip()]
 
-    # logger.info(f"Processing file input: {file_input}")
 
-    # Chuẩn hóa đầu vào thành list
-    files_to_process = file_input if isinstance(file_input, list) else [file_input]
+_parse_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def _get_parse_semaphore() -> asyncio.Semaphore:
+    # Tạo lazy trong event loop đang chạy; giới hạn chung cho mọi job trong tiến trình
+    global _parse_semaphore
+    if _parse_semaphore is None:
+        _parse_semaphore = asyncio.Semaphore(max(settings.FILE_PARSE_MAX_CONCURRENCY, 1))
+    return _parse_semaphore
+
+
+async def _parse_one_file(file_path: str) -> str:
+    try:
+        # Kiểm tra đường dẫn có tồn tại không
+        if not os.path.exists(file_path):
+            logger.warning(f"Warning: File not found at path: {file_path}")
+            return ""
+
+        async with _get_parse_semaphore():
+            started_at = time.perf_counter()
+            content = await file_parser.parse_local_file(file_path)
+            elapsed = time.perf_counter() - started_at
+
+        filename = os.path.basename(file_path)
+        extension = os.path.splitext(filename)[1].lower() or "none"
+        metrics.observe("file_parse_seconds", elapsed, extension=extension)
+        logger.info(f"📄 [Parsed] {filename} ({extension}) trong {elapsed:.2f}s")
+        return f"\n--- File: {filename} ---\n{content}\n"
+
+    except Exception as e:
+        logger.error(f"Error processing file path '{file_path}': {e}")
+        return ""
 
-    for file_path in files_to_process:
-        try:
-            # Bỏ qua nếu không phải chuỗi
-            if not isinstance(file_path, str):
-                continue
-
-            clean_path = file_path.strip()
-            
-            # Kiểm tra đường dẫn có tồn tại không
-            if clean_path and os.path.exists(clean_path):
-                content = await file_parser.parse_local_file(clean_path)
-                filename = os.path.basename(clean_path)
-                combined_text += f"\n--- File: {filename} ---\n{content}\n"
-            else:
-                print(f"Warning: File not found at path: {clean_path}")
-
-        except Exception as e:
-            print(f"Error processing file path '{file_path}': {e}")
-            continue
-
-    return combined_text
+
+async def process_upload_files(
+    file_input: Union[List[str], str, None]
+) -> str:
+    """
+    Parse các file đồng thời (tối đa FILE_PARSE_MAX_CONCURRENCY file cùng lúc trong tiến trình),
+    ghép kết quả theo đúng thứ tự đầu vào. Tổng thời gian ~ file chậm nhất thay vì tổng các file.
+    """
+    files_to_process = _as_list(file_input)
+    if not files_to_process:
+        return ""
+    contents = await asyncio.gather(*(_parse_one_file(path) for path in files_to_process))
+    return "".join(contents)
 
 def validate_submission_content(text_content: str, file_content_parsed: str):
     has_text = text_content and text_content.strip()
     has_file = file_content_parsed and file_content_parsed.strip()
     
     if not has_text and not has_file:
-        raise HTTPException(400, detail="Yêu cầu không hợp lệ: Thiếu nội dung.")
\ No newline at end of file
+        raise HTTPException(400, detail="Yêu cầu không hợp lệ: Thiếu nội dung.")
+
+
+# =========================================================================
+# Chuẩn bị đầu vào chấm bài trong worker (trước bước gọi LLM)
+# Endpoint chỉ lưu văn bản + đường dẫn file; việc đọc/parse/vệ sinh file chạy ở đây.
+# =========================================================================
+
+def file_identity(path: str) -> str:
+    """Định danh rẻ của file (không đọc nội dung): đường dẫn + kích thước + thời điểm sửa."""
+    try:
+        stat = os.stat(path)
+        return f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+    except OSError:
+        return f"{path}:missing"
+
+
+# Đuôi file văn bản thuần: ~4 byte / token. PDF / DOCX nén + nhiều metadata: ước lượng thô ~10 byte / token
+_PLAIN_TEXT_EXTENSIONS = (".txt", ".md", ".py", ".java", ".cpp", ".json", ".html", ".css", ".js", ".php")
+
+
+def estimate_file_tokens(path: str) -> int:
+    """Ước lượng số token của file từ kích thước (không đọc nội dung) - đủ để xếp lịch job ngắn / dài."""
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return 0
+    return size // 4 if path.lower().endswith(_PLAIN_TEXT_EXTENSIONS) else size // 10
+
+
+def grading_input_parts(data: Dict[str, Any]) -> Tuple[Dict[str, str], List[str]]:
+    """
+    Tách đầu vào chấm bài (đã parse hoặc còn thô) thành:
+    - phần văn bản theo từng mục (question, submission, reference, ...),
+    - danh sách file chưa parse.
+    Dùng để tính hash / ước lượng kích thước job mà không phải đọc file.
+    """
+    texts = {
+        "rubric": data.get("rubric") or "",
+        "teacher_instruction": data.get("teacher_instruction") or "",
+    }
+    files: List[str] = []
+    raw_fields = {
+        "question": ("assignment_content", "assignment_attachments"),
+        "submission": ("student_submission_text", "student_submission_files"),
+        "reference": ("reference_answer_text", "reference_answer_file"),
+    }
+    for part, (text_field, file_field) in raw_fields.items():
+        if part in data:
+            texts[part] = data[part] or ""
+        else:
+            texts[part] = data.get(text_field) or ""
+            files.extend(_as_list(data.get(file_field)))
+    return texts, files
+
+
+def check_submission_text(req_id: str, submission_text: Optional[str]) -> Tuple[str, bool]:
+    """
+    Kiểm tra bảo mật phần văn bản bài làm (trước khi đọc file đính kèm).
+    Trả về (văn bản đã vệ sinh hoặc thông báo lỗi bảo mật, có được đọc file đính kèm hay không).
+    """
+    # Hàm này sẽ trả về văn bản sạch hoặc thông báo lỗi "ERROR: [SECURITY_VIOLATION]..."
+    sanitized_sub_text = prompt_security_service.validate_and_sanitize(submission_text or "")
+
+    if "ERROR: [SECURITY_VIOLATION]" in sanitized_sub_text:
+        # Gian lận: nội dung bài làm chính là thông báo lỗi, bỏ qua bước đọc file
+        logger.warning(f"⚠️ [Security Block] Request {req_id}: Text submission contains prompt injection. Skipping file processing.")
+        return sanitized_sub_text, False
+
+    # File cũng được FileParserService quét injection + vệ sinh
+    logger.info(f"Request {req_id}: Text clean. Processing attachment files...")
+    return sanitized_sub_text, True
+
+
+async def _no_files() -> str:
+    return ""
+
+
+async def prepare_assignment_context(context: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse phần dùng chung của 1 batch chấm hàng loạt (file đề + file đáp án) trong worker.
+    Chạy 1 lần cho cả batch, kết quả được lưu lại; mục đã parse sẵn (ngữ cảnh cũ) được giữ nguyên.
+    """
+    prepared = {key: value for key, value in context.items() if key not in (
+        "assignment_content", "assignment_attachments", "reference_answer_text", "reference_answer_file"
+    )}
+    q_files, r_files = await asyncio.gather(
+        process_upload_files(context.get("assignment_attachments")) if "question" not in context else _no_files(),
+        process_upload_files(context.get("reference_answer_file")) if "reference" not in context else _no_files(),
+    )
+    if "question" not in context:
+        prepared["question"] = (context.get("assignment_content") or "") + q_files
+    if "reference" not in context:
+        prepared["reference"] = (context.get("reference_answer_text") or "") + r_files
+    return prepared
+
+
+async def prepare_grading_input(data: Dict[str, Any], request_id: str = "") -> Dict[str, Any]:
+    """
+    Bước tiền xử lý trong worker: parse file đề / bài làm / đáp án (đồng thời), vệ sinh bài làm, kiểm tra
+    có nội dung để chấm. Mục nào đã có sẵn (job cũ, ngữ cảnh dùng chung đã parse) được giữ nguyên.
+    Thiếu nội dung -> ValueError (job kết thúc với lỗi, gửi qua webhook).
+    """
+    prepared = {key: value for key, value in data.items() if key not in (
+        "assignment_content", "assignment_attachments", "student_submission_text", "student_submission_files",
+        "reference_answer_text", "reference_answer_file"
+    )}
+
+    needs_submission = "submission" not in data
+    sanitized_sub_text, parse_submission_files = "", False
+    if needs_submission:
+        sanitized_sub_text, parse_submission_files = check_submission_text(request_id, data.get("student_submission_text"))
+
+    # 3 nhóm file parse cùng lúc (giới hạn chung FILE_PARSE_MAX_CONCURRENCY), kết quả giữ đúng thứ tự
+    s_files_content, q_files, r_files = await asyncio.gather(
+        process_upload_files(data.get("student_submission_files")) if parse_submission_files else _no_files(),
+        process_upload_files(data.get("assignment_attachments")) if "question" not in data else _no_files(),
+        process_upload_files(data.get("reference_answer_file")) if "reference" not in data else _no_files(),
+    )
+
+    if needs_submission:
+        try:
+            validate_submission_content(sanitized_sub_text, s_files_content)
+        except HTTPException as e:
+            raise ValueError(e.detail)
+        # Kết hợp văn bản đã vệ sinh + nội dung file (nếu có)
+        prepared["submission"] = sanitized_sub_text + s_files_content
+
+    if "question" not in data:
+        prepared["question"] = (data.get("assignment_content") or "") + q_files
+
+    if "reference" not in data:
+        prepared["reference"] = (data.get("reference_answer_text") or "") + r_files
+
+    return prepared
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.ollama_pool import ollama_pool
+
+logger = logging.getLogger("concurrency")
+
+
+class AdaptiveLimiter:
+    """
+    Giới hạn concurrency tự điều chỉnh (AIMD) thay cho asyncio.Semaphore cố định:
+    - Tăng cộng: mỗi "vòng" (limit request thành công khi đang dùng hết slot) -> limit + 1.
+    - Giảm nhân: latency tăng vọt so với nền, tokens/sec tụt, timeout hoặc 5xx -> limit * decrease_factor.
+    - Luôn nằm trong [min_limit, max_limit]; min_limit = max_limit -> hoạt động như semaphore thường.
+    Latency nền / tokens/sec nền là EWMA chậm, giá trị hiện tại là EWMA nhanh.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        min_limit: int,
+        max_limit: int,
+        initial_limit: Optional[int] = None,
+        latency_tolerance: float = 2.0,
+        decrease_factor: float = 0.7,
+        fast_smoothing: float = 0.3,
+        slow_smoothing: float = 0.05,
+    ):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.fast_smoothing = fast_smoothing
+        self.slow_smoothing = slow_smoothing
+        self._limit = float(min(max(initial_limit or self.min_limit, self.min_limit), self.max_limit))
+        self.in_flight = 0
+        self._latency_fast: Optional[float] = None
+        self._latency_slow: Optional[float] = None
+        self._tps_fast: Optional[float] = None
+        self._tps_slow: Optional[float] = None
+        self._last_decrease_at = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+        self._publish()
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @property
+    def adaptive(self) -> bool:
+        return self.max_limit > self.min_limit
+
+    def _get_condition(self) -> asyncio.Condition:
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def _publish(self):
+        metrics.set_gauge("concurrency_limit", self.limit, limiter=self.name)
+        metrics.set_gauge("concurrency_in_flight", self.in_flight, limiter=self.name)
+
+    @asynccontextmanager
+    async def slot(self):
+        """async with limiter.slot(): ... - chờ tới khi số request đang chạy < limit hiện tại."""
+        condition = self._get_condition()
+        async with condition:
+            while self.in_flight >= self.limit:
+                await condition.wait()
+            self.in_flight += 1
+        self._publish()
+        try:
+            yield
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+            self._publish()
+
+    @staticmethod
+    def _ewma(current: Optional[float], sample: float, alpha: float) -> float:
+        return sample if current is None else (1 - alpha) * current + alpha * sample
+
+    def _set_limit(self, new_limit: float, reason: str):
+        new_limit = min(max(new_limit, float(self.min_limit)), float(self.max_limit))
+        old = self.limit
+        self._limit = new_limit
+        if self.limit != old:
+            logger.info(f"🎚️ [Concurrency:{self.name}] {old} -> {self.limit} ({reason})")
+            metrics.inc("concurrency_limit_changes_total", limiter=self.name, reason=reason)
+            if self.limit > old and self._condition is not None:
+                asyncio.ensure_future(self._notify())
+        self._publish()
+
+    async def _notify(self):
+        condition = self._get_condition()
+        async with condition:
+            condition.notify_all()
+
+    def _decrease(self, reason: str):
+        # Một đợt quá tải chỉ giảm 1 lần: bỏ qua các tín hiệu tới trong cùng "vòng" latency
+        now = time.monotonic()
+        cooldown = self._latency_fast or 1.0
+        if now - self._last_decrease_at < cooldown:
+            return
+        self._last_decrease_at = now
+        self._set_limit(self._limit * self.decrease_factor, reason)
+
+    def record_sample(self, latency: float, tokens_per_second: Optional[float] = None):
+        """
+        Ghi nhận 1 lời gọi backend thành công.
+        latency: độ trễ tới token đầu (stream) hoặc toàn bộ lời gọi; tokens_per_second: tốc độ sinh.
+        """
+        self._latency_fast = self._ewma(self._latency_fast, latency, self.fast_smoothing)
+        self._latency_slow = self._ewma(self._latency_slow, latency, self.slow_smoothing)
+        if tokens_per_second:
+            self._tps_fast = self._ewma(self._tps_fast, tokens_per_second, self.fast_smoothing)
+            self._tps_slow = self._ewma(self._tps_slow, tokens_per_second, self.slow_smoothing)
+        if not self.adaptive:
+            return
+
+        if self._latency_fast > self._latency_slow * self.latency_tolerance:
+            self._decrease("latency")
+        elif self._tps_fast is not None and self._tps_fast * self.latency_tolerance < self._tps_slow:
+            self._decrease("throughput")
+        elif self.in_flight >= self.limit - 1:
+            # Chỉ tăng khi limit thực sự đang được dùng hết
+            self._set_limit(self._limit + 1.0 / max(self._limit, 1.0), "healthy")
+
+    def record_overload(self, reason: str = "error"):
+        """Timeout / 5xx / mất kết nối -> giảm limit ngay."""
+        if self.adaptive:
+            self._decrease(reason)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "latency_ewma_seconds": self._latency_fast,
+            "latency_baseline_seconds": self._latency_slow,
+            "tokens_per_second_ewma": self._tps_fast,
+            "tokens_per_second_baseline": self._tps_slow,
+        }
+
+    @classmethod
+    def from_settings(cls) -> "AdaptiveLimiter":
+        # Trần = tổng slot của các node; sàn = MAX_CONCURRENT_REQUESTS (giá trị đã biết là an toàn)
+        ceiling = ollama_pool.total_capacity
+        floor = min(settings.MAX_CONCURRENT_REQUESTS, ceiling)
+        if not settings.ADAPTIVE_CONCURRENCY_ENABLED:
+            floor = ceiling = max(settings.MAX_CONCURRENT_REQUESTS, ceiling)
+        return cls(
+            name="ollama",
+            min_limit=floor,
+            max_limit=ceiling,
+            latency_tolerance=settings.ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE,
+            decrease_factor=settings.ADAPTIVE_CONCURRENCY_DECREASE_FACTOR,
+        )
+
+# Khởi tạo singleton
+adaptive_limiter = AdaptiveLimiter.from_settings()
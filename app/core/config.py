@@ -9,10 +9,134 @@ class Settings(BaseSettings):
     MODEL_NAME: str
 
     MAX_INPUT_TOKENS: int = 3000
-    MAX_CONCURRENT_REQUESTS: int = 1
+
+    # --- Context / num_ctx ---
+    OLLAMA_MIN_NUM_CTX: int = 2048
+    OLLAMA_MAX_NUM_CTX: int = 8192
+    OLLAMA_NUM_CTX_STEP: int = 1024  # Làm tròn num_ctx theo bậc để Ollama ít phải nạp lại model
+    RESPONSE_TOKEN_RESERVE: int = 768  # Token dành cho output JSON
+    TOKEN_SAFETY_MARGIN: float = 1.15  # tiktoken đếm khác tokenizer của Qwen
+    MAX_CONCURRENT_REQUESTS: int = 1  # Sàn của giới hạn concurrency tự điều chỉnh
+
+    # --- Adaptive Concurrency (AIMD thay cho semaphore cố định) ---
+    ADAPTIVE_CONCURRENCY_ENABLED: bool = True
+    ADAPTIVE_CONCURRENCY_MAX_PER_NODE: int = 4  # Trần slot mỗi node (khi không đặt OLLAMA_NODE_MAX_CONCURRENCY)
+    ADAPTIVE_CONCURRENCY_LATENCY_TOLERANCE: float = 2.0  # Latency > nền x hệ số này -> giảm
+    ADAPTIVE_CONCURRENCY_DECREASE_FACTOR: float = 0.7
+
+    # --- Ollama Pool (nhiều node) ---
+    # Dạng "http://gpu1:11434=2,http://gpu2:11434" (=N là số slot của node). Bỏ trống -> chỉ dùng OLLAMA_HOST
+    OLLAMA_HOSTS: Optional[str] = None
+    OLLAMA_NODE_MAX_CONCURRENCY: Optional[int] = None  # Mặc định = ADAPTIVE_CONCURRENCY_MAX_PER_NODE (hoặc MAX_CONCURRENT_REQUESTS nếu tắt adaptive)
+    OLLAMA_EJECT_AFTER_FAILURES: int = 3  # Số lỗi liên tiếp trước khi loại node
+    OLLAMA_PROBE_INTERVAL: float = 15.0  # Giây giữa các lần probe node bị loại
+    OLLAMA_STICKY_ROUTING: bool = True  # Cùng bài tập -> ưu tiên cùng node (tái sử dụng KV cache)
+    OLLAMA_KEEP_ALIVE: str = "30m"  # Thời gian Ollama giữ model trong bộ nhớ sau mỗi request
+
+    # --- Circuit Breaker (bảo vệ backend Ollama) ---
+    CIRCUIT_BREAKER_FAILURE_THRESHOLD: int = 5  # Số lỗi liên tiếp để ngắt mạch
+    CIRCUIT_BREAKER_RECOVERY_TIMEOUT: float = 30.0  # Giây chờ trước khi thăm dò lại (half-open)
+    CIRCUIT_BREAKER_HALF_OPEN_MAX_CALLS: int = 1
+    CIRCUIT_BREAKER_PARK_JOBS: bool = True  # True: job chờ mạch đóng lại | False: báo lỗi ngay
+
+    # --- Warm-up (nạp sẵn model khi khởi động) ---
+    WARMUP_ENABLED: bool = True
+    WARMUP_KEEP_ALIVE: str = "24h"
+    WARMUP_PING_INTERVAL: float = 300.0  # Ping lại node rảnh sau mỗi khoảng này (giây)
+    WARMUP_TIMEOUT: float = 600.0  # Nạp model lần đầu có thể rất lâu
+
+    # --- Prompt Layout ---
+    # "classic": thứ tự gốc | "prefix_stable": phần chung của bài tập trước, bài làm sinh viên cuối cùng
+    PROMPT_LAYOUT: str = "classic"
+    PROMPT_SUBMISSION_BUDGET_SHARE: float = 0.4  # Tỉ lệ ngân sách token dành cho bài làm (prefix_stable)
+
+    # Gửi JSON schema của GradingOutput làm "format" (structured output) thay vì "json" lỏng
+    OLLAMA_STRUCTURED_OUTPUT: bool = True
+
+    # Chấm điểm ở chế độ stream: ngắt request ngay khi đã nhận đủ object JSON
+    OLLAMA_STREAM_GRADING: bool = True
 
     SHARED_SECRET_KEY: Optional[str] = None
 
+    # --- HTTP Client Settings (Pool dùng chung cho Ollama + Webhook) ---
+    HTTP_POOL_MAX_CONNECTIONS: int = 20
+    HTTP_POOL_MAX_KEEPALIVE: int = 10
+    HTTP_KEEPALIVE_EXPIRY: float = 60.0  # Giây
+    HTTP_CONNECT_TIMEOUT: float = 5.0
+    HTTP_READ_TIMEOUT: float = 120.0  # Ollama sinh văn bản lâu -> read timeout dài
+    HTTP_WRITE_TIMEOUT: float = 30.0
+    HTTP_POOL_TIMEOUT: float = 30.0
+    WEBHOOK_TIMEOUT: float = 30.0
+
+    # --- Webhook Delivery ---
+    WEBHOOK_MAX_ATTEMPTS: int = 5  # Hết số lần thử -> dead-letter
+    WEBHOOK_BACKOFF_BASE: float = 2.0  # Backoff ngẫu nhiên trong [0, base * 2^lần thử]
+    WEBHOOK_BACKOFF_MAX: float = 300.0
+    WEBHOOK_MAX_IN_FLIGHT_PER_HOST: int = 4  # Không dội quá nhiều request vào 1 máy chủ Moodle
+    WEBHOOK_MAX_IN_FLIGHT: int = 32
+    # Webhook trong outbox không được cập nhật quá khoảng này -> tiến trình sở hữu đã chết, tiến trình khởi động sau gửi lại
+    WEBHOOK_OUTBOX_STALE_SECONDS: float = 900.0
+
+    # --- Result Cache (kết quả chấm theo nội dung đầu vào) ---
+    RESULT_CACHE_ENABLED: bool = True
+    RESULT_CACHE_DB_PATH: str = os.path.join(os.getcwd(), "data", "result_cache.db")
+    RESULT_CACHE_MEMORY_SIZE: int = 512  # Số kết quả giữ trong RAM (LRU)
+    RESULT_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    RESULT_CACHE_MAX_ENTRIES: int = 20000  # Giới hạn số bản ghi trên đĩa
+
+    # --- Job Queue (hàng đợi bền vững trên SQLite) ---
+    JOB_DB_PATH: str = os.path.join(os.getcwd(), "data", "jobs.db")
+    JOB_WORKER_COUNT: Optional[int] = None  # Mặc định = 2 x trần concurrency
+    JOB_LEASE_SECONDS: float = 120.0  # Worker không heartbeat trong khoảng này -> job được đưa lại hàng đợi
+    JOB_HEARTBEAT_INTERVAL: float = 30.0
+    JOB_MAX_ATTEMPTS: int = 3  # Số lần worker "mất" job trước khi đánh dấu failed
+    JOB_POLL_INTERVAL: float = 5.0  # Giây giữa các lần worker rảnh kiểm tra lại hàng đợi
+    # request_id đã chấm xong trong khoảng này -> trả lại kết quả đã lưu thay vì chấm lại
+    JOB_IDEMPOTENCY_RETENTION_SECONDS: float = 24 * 3600
+    JOB_COALESCE_IDENTICAL: bool = True  # Job trùng nội dung với job đang chạy -> dùng chung 1 lần chấm
+    # Job đã kết thúc quá JOB_IDEMPOTENCY_RETENTION_SECONDS bị xóa (cả bài làm đã parse), kiểm tra mỗi khoảng này
+    JOB_RETENTION_SWEEP_INTERVAL: float = 3600.0
+
+    # --- Backpressure (429 khi hàng đợi quá sâu) ---
+    JOB_MAX_QUEUE_DEPTH: Optional[int] = 2000  # None -> không giới hạn
+    JOB_MAX_ESTIMATED_WAIT_SECONDS: Optional[float] = None  # vd: 4 * 3600
+    JOB_DEFAULT_SERVICE_SECONDS: float = 30.0  # Ước lượng khi chưa đo được job nào
+    JOB_MAX_RETRY_AFTER_SECONDS: float = 3600.0
+
+    # --- Fair Scheduling (chia đều worker giữa các khóa học) ---
+    SCHEDULER_FAIR_SHARE: bool = True  # False -> FIFO toàn cục như trước
+    # Dạng "CS101=3,MATH2=0.5": khóa học trọng số 3 được xử lý gấp 3 lần khóa trọng số 1
+    SCHEDULER_COURSE_WEIGHTS: Optional[str] = None
+    SCHEDULER_DEFAULT_WEIGHT: float = 1.0
+    # Thứ tự trong 1 hàng đợi: "fifo" (cũ nhất trước) | "sjf" (ít token nhất trước, có aging)
+    SCHEDULER_POLICY: str = "fifo"
+    # SJF aging: mỗi giây chờ được tính như nhỏ đi bấy nhiêu token (5 -> job 3000 token chờ tối đa ~10 phút)
+    SCHEDULER_SJF_AGING_TOKENS_PER_SECOND: float = 5.0
+
+    # --- Cross-process LLM Slots (chạy nhiều worker uvicorn/gunicorn) ---
+    # Bật khi chạy > 1 tiến trình: tổng request Ollama đồng thời của mọi tiến trình <= LLM_GLOBAL_CONCURRENCY
+    LLM_GLOBAL_SLOTS_ENABLED: bool = False
+    LLM_GLOBAL_CONCURRENCY: Optional[int] = None  # Mặc định = tổng slot của các node Ollama
+    LLM_SLOT_LEASE_SECONDS: float = 60.0  # Tiến trình chết -> slot được thu hồi sau khoảng này
+    LLM_SLOT_POLL_INTERVAL: float = 0.25  # Giây tối đa giữa các lần thử lấy slot
+
+    # --- File Parsing (file đính kèm: bài làm, đề bài, đáp án) ---
+    FILE_PARSE_MAX_CONCURRENCY: int = 4  # Số file được parse đồng thời trong tiến trình (CPU bound)
+    # Cache văn bản đã parse theo nội dung file (đề bài / đáp án dùng chung không parse lại cho từng sinh viên)
+    DOCUMENT_CACHE_ENABLED: bool = True
+    DOCUMENT_CACHE_DB_PATH: str = os.path.join(os.getcwd(), "data", "document_cache.db")
+    DOCUMENT_CACHE_MEMORY_SIZE: int = 128  # Số văn bản giữ trong RAM (LRU)
+    DOCUMENT_CACHE_MAX_DISK_MB: int = 512  # Giới hạn dung lượng trên đĩa
+    # Trích xuất PDF trong process pool: số tiến trình (0 -> trong thread như cũ) + số trang mỗi đoạn song song
+    PDF_EXTRACT_WORKERS: int = 2
+    PDF_PAGES_PER_TASK: int = 25
+    # Giới hạn đầu vào: file lớn hơn bị từ chối (báo lỗi trong <file_attachment>), PDF chỉ lấy N trang đầu
+    FILE_MAX_BYTES: int = 25 * 1024 * 1024
+    PDF_MAX_PAGES: int = 300
+    # Ngừng trích xuất khi văn bản 1 file đạt ngân sách này (phần sau đằng nào cũng bị cắt khỏi context). None -> không giới hạn
+    FILE_TOKEN_BUDGET: Optional[int] = 8000
+    FILE_TEXT_CHUNK_CHARS: int = 16 * 1024  # File văn bản được đọc từng đoạn thay vì đọc cả file
+
     # --- RAG Settings ---
     # Lưu DB vào thư mục data để map volume Docker dễ dàng
     CHROMA_DB_DIR: str = os.path.join(os.getcwd(), "data", "chroma_db")
@@ -0,0 +1,58 @@
+import httpx
+import logging
+from typing import Optional
+from app.core.config import settings
+
+logger = logging.getLogger("http_client")
+
+class HttpClientManager:
+    """
+    Quản lý một httpx.AsyncClient dùng chung cho toàn ứng dụng:
+    1. Connection pool + keep-alive (tránh TCP connect lại mỗi lần gọi Ollama).
+    2. Timeout tách theo từng pha (connect / read / write / pool).
+    3. Vòng đời gắn với startup/shutdown của FastAPI (app/main.py).
+    """
+
+    def __init__(self):
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(
+            max_connections=settings.HTTP_POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.HTTP_POOL_MAX_KEEPALIVE,
+            keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+        )
+        timeout = httpx.Timeout(
+            connect=settings.HTTP_CONNECT_TIMEOUT,
+            read=settings.HTTP_READ_TIMEOUT,
+            write=settings.HTTP_WRITE_TIMEOUT,
+            pool=settings.HTTP_POOL_TIMEOUT,
+        )
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+    async def startup(self):
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+            logger.info(
+                f"🔌 [HTTP] Khởi tạo connection pool "
+                f"(max={settings.HTTP_POOL_MAX_CONNECTIONS}, keep-alive={settings.HTTP_POOL_MAX_KEEPALIVE})"
+            )
+
+    async def shutdown(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("🔌 [HTTP] Đã đóng connection pool")
+        self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """
+        Trả về client dùng chung. Nếu được gọi ngoài vòng đời app (script, test)
+        thì tự khởi tạo để không bị lỗi.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+        return self._client
+
+# Khởi tạo singleton
+http_client_manager = HttpClientManager()
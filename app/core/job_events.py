@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Set, Optional, Any
+
+logger = logging.getLogger("job_events")
+
+# request_id của job đang chạy trong task hiện tại (để service sâu bên dưới phát sự kiện mà không cần truyền tham số)
+current_job_id: ContextVar[Optional[str]] = ContextVar("current_job_id", default=None)
+
+# Sự kiện kết thúc: stream SSE đóng sau khi gửi
+TERMINAL_EVENTS = ("done", "failed", "cancelled")
+
+
+class JobEventBus:
+    """
+    Phát sự kiện tiến trình của từng job (trong tiến trình hiện tại) cho các subscriber SSE:
+    - "stage": chuyển giai đoạn (queued, running, parked, prompt_built, generating, ...).
+    - "token": token feedback vừa sinh từ Ollama.
+    - "done" | "failed" | "cancelled": kết thúc.
+    Không có subscriber -> publish gần như không tốn gì.
+    """
+
+    def __init__(self, max_buffer: int = 1000):
+        self.max_buffer = max_buffer
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+    def publish(self, request_id: str, event: str, **data: Any):
+        queues = self._subscribers.get(request_id)
+        if not queues:
+            return
+        message = {"event": event, "request_id": request_id, "timestamp": time.time(), **data}
+        for queue in queues:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Client đọc chậm: bỏ token, vẫn cố giữ sự kiện giai đoạn
+                if event != "token":
+                    queue.get_nowait()
+                    queue.put_nowait(message)
+
+    def emit(self, event: str, **data: Any):
+        """Phát sự kiện cho job đang chạy trong context hiện tại (nếu có)."""
+        request_id = current_job_id.get()
+        if request_id:
+            self.publish(request_id, event, **data)
+
+    def stage(self, stage: str, **data: Any):
+        self.emit("stage", stage=stage, **data)
+
+    @contextmanager
+    def subscribe(self, request_id: str):
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.max_buffer)
+        self._subscribers[request_id].add(queue)
+        try:
+            yield queue
+        finally:
+            self._subscribers[request_id].discard(queue)
+            if not self._subscribers[request_id]:
+                del self._subscribers[request_id]
+
+# Khởi tạo singleton
+job_events = JobEventBus()
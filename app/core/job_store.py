@@ -0,0 +1,512 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Dict, Any, List, Tuple
+from app.core.config import settings
+
+logger = logging.getLogger("job_store")
+
+# Vòng đời job: queued -> running -> done | failed (| cancelled khi bị hủy qua API)
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_CANCELLED = "cancelled"
+# Job trùng nội dung với 1 job đang chạy: không chấm lại, chờ dùng chung kết quả
+STATUS_COALESCED = "coalesced"
+ACTIVE_STATUSES = (STATUS_QUEUED, STATUS_RUNNING, STATUS_COALESCED)
+FINISHED_STATUSES = (STATUS_DONE, STATUS_FAILED, STATUS_CANCELLED)
+
+_JSON_COLUMNS = ("input_data", "result")
+# Cột thêm sau phiên bản đầu tiên (ALTER TABLE cho DB cũ)
+_ADDED_COLUMNS = {
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "content_hash": "TEXT",
+    "coalesced_into": "TEXT",
+    "estimated_tokens": "INTEGER",
+    "batch_id": "TEXT",
+    "batch_notified": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+class JobStore:
+    """
+    Hàng đợi job bền vững trên SQLite (WAL mode):
+    - Job không mất khi container restart / deploy.
+    - Worker "thuê" (lease) job có thời hạn, gia hạn bằng heartbeat.
+    - Worker chết -> lease hết hạn -> job được đưa lại hàng đợi (recover_expired).
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " request_id TEXT PRIMARY KEY,"
+                " kind TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " course_id TEXT,"
+                " callback_url TEXT NOT NULL,"
+                " input_data TEXT NOT NULL,"
+                " result TEXT,"
+                " error TEXT,"
+                " priority INTEGER NOT NULL DEFAULT 0,"
+                " content_hash TEXT,"
+                " coalesced_into TEXT,"
+                " estimated_tokens INTEGER,"
+                " batch_id TEXT,"
+                " batch_notified INTEGER NOT NULL DEFAULT 0,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " created_at REAL NOT NULL,"
+                " started_at REAL,"
+                " finished_at REAL,"
+                " lease_owner TEXT,"
+                " lease_expires_at REAL,"
+                " heartbeat_at REAL)"
+            )
+            columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, definition in _ADDED_COLUMNS.items():
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs(status, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs(status, priority, course_id, created_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_content_hash ON jobs(content_hash, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_coalesced_into ON jobs(coalesced_into)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_batch ON jobs(batch_id, status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_finished ON jobs(status, finished_at)")
+            # Ngữ cảnh bài tập dùng chung của các job chấm hàng loạt: data = đầu vào gốc (văn bản + đường dẫn file),
+            # prepared = đề / đáp án đã parse (worker đầu tiên parse rồi lưu lại cho các job còn lại)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS assignment_contexts ("
+                " context_id TEXT PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " prepared TEXT,"
+                " created_at REAL NOT NULL)"
+            )
+            context_columns = {row["name"] for row in conn.execute("PRAGMA table_info(assignment_contexts)")}
+            if "prepared" not in context_columns:
+                conn.execute("ALTER TABLE assignment_contexts ADD COLUMN prepared TEXT")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_batches ("
+                " batch_id TEXT PRIMARY KEY,"
+                " context_id TEXT,"
+                " callback_url TEXT NOT NULL,"
+                " callback_batch_size INTEGER,"
+                " total INTEGER,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _row_to_job(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+        if row is None:
+            return None
+        job = dict(row)
+        for column in _JSON_COLUMNS:
+            if job.get(column) is not None:
+                job[column] = json.loads(job[column])
+        return job
+
+    def enqueue(
+        self,
+        request_id: str,
+        kind: str,
+        input_data: Dict[str, Any],
+        callback_url: str,
+        course_id: Optional[str] = None,
+        priority: int = 0,
+        content_hash: Optional[str] = None,
+        retention_seconds: float = 0.0,
+        estimated_tokens: Optional[int] = None,
+        batch_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Thêm job vào hàng đợi (idempotent). Job trả về có thêm khóa "admission":
+        - "queued": job mới (hoặc chấm lại request_id đã kết thúc ngoài thời gian lưu giữ / bị lỗi).
+        - "duplicate": request_id đang queued/running -> giữ nguyên job cũ, không chạy trùng.
+        - "completed": request_id đã chấm xong trong retention_seconds -> dùng lại kết quả đã lưu.
+        - "coalesced": job khác cùng content_hash đang chờ/chạy -> dùng chung kết quả của job đó.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                existing = conn.execute("SELECT status, finished_at FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                admission = None
+                if existing is not None:
+                    if existing["status"] in ACTIVE_STATUSES:
+                        admission = "duplicate"
+                    elif existing["status"] == STATUS_DONE and now - (existing["finished_at"] or 0) <= retention_seconds:
+                        admission = "completed"
+
+                if admission is None:
+                    primary = None
+                    if content_hash:
+                        primary = conn.execute(
+                            "SELECT request_id FROM jobs WHERE content_hash = ? AND status IN (?, ?) AND request_id != ?"
+                            " ORDER BY created_at LIMIT 1",
+                            (content_hash, STATUS_QUEUED, STATUS_RUNNING, request_id),
+                        ).fetchone()
+                    admission = "coalesced" if primary else "queued"
+                    conn.execute(
+                        "INSERT OR REPLACE INTO jobs (request_id, kind, status, course_id, priority, callback_url, input_data,"
+                        " content_hash, coalesced_into, estimated_tokens, batch_id, attempts, created_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, ?)",
+                        (request_id, kind, STATUS_COALESCED if primary else STATUS_QUEUED, course_id, priority, callback_url,
+                         json.dumps(input_data, ensure_ascii=False), content_hash, primary["request_id"] if primary else None,
+                         estimated_tokens, batch_id, now),
+                    )
+                row = conn.execute("SELECT * FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        job = self._row_to_job(row)
+        job["admission"] = admission
+        return job
+
+    def lease_next(
+        self,
+        worker_id: str,
+        lease_seconds: float,
+        course_id: Optional[str] = None,
+        priority: Optional[int] = None,
+        any_queue: bool = True,
+        shortest_first: bool = False,
+        aging_tokens_per_second: float = 0.0
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Lấy job cũ nhất đang chờ và đánh dấu running (atomic, an toàn giữa nhiều tiến trình).
+        any_queue=False -> chỉ lấy trong hàng đợi (priority, course_id) do scheduler chọn.
+        shortest_first=True -> lấy job có estimated_tokens nhỏ nhất (SJF); mỗi giây chờ trừ đi
+        aging_tokens_per_second để job lớn không bị "đói" mãi. Job không có ước lượng coi như 0 token.
+        """
+        now = time.time()
+        query = "SELECT request_id FROM jobs WHERE status = ?"
+        params: List[Any] = [STATUS_QUEUED]
+        if not any_queue:
+            query += " AND priority = ? AND course_id IS ?"
+            params += [priority, course_id]
+        if shortest_first:
+            query += " ORDER BY priority DESC, COALESCE(estimated_tokens, 0) - ? * (? - created_at), created_at LIMIT 1"
+            params += [aging_tokens_per_second, now]
+        else:
+            query += " ORDER BY priority DESC, created_at LIMIT 1"
+
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(query, params).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ?,"
+                    " lease_owner = ?, lease_expires_at = ?, heartbeat_at = ? WHERE request_id = ?",
+                    (STATUS_RUNNING, now, worker_id, now + lease_seconds, now, row["request_id"]),
+                )
+                job = conn.execute("SELECT * FROM jobs WHERE request_id = ?", (row["request_id"],)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return self._row_to_job(job)
+
+    def heartbeat(self, request_id: str, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._get_conn().execute(
+                "UPDATE jobs SET heartbeat_at = ?, lease_expires_at = ?"
+                " WHERE request_id = ? AND lease_owner = ? AND status = ?",
+                (now, now + lease_seconds, request_id, worker_id, STATUS_RUNNING),
+            )
+            return cursor.rowcount > 0
+
+    def _finish(self, request_id: str, status: str, result: Optional[Dict[str, Any]], error: Optional[str]) -> bool:
+        """Ghi kết quả cuối. Job đã bị hủy thì giữ nguyên (trả về False)."""
+        with self._lock:
+            cursor = self._get_conn().execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?,"
+                " lease_owner = NULL, lease_expires_at = NULL WHERE request_id = ? AND status != ?",
+                (status, json.dumps(result, ensure_ascii=False) if result is not None else None, error, time.time(),
+                 request_id, STATUS_CANCELLED),
+            )
+            return cursor.rowcount > 0
+
+    def complete(self, request_id: str, result: Optional[Dict[str, Any]]) -> bool:
+        return self._finish(request_id, STATUS_DONE, result, None)
+
+    def fail(self, request_id: str, error: str, result: Optional[Dict[str, Any]] = None) -> bool:
+        return self._finish(request_id, STATUS_FAILED, result, error)
+
+    def cancel(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Hủy job queued / coalesced / running. Trả về job (None nếu không tồn tại) kèm
+        "previous_status" và "cancelled" (False nếu job đã kết thúc từ trước).
+        Job bị hủy đang có job khác gộp vào -> job gộp đầu tiên được đưa lên thay thế.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT status FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                previous_status = row["status"]
+                cancelled = previous_status in ACTIVE_STATUSES
+                if cancelled:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_owner = NULL, lease_expires_at = NULL"
+                        " WHERE request_id = ?",
+                        (STATUS_CANCELLED, "Cancelled by client", now, request_id),
+                    )
+                    followers = conn.execute(
+                        "SELECT request_id FROM jobs WHERE coalesced_into = ? AND status = ? ORDER BY created_at",
+                        (request_id, STATUS_COALESCED),
+                    ).fetchall()
+                    if followers:
+                        heir = followers[0]["request_id"]
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, coalesced_into = NULL WHERE request_id = ?", (STATUS_QUEUED, heir)
+                        )
+                        conn.execute(
+                            "UPDATE jobs SET coalesced_into = ? WHERE coalesced_into = ? AND status = ?",
+                            (heir, request_id, STATUS_COALESCED),
+                        )
+                job = conn.execute("SELECT * FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        job = self._row_to_job(job)
+        job["previous_status"] = previous_status
+        job["cancelled"] = cancelled
+        return job
+
+    def requeue(self, request_id: str, worker_id: str):
+        """Trả job về hàng đợi khi worker dừng có chủ đích (shutdown), không tính là 1 lần thử."""
+        with self._lock:
+            self._get_conn().execute(
+                "UPDATE jobs SET status = ?, attempts = MAX(attempts - 1, 0), lease_owner = NULL, lease_expires_at = NULL"
+                " WHERE request_id = ? AND lease_owner = ? AND status = ?",
+                (STATUS_QUEUED, request_id, worker_id, STATUS_RUNNING),
+            )
+
+    def recover_expired(self, max_attempts: int) -> List[Dict[str, Any]]:
+        """
+        Job running có lease đã hết hạn (worker crash) -> đưa lại hàng đợi.
+        Job đã thử quá max_attempts lần -> failed. Trả về danh sách job bị chuyển sang failed.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                expired = conn.execute(
+                    "SELECT * FROM jobs WHERE status = ? AND lease_expires_at < ?", (STATUS_RUNNING, now)
+                ).fetchall()
+                failed = []
+                for row in expired:
+                    if row["attempts"] >= max_attempts:
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_owner = NULL, lease_expires_at = NULL"
+                            " WHERE request_id = ?",
+                            (STATUS_FAILED, "Worker lost the job too many times", now, row["request_id"]),
+                        )
+                        failed.append(row["request_id"])
+                    else:
+                        conn.execute(
+                            "UPDATE jobs SET status = ?, lease_owner = NULL, lease_expires_at = NULL WHERE request_id = ?",
+                            (STATUS_QUEUED, row["request_id"]),
+                        )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if expired:
+            logger.warning(f"♻️ [Recover] {len(expired) - len(failed)} job được đưa lại hàng đợi, {len(failed)} job thất bại")
+        return [self.get(request_id) for request_id in failed]
+
+    def followers_of(self, request_id: str) -> List[Dict[str, Any]]:
+        """Các job đang chờ dùng chung kết quả của job request_id."""
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT * FROM jobs WHERE coalesced_into = ? AND status = ?", (request_id, STATUS_COALESCED)
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    def save_context(self, context_id: str, data: Dict[str, Any]):
+        """Lưu ngữ cảnh bài tập dùng chung (context_id là hash nội dung -> gửi lại không tạo bản mới)."""
+        with self._lock:
+            self._get_conn().execute(
+                "INSERT OR IGNORE INTO assignment_contexts (context_id, data, created_at) VALUES (?, ?, ?)",
+                (context_id, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+
+    def get_context(self, context_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT data FROM assignment_contexts WHERE context_id = ?", (context_id,)
+            ).fetchone()
+        return json.loads(row["data"]) if row else None
+
+    def get_prepared_context(self, context_id: str) -> Optional[Dict[str, Any]]:
+        """Ngữ cảnh đã parse (None nếu chưa worker nào parse)."""
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT prepared FROM assignment_contexts WHERE context_id = ?", (context_id,)
+            ).fetchone()
+        return json.loads(row["prepared"]) if row and row["prepared"] else None
+
+    def save_prepared_context(self, context_id: str, prepared: Dict[str, Any]):
+        with self._lock:
+            self._get_conn().execute(
+                "UPDATE assignment_contexts SET prepared = ? WHERE context_id = ?",
+                (json.dumps(prepared, ensure_ascii=False), context_id),
+            )
+
+    def create_batch(
+        self,
+        batch_id: str,
+        context_id: Optional[str],
+        callback_url: str,
+        callback_batch_size: Optional[int]
+    ):
+        """Tạo batch "mở" (total = NULL): chưa gửi phần kết quả cuối cho tới khi seal_batch."""
+        with self._lock:
+            self._get_conn().execute(
+                "INSERT OR REPLACE INTO job_batches (batch_id, context_id, callback_url, callback_batch_size, total, created_at)"
+                " VALUES (?, ?, ?, ?, NULL, ?)",
+                (batch_id, context_id, callback_url, callback_batch_size, time.time()),
+            )
+
+    def seal_batch(self, batch_id: str):
+        """Đã enqueue xong: total = số job thực sự thuộc batch."""
+        with self._lock:
+            self._get_conn().execute(
+                "UPDATE job_batches SET total = (SELECT COUNT(*) FROM jobs WHERE batch_id = ?) WHERE batch_id = ?",
+                (batch_id, batch_id),
+            )
+
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._get_conn().execute("SELECT * FROM job_batches WHERE batch_id = ?", (batch_id,)).fetchone()
+        return dict(row) if row else None
+
+    def collect_batch_results(self, batch_id: str, min_results: int) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Lấy các job đã xong của batch chưa được gửi callback, khi đủ min_results job
+        hoặc batch đã seal và không còn job nào đang chờ/chạy (gửi nốt phần còn lại).
+        Đánh dấu đã gửi trong cùng transaction -> mỗi kết quả chỉ nằm trong 1 callback.
+        Trả về (danh sách job, số job còn đang chờ/chạy).
+        """
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                remaining = conn.execute(
+                    f"SELECT COUNT(*) AS n FROM jobs WHERE batch_id = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                    (batch_id, *ACTIVE_STATUSES),
+                ).fetchone()["n"]
+                rows = conn.execute(
+                    "SELECT * FROM jobs WHERE batch_id = ? AND status IN (?, ?) AND batch_notified = 0 ORDER BY finished_at",
+                    (batch_id, STATUS_DONE, STATUS_FAILED),
+                ).fetchall()
+                sealed = conn.execute(
+                    "SELECT total IS NOT NULL AS sealed FROM job_batches WHERE batch_id = ?", (batch_id,)
+                ).fetchone()
+                if not (sealed and sealed["sealed"]):
+                    # Batch còn đang enqueue: chưa biết đã đủ job hay chưa
+                    remaining = max(remaining, 1)
+                if rows and (len(rows) >= min_results or remaining == 0):
+                    conn.executemany(
+                        "UPDATE jobs SET batch_notified = 1 WHERE request_id = ?", [(row["request_id"],) for row in rows]
+                    )
+                else:
+                    rows = []
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [self._row_to_job(row) for row in rows], remaining
+
+    def purge_finished(self, older_than: float) -> Dict[str, int]:
+        """
+        Xóa job đã kết thúc trước thời điểm older_than (kèm input_data chứa bài làm đã parse),
+        rồi tới batch không còn job nào và ngữ cảnh bài tập không còn batch nào dùng (cùng ngưỡng thời gian).
+        Job của batch chưa được gửi callback được giữ lại.
+        """
+        placeholders = ", ".join("?" * len(FINISHED_STATUSES))
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                jobs = conn.execute(
+                    f"DELETE FROM jobs WHERE status IN ({placeholders}) AND finished_at < ?"
+                    " AND (batch_id IS NULL OR batch_notified = 1)",
+                    (*FINISHED_STATUSES, older_than),
+                ).rowcount
+                batches = conn.execute(
+                    "DELETE FROM job_batches WHERE created_at < ?"
+                    " AND NOT EXISTS (SELECT 1 FROM jobs WHERE jobs.batch_id = job_batches.batch_id)",
+                    (older_than,),
+                ).rowcount
+                contexts = conn.execute(
+                    "DELETE FROM assignment_contexts WHERE created_at < ?"
+                    " AND NOT EXISTS (SELECT 1 FROM job_batches WHERE job_batches.context_id = assignment_contexts.context_id)",
+                    (older_than,),
+                ).rowcount
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {"jobs": jobs, "batches": batches, "contexts": contexts}
+
+    def queued_summary(self) -> List[Dict[str, Any]]:
+        """Thống kê từng hàng đợi (priority, course_id): số job đang chờ + thời điểm job cũ nhất."""
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT priority, course_id, COUNT(*) AS depth, MIN(created_at) AS oldest_created_at"
+                " FROM jobs WHERE status = ? GROUP BY priority, course_id",
+                (STATUS_QUEUED,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def get(self, request_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._get_conn().execute("SELECT * FROM jobs WHERE request_id = ?", (request_id,)).fetchone()
+        return self._row_to_job(row)
+
+    def count_by_status(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._get_conn().execute("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status").fetchall()
+        return {row["status"]: row["total"] for row in rows}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# Khởi tạo singleton
+job_store = JobStore(settings.JOB_DB_PATH)
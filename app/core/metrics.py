@@ -0,0 +1,73 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Any
+
+class MetricsRegistry:
+    """
+    Bộ đếm số liệu nội bộ (in-process), không phụ thuộc thư viện ngoài.
+    - Counter: inc("llm_requests_total", model="qwen")
+    - Gauge:   set_gauge("queue_depth", 12)
+    - Timing:  observe("llm_generation_seconds", 3.2)
+    Xem toàn bộ qua GET /utils/metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Dict[str, float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> str:
+        if not labels:
+            return name
+        label_str = ",".join(f"{k}={v}" for k, v in sorted(labels.items()))
+        return f"{name}{{{label_str}}}"
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] += value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            stat = self._timings.get(key)
+            if stat is None:
+                stat = {"count": 0, "sum": 0.0, "min": value, "max": value, "last": value}
+                self._timings[key] = stat
+            stat["count"] += 1
+            stat["sum"] += value
+            stat["min"] = min(stat["min"], value)
+            stat["max"] = max(stat["max"], value)
+            stat["last"] = value
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            timings = {
+                key: {**stat, "avg": stat["sum"] / stat["count"] if stat["count"] else 0.0}
+                for key, stat in self._timings.items()
+            }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings,
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._timings.clear()
+
+# Khởi tạo singleton
+metrics = MetricsRegistry()
@@ -0,0 +1,128 @@
+import logging
+from typing import Dict, List, Optional, Tuple, Any, Callable
+from app.core.config import settings
+
+logger = logging.getLogger("scheduler")
+
+# Lớp ưu tiên: interactive (chấm lại đơn lẻ, giáo viên đang chờ) luôn được lấy trước bulk
+PRIORITY_BULK = 0
+PRIORITY_INTERACTIVE = 1
+PRIORITY_CLASSES = {"bulk": PRIORITY_BULK, "interactive": PRIORITY_INTERACTIVE}
+
+# Job không có course_id dùng chung 1 hàng đợi
+DEFAULT_QUEUE = "_default"
+
+
+def parse_course_weights(raw_weights: Optional[str]) -> Dict[str, float]:
+    """
+    Đọc cấu hình SCHEDULER_COURSE_WEIGHTS dạng "CS101=3,MATH2=0.5".
+    Khóa học không có trong cấu hình dùng SCHEDULER_DEFAULT_WEIGHT.
+    """
+    weights = {}
+    if not raw_weights:
+        return weights
+    for item in raw_weights.split(","):
+        course_id, sep, weight = item.strip().rpartition("=")
+        if not sep or not course_id.strip():
+            continue
+        try:
+            weights[course_id.strip()] = max(float(weight), 0.01)
+        except ValueError:
+            logger.warning(f"⚠️ [Scheduler] Bỏ qua trọng số không hợp lệ: {item}")
+    return weights
+
+
+class DeficitRoundRobin:
+    """
+    Deficit Round-Robin giữa các hàng đợi (mỗi course_id 1 hàng đợi):
+    - Mỗi lượt ghé 1 hàng đợi -> cộng quantum * weight vào "deficit" của nó.
+    - Hàng đợi được phục vụ khi deficit >= chi phí job đầu hàng.
+    - Hàng đợi rỗng -> deficit về 0 (không tích lũy quyền khi không có việc).
+    Kết quả: mỗi khóa học nhận phần xử lý tỉ lệ với trọng số, bất kể số job đang chờ.
+    """
+
+    def __init__(self, weight_of: Callable[[str], float], quantum: float = 1.0):
+        self.weight_of = weight_of
+        self.quantum = quantum
+        self._ring: List[str] = []
+        self._cursor = 0
+        self._deficit: Dict[str, float] = {}
+
+    def _sync(self, active: List[str]):
+        active_set = set(active)
+        for queue in list(self._ring):
+            if queue not in active_set:
+                index = self._ring.index(queue)
+                self._ring.pop(index)
+                self._deficit.pop(queue, None)
+                if index < self._cursor:
+                    self._cursor -= 1
+        for queue in active:
+            if queue not in self._deficit:
+                # Hàng đợi mới vào cuối vòng, nhận quantum khi tới lượt (không phải chờ backlog của khóa khác)
+                self._ring.append(queue)
+                self._deficit[queue] = 0.0
+        if self._ring:
+            self._cursor %= len(self._ring)
+        else:
+            self._cursor = 0
+
+    def pick(self, active: List[str], cost_of: Optional[Callable[[str], float]] = None) -> Optional[str]:
+        self._sync(active)
+        if not self._ring:
+            return None
+        cost_of = cost_of or (lambda queue: 1.0)
+
+        while True:
+            queue = self._ring[self._cursor]
+            cost = cost_of(queue)
+            if self._deficit[queue] >= cost:
+                self._deficit[queue] -= cost
+                return queue
+            # Hết lượt -> sang hàng đợi kế tiếp và cộng quantum cho nó
+            self._cursor = (self._cursor + 1) % len(self._ring)
+            next_queue = self._ring[self._cursor]
+            self._deficit[next_queue] += self.quantum * self.weight_of(next_queue)
+
+
+class FairScheduler:
+    """
+    Chọn hàng đợi cho worker tiếp theo:
+    1. Ưu tiên tuyệt đối theo lớp (interactive > bulk).
+    2. Trong cùng lớp: DRR theo course_id với trọng số cấu hình được.
+    """
+
+    def __init__(self, weights: Dict[str, float], default_weight: float = 1.0):
+        self.weights = weights
+        self.default_weight = default_weight
+        self._drr: Dict[int, DeficitRoundRobin] = {}
+
+    @classmethod
+    def from_settings(cls) -> "FairScheduler":
+        return cls(
+            weights=parse_course_weights(settings.SCHEDULER_COURSE_WEIGHTS),
+            default_weight=settings.SCHEDULER_DEFAULT_WEIGHT,
+        )
+
+    def weight_of(self, queue: str) -> float:
+        return self.weights.get(queue, self.default_weight)
+
+    def choose(self, queued: List[Dict[str, Any]]) -> Optional[Tuple[int, Optional[str]]]:
+        """
+        queued: thống kê hàng đợi từ JobStore.queued_summary() (priority, course_id, depth, ...).
+        Trả về (priority, course_id) của hàng đợi được phục vụ, hoặc None nếu không còn job.
+        """
+        waiting = [q for q in queued if q["depth"] > 0]
+        if not waiting:
+            return None
+        priority = max(q["priority"] for q in waiting)
+        courses = [q["course_id"] for q in waiting if q["priority"] == priority]
+
+        drr = self._drr.get(priority)
+        if drr is None:
+            drr = self._drr[priority] = DeficitRoundRobin(self.weight_of)
+        queue = drr.pick([course or DEFAULT_QUEUE for course in courses])
+        return priority, (None if queue == DEFAULT_QUEUE else queue)
+
+# Khởi tạo singleton
+fair_scheduler = FairScheduler.from_settings()
@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Any
+from fastapi.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.core.metrics import metrics
+from app.services.ollama_pool import ollama_pool
+
+logger = logging.getLogger("slot_pool")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Tiến trình tồn tại nhưng thuộc user khác
+        return True
+    return True
+
+
+class SharedSlotPool:
+    """
+    Giới hạn concurrency dùng chung giữa nhiều tiến trình (uvicorn/gunicorn nhiều worker),
+    lưu trong SQLite cùng file với hàng đợi job:
+    - Mỗi slot đang dùng là 1 dòng (pool, slot) -> tổng số request LLM đồng thời không vượt capacity
+      dù chạy bao nhiêu tiến trình.
+    - Slot có lease, được gia hạn khi còn giữ; tiến trình chết -> slot được thu hồi khi lease hết hạn,
+      hoặc ngay lập tức nếu cùng máy và PID không còn tồn tại.
+    Không có thông báo liên tiến trình nên bên chờ thăm dò lại theo backoff ngắn.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        capacity: int,
+        name: str = "ollama",
+        lease_seconds: float = 60.0,
+        poll_interval: float = 0.25,
+        enabled: bool = True,
+    ):
+        self.db_path = db_path
+        self.capacity = max(1, capacity)
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.enabled = enabled
+        self.hostname = socket.gethostname()
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_slots ("
+                " pool TEXT NOT NULL,"
+                " slot INTEGER NOT NULL,"
+                " owner TEXT NOT NULL,"
+                " hostname TEXT NOT NULL,"
+                " pid INTEGER NOT NULL,"
+                " acquired_at REAL NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (pool, slot))"
+            )
+            self._conn = conn
+        return self._conn
+
+    def _reclaim(self, conn: sqlite3.Connection, now: float) -> int:
+        """Xóa slot hết lease hoặc của tiến trình đã chết trên cùng máy. Gọi trong transaction."""
+        reclaimed = conn.execute(
+            "DELETE FROM llm_slots WHERE pool = ? AND expires_at < ?", (self.name, now)
+        ).rowcount
+        rows = conn.execute(
+            "SELECT slot, pid FROM llm_slots WHERE pool = ? AND hostname = ? AND pid != ?",
+            (self.name, self.hostname, self.pid),
+        ).fetchall()
+        for row in rows:
+            if not _pid_alive(row["pid"]):
+                conn.execute("DELETE FROM llm_slots WHERE pool = ? AND slot = ?", (self.name, row["slot"]))
+                reclaimed += 1
+        if reclaimed:
+            logger.warning(f"♻️ [Slots:{self.name}] Thu hồi {reclaimed} slot bị bỏ rơi")
+            metrics.inc("llm_slots_reclaimed_total", reclaimed, pool=self.name)
+        return reclaimed
+
+    def try_acquire(self, owner: str) -> Optional[int]:
+        """Lấy 1 slot trống (số nhỏ nhất < capacity). Hết slot -> None."""
+        now = time.time()
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._reclaim(conn, now)
+                used = {
+                    row["slot"]
+                    for row in conn.execute("SELECT slot FROM llm_slots WHERE pool = ?", (self.name,))
+                }
+                free = next((slot for slot in range(self.capacity) if slot not in used), None)
+                if free is not None:
+                    conn.execute(
+                        "INSERT INTO llm_slots (pool, slot, owner, hostname, pid, acquired_at, expires_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (self.name, free, owner, self.hostname, self.pid, now, now + self.lease_seconds),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return free
+
+    def renew(self, slot: int, owner: str) -> bool:
+        with self._lock:
+            cursor = self._get_conn().execute(
+                "UPDATE llm_slots SET expires_at = ? WHERE pool = ? AND slot = ? AND owner = ?",
+                (time.time() + self.lease_seconds, self.name, slot, owner),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, slot: int, owner: str):
+        with self._lock:
+            self._get_conn().execute(
+                "DELETE FROM llm_slots WHERE pool = ? AND slot = ? AND owner = ?", (self.name, slot, owner)
+            )
+
+    def reclaim(self) -> int:
+        """Thu hồi slot bị bỏ rơi (gọi lúc khởi động, trước khi worker chạy)."""
+        if not self.enabled:
+            return 0
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                reclaimed = self._reclaim(conn, time.time())
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return reclaimed
+
+    def in_use(self) -> int:
+        with self._lock:
+            row = self._get_conn().execute(
+                "SELECT COUNT(*) AS n FROM llm_slots WHERE pool = ? AND expires_at >= ?", (self.name, time.time())
+            ).fetchone()
+        return row["n"]
+
+    async def _renew_loop(self, slot: int, owner: str):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            if not await run_in_threadpool(self.renew, slot, owner):
+                logger.warning(f"⚠️ [Slots:{self.name}] Slot {slot} đã bị thu hồi khi đang dùng")
+                return
+
+    async def _release_when_acquired(self, acquire: "asyncio.Future", owner: str):
+        try:
+            slot = await acquire
+        except Exception:
+            return
+        if slot is not None:
+            await run_in_threadpool(self.release, slot, owner)
+
+    @asynccontextmanager
+    async def slot(self):
+        """async with pool.slot(): ... - chờ tới khi còn slot trống trên toàn bộ các tiến trình."""
+        if not self.enabled:
+            yield
+            return
+
+        owner = f"{self.hostname}:{self.pid}:{uuid.uuid4().hex}"
+        started_at = time.perf_counter()
+        delay = 0.01
+        while True:
+            acquire = asyncio.ensure_future(run_in_threadpool(self.try_acquire, owner))
+            try:
+                slot = await asyncio.shield(acquire)
+            except asyncio.CancelledError:
+                # Job bị hủy trong lúc thread vẫn đang INSERT: chờ thread xong rồi trả slot,
+                # không để slot bị giữ tới hết lease (PID còn sống nên _reclaim không thu hồi sớm)
+                await asyncio.shield(self._release_when_acquired(acquire, owner))
+                raise
+            if slot is not None:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.poll_interval)
+        metrics.observe("llm_slot_wait_seconds", time.perf_counter() - started_at, pool=self.name)
+
+        renewer = asyncio.create_task(self._renew_loop(slot, owner))
+        try:
+            yield
+        finally:
+            renewer.cancel()
+            # shield: job bị hủy lần nữa trong lúc trả slot vẫn không làm rò slot
+            await asyncio.shield(run_in_threadpool(self.release, slot, owner))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "name": self.name,
+            "capacity": self.capacity,
+            "in_use": self.in_use() if self.enabled else None,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @classmethod
+    def from_settings(cls) -> "SharedSlotPool":
+        return cls(
+            db_path=settings.JOB_DB_PATH,
+            capacity=settings.LLM_GLOBAL_CONCURRENCY or ollama_pool.total_capacity,
+            lease_seconds=settings.LLM_SLOT_LEASE_SECONDS,
+            poll_interval=settings.LLM_SLOT_POLL_INTERVAL,
+            enabled=settings.LLM_GLOBAL_SLOTS_ENABLED,
+        )
+
+# Khởi tạo singleton
+llm_slot_pool = SharedSlotPool.from_settings()
@@ -1,116 +1,615 @@
-import httpx
 import logging
 import asyncio
+import os
+import socket
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Callable, Any, Dict
+from typing import Callable, Any, Awaitable, Dict, Optional, List
+from fastapi.concurrency import run_in_threadpool
 from app.core.config import settings
+from app.core.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.core.concurrency import adaptive_limiter
+from app.core.slot_pool import llm_slot_pool
+from app.core.job_store import job_store, JobStore, STATUS_QUEUED, STATUS_RUNNING
+from app.core.job_events import job_events, current_job_id
+from app.core.metrics import metrics
+from app.core.webhook_dispatcher import webhook_dispatcher
+from app.core.scheduler import fair_scheduler, FairScheduler, PRIORITY_BULK, DEFAULT_QUEUE
 from app.schemas.grading import GradingResponse, WebhookPayload
 
 # Setup Logger
 logger = logging.getLogger("task_runner")
 
-# Giới hạn số lượng task chạy đồng thời
-global_semaphore = asyncio.Semaphore(settings.MAX_CONCURRENT_REQUESTS)
+
+
+@dataclass
+class JobHandler:
+    """Cách xử lý 1 loại job (vd: "grading")."""
+    processing_function: Callable[[Dict[str, Any]], Any]  # Bắt buộc trả về GradingResponse
+    cache_lookup: Optional[Callable[[Dict[str, Any]], Optional[GradingResponse]]] = None
+    circuit_breaker: Optional[CircuitBreaker] = None
+    # Hash nội dung đầu vào: job trùng nội dung với job đang chạy sẽ dùng chung kết quả
+    fingerprint: Optional[Callable[[Dict[str, Any]], str]] = None
+    # Ước lượng số token đầu vào (kích thước job) cho lịch SJF
+    estimate_tokens: Optional[Callable[[Dict[str, Any]], int]] = None
+    # Tiền xử lý trong worker trước khi gọi LLM (parse file, vệ sinh, kiểm tra); ValueError -> job lỗi
+    prepare: Optional[Callable[[Dict[str, Any], str], Awaitable[Dict[str, Any]]]] = None
+    # Tiền xử lý ngữ cảnh dùng chung của batch (parse file đề / đáp án): chạy 1 lần, kết quả lưu lại
+    prepare_context: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
+
 
 class TaskRunner:
     """
     Class chịu trách nhiệm điều phối:
-    1. Kiểm soát concurrency (Semaphore).
-    2. Gọi hàm xử lý (Business Logic).
-    3. Đóng gói kết quả chuẩn Schema.
-    4. Gửi Webhook (kèm cơ chế Retry).
+    1. Nhận job vào hàng đợi bền vững (JobStore) - endpoint chỉ enqueue rồi trả về.
+    2. Worker pool cố định lấy job (lease + heartbeat), khôi phục job của worker đã chết.
+       Thứ tự lấy job: interactive trước bulk, chia đều giữa các course_id (DRR theo trọng số),
+       trong 1 hàng đợi: FIFO hoặc job ít token nhất trước (SJF + aging).
+    3. Tiền xử lý đầu vào (parse file đính kèm...) ngay trong worker, ngoài slot LLM
+       -> chạy song song với bước suy luận của các job khác.
+       Kiểm soát concurrency (AdaptiveLimiter), "đỗ" job khi backend bị ngắt mạch.
+    4. Gọi hàm xử lý (Business Logic), đóng gói kết quả chuẩn Schema.
+    5. Chuyển kết quả cho WebhookDispatcher (gửi + retry + dead-letter).
+    6. Idempotent: request_id trùng không chạy lại, job trùng nội dung dùng chung 1 lần chấm.
+    7. Chấm hàng loạt: job chỉ lưu "context_id" + phần riêng của sinh viên, ngữ cảnh bài tập
+       dùng chung được ghép vào khi xử lý; callback gửi riêng từng job hoặc gom theo batch.
     """
 
-    async def run_task_and_callback(
+    def __init__(self, store: JobStore, scheduler: FairScheduler):
+        self.store = store
+        self.scheduler = scheduler
+        self.handlers: Dict[str, JobHandler] = {}
+        self.worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+        self._workers: List[asyncio.Task] = []
+        self._reaper_task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._schedule_lock: Optional[asyncio.Lock] = None
+        # Task đang chạy của từng job (để hủy ngay khi có yêu cầu cancel)
+        self._running: Dict[str, asyncio.Task] = {}
+        self._aborted: set = set()
+        # Ngữ cảnh bài tập dùng chung (bất biến) vừa dùng, tránh đọc lại SQLite cho mỗi sinh viên
+        self._contexts: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._prepared_contexts: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Mỗi ngữ cảnh chỉ 1 worker parse, các worker khác cùng batch chờ kết quả
+        self._context_locks: Dict[str, asyncio.Lock] = {}
+        # EWMA thời gian xử lý 1 job khi đã có slot (ước lượng thời gian chờ cho backpressure)
+        self._service_seconds: Optional[float] = None
+        self._last_purge_at = 0.0
+
+    @property
+    def worker_count(self) -> int:
+        # Mặc định gấp đôi trần concurrency: slot LLM không trống trong lúc worker khác đang lease / lưu kết quả
+        return settings.JOB_WORKER_COUNT or 2 * adaptive_limiter.max_limit
+
+    def register_handler(
         self,
-        processing_function: Callable[[Any], GradingResponse], # Hàm này bắt buộc trả về GradingResponse
-        input_data: Dict[str, Any],
-        callback_url: str,
-        request_id: str
+        kind: str,
+        processing_function: Callable[[Dict[str, Any]], Any],
+        cache_lookup: Optional[Callable[[Dict[str, Any]], Optional[GradingResponse]]] = None,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        fingerprint: Optional[Callable[[Dict[str, Any]], str]] = None,
+        estimate_tokens: Optional[Callable[[Dict[str, Any]], int]] = None,
+        prepare: Optional[Callable[[Dict[str, Any], str], Awaitable[Dict[str, Any]]]] = None,
+        prepare_context: Optional[Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]]] = None
     ):
-        # return True
-        logger.info(f"⏳ [Queue] Request {request_id} đang chờ slot xử lý...")
-        
-        async with global_semaphore:
-            logger.info(f"▶️ [Start] Bắt đầu xử lý {request_id}")
-            
+        self.handlers[kind] = JobHandler(
+            processing_function, cache_lookup, circuit_breaker, fingerprint, estimate_tokens, prepare, prepare_context
+        )
+
+    def _get_wakeup(self) -> asyncio.Event:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def resolve_input(self, input_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Ghép ngữ cảnh bài tập dùng chung (nếu job tham chiếu "context_id") với phần riêng của job.
+        Phần riêng được ưu tiên khi trùng khóa.
+        """
+        context_id = input_data.get("context_id")
+        if not context_id:
+            return input_data
+        context = self._contexts.get(context_id)
+        if context is None:
+            context = self.store.get_context(context_id)
+            if context is None:
+                raise ValueError(f"Unknown assignment context: {context_id}")
+            self._contexts[context_id] = context
+            if len(self._contexts) > 64:
+                self._contexts.popitem(last=False)
+        else:
+            self._contexts.move_to_end(context_id)
+        return {**context, **input_data}
+
+    def _remember_prepared(self, context_id: str, prepared: Dict[str, Any]):
+        self._prepared_contexts[context_id] = prepared
+        self._prepared_contexts.move_to_end(context_id)
+        if len(self._prepared_contexts) > 64:
+            self._prepared_contexts.popitem(last=False)
+
+    async def _resolve_prepared_input(self, handler: JobHandler, input_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Như resolve_input nhưng ngữ cảnh dùng chung đã qua handler.prepare_context: job đầu tiên của batch
+        parse file đề / đáp án rồi lưu vào SQLite, các job sau (kể cả ở tiến trình khác) dùng lại.
+        """
+        context_id = input_data.get("context_id")
+        if not context_id or handler.prepare_context is None:
+            return await run_in_threadpool(self.resolve_input, input_data)
+
+        prepared = self._prepared_contexts.get(context_id)
+        if prepared is None:
+            lock = self._context_locks.setdefault(context_id, asyncio.Lock())
             try:
-                # 1. Thực thi Logic chính (AI Grading)
-                # Lưu ý: Hàm processing_function phải trả về object GradingResponse
-                result: GradingResponse = await processing_function(input_data)
-                
-                # 2. Kiểm tra kết quả logic
-                if result.error:
-                    status = "error"
-                    logger.warning(f"⚠️ [Logic Error] {request_id}: {result.error}")
-                else:
-                    status = "success"
-                    logger.info(f"✅ [Success] {request_id} - Score: {result.score}")
-
-                # 3. Đóng gói Payload thành công
-                payload = WebhookPayload(
-                    request_id=request_id,
-                    status=status,
-                    timestamp=datetime.utcnow().isoformat(),
-                    data=result
+                async with lock:
+                    prepared = self._prepared_contexts.get(context_id)
+                    if prepared is None:
+                        prepared = await run_in_threadpool(self.store.get_prepared_context, context_id)
+                    if prepared is None:
+                        context = await run_in_threadpool(self.store.get_context, context_id)
+                        if context is None:
+                            raise ValueError(f"Unknown assignment context: {context_id}")
+                        job_events.stage("preparing_context")
+                        prepared = await handler.prepare_context(context)
+                        await run_in_threadpool(self.store.save_prepared_context, context_id, prepared)
+                        metrics.inc("assignment_contexts_prepared_total")
+                    self._remember_prepared(context_id, prepared)
+            finally:
+                if not lock.locked():
+                    self._context_locks.pop(context_id, None)
+        else:
+            self._prepared_contexts.move_to_end(context_id)
+        return {**prepared, **input_data}
+
+    async def enqueue(
+        self,
+        kind: str,
+        input_data: Dict[str, Any],
+        callback_url: str,
+        request_id: str,
+        course_id: Optional[str] = None,
+        priority: int = PRIORITY_BULK,
+        batch_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        handler = self.handlers.get(kind)
+        if handler is None:
+            raise ValueError(f"Unknown job kind: {kind}")
+        # Hash + ước lượng token tính trên đầu vào đầy đủ, nhưng chỉ lưu phần riêng của job
+        full_input = await run_in_threadpool(self.resolve_input, input_data)
+        content_hash = None
+        if settings.JOB_COALESCE_IDENTICAL and handler.fingerprint is not None:
+            content_hash = handler.fingerprint(full_input)
+        estimated_tokens = None
+        if handler.estimate_tokens is not None:
+            # Đếm token là việc CPU -> chạy ngoài event loop
+            estimated_tokens = await run_in_threadpool(handler.estimate_tokens, full_input)
+
+        job = await run_in_threadpool(
+            self.store.enqueue, request_id, kind, input_data, callback_url, course_id, priority,
+            content_hash, settings.JOB_IDEMPOTENCY_RETENTION_SECONDS, estimated_tokens, batch_id
+        )
+        admission = job["admission"]
+        metrics.inc("jobs_enqueued_total", kind=kind, admission=admission)
+        if admission == "queued":
+            logger.info(f"📥 [Enqueue] {request_id} ({kind}) -> queued")
+            job_events.publish(request_id, "stage", stage="queued")
+            self._get_wakeup().set()
+        elif admission == "coalesced":
+            logger.info(f"🔗 [Coalesced] {request_id} dùng chung kết quả với {job['coalesced_into']}")
+            job_events.publish(request_id, "stage", stage="coalesced", coalesced_into=job["coalesced_into"])
+        else:
+            logger.info(f"♊ [Duplicate] {request_id} đã tồn tại ({job['status']}), không tạo job mới")
+        return job
+
+    async def start(self):
+        if self._workers:
+            return
+        # Job của tiến trình trước (crash / deploy) có lease hết hạn -> đưa lại hàng đợi
+        await self._recover_expired()
+        # Slot LLM dùng chung bị tiến trình đã chết giữ lại
+        await run_in_threadpool(llm_slot_pool.reclaim)
+        self._workers = [
+            asyncio.create_task(self._worker_loop(f"{self.worker_prefix}-{index}"))
+            for index in range(self.worker_count)
+        ]
+        self._reaper_task = asyncio.create_task(self._reaper_loop())
+        logger.info(f"👷 [Workers] Đã khởi động {self.worker_count} worker")
+
+    async def stop(self):
+        tasks = self._workers + ([self._reaper_task] if self._reaper_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._reaper_task = None
+
+    async def _lease_next(self, worker_id: str) -> Optional[Dict[str, Any]]:
+        shortest_first = settings.SCHEDULER_POLICY == "sjf"
+        aging = settings.SCHEDULER_SJF_AGING_TOKENS_PER_SECOND
+        if not settings.SCHEDULER_FAIR_SHARE:
+            return await run_in_threadpool(
+                self.store.lease_next, worker_id, settings.JOB_LEASE_SECONDS, None, None, True, shortest_first, aging
+            )
+
+        if self._schedule_lock is None:
+            self._schedule_lock = asyncio.Lock()
+        # Chọn hàng đợi + lease trong cùng 1 lock để trạng thái DRR nhất quán giữa các worker
+        async with self._schedule_lock:
+            for _ in range(3):
+                queued = await run_in_threadpool(self.store.queued_summary)
+                choice = self.scheduler.choose(queued)
+                if choice is None:
+                    return None
+                priority, course_id = choice
+                job = await run_in_threadpool(
+                    self.store.lease_next, worker_id, settings.JOB_LEASE_SECONDS, course_id, priority, False,
+                    shortest_first, aging
                 )
+                # None: tiến trình khác vừa lấy mất job cuối của hàng đợi này -> chọn lại
+                if job is not None:
+                    return job
+            return None
+
+    async def _worker_loop(self, worker_id: str):
+        wakeup = self._get_wakeup()
+        while True:
+            job = await self._lease_next(worker_id)
+            if job is None:
+                wakeup.clear()
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=settings.JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
 
+            try:
+                await self._run_job(job, worker_id)
+            except asyncio.CancelledError:
+                # Shutdown giữa chừng -> trả job về hàng đợi cho lần khởi động sau
+                await run_in_threadpool(self.store.requeue, job["request_id"], worker_id)
+                raise
             except Exception as e:
-                # 4. Xử lý lỗi hệ thống (Crash code, AI service down, v.v.)
-                logger.error(f"❌ [System Error] {request_id}: {str(e)}", exc_info=True)
-                
-                # Tạo payload báo lỗi hệ thống
-                payload = WebhookPayload(
-                    request_id=request_id,
-                    status="error",
-                    timestamp=datetime.utcnow().isoformat(),
-                    data=None,
-                    system_error=f"Internal Server Error: {str(e)}"
+                logger.error(f"❌ [Worker Error] {job['request_id']}: {e}", exc_info=True)
+
+    async def _heartbeat_loop(self, request_id: str, worker_id: str, execution: asyncio.Task):
+        while True:
+            await asyncio.sleep(settings.JOB_HEARTBEAT_INTERVAL)
+            alive = await run_in_threadpool(self.store.heartbeat, request_id, worker_id, settings.JOB_LEASE_SECONDS)
+            if not alive:
+                # Job bị hủy (có thể từ tiến trình khác) hoặc lease đã chuyển cho worker khác -> dừng xử lý
+                logger.warning(f"⚠️ [Lease Lost] {request_id} không còn thuộc worker {worker_id}, dừng xử lý")
+                self._aborted.add(request_id)
+                execution.cancel()
+                return
+
+    async def cancel(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Hủy job (queued / coalesced / running). Job đang chạy trong tiến trình này bị dừng ngay,
+        kéo theo đóng request Ollama đang stream -> giải phóng slot LLM.
+        """
+        job = await run_in_threadpool(self.store.cancel, request_id)
+        if job is None or not job["cancelled"]:
+            return job
+
+        metrics.inc("jobs_cancelled_total", previous_status=job["previous_status"])
+        logger.info(f"🛑 [Cancel] {request_id} ({job['previous_status']}) đã bị hủy")
+        execution = self._running.get(request_id)
+        if execution is not None:
+            self._aborted.add(request_id)
+            execution.cancel()
+        job_events.publish(request_id, "cancelled", previous_status=job["previous_status"])
+        # Job hủy có thể là job cuối của batch -> gửi nốt kết quả đã có
+        await self._notify_batch(job["batch_id"])
+        # Job gộp được đưa lên thay thế -> đánh thức worker
+        self._get_wakeup().set()
+        return job
+
+    async def _run_job(self, job: Dict[str, Any], worker_id: str):
+        request_id = job["request_id"]
+        metrics.observe(
+            "job_queue_wait_seconds",
+            max(job["started_at"] - job["created_at"], 0.0),
+            kind=job["kind"],
+            course_id=job["course_id"] or DEFAULT_QUEUE,
+            priority=job["priority"]
+        )
+        job_events.publish(request_id, "stage", stage="running", attempt=job["attempts"])
+
+        handler = self.handlers.get(job["kind"])
+        if handler is None:
+            payload = self._error_payload(request_id, f"Unknown job kind: {job['kind']}")
+        else:
+            # Chạy trong task riêng (mang theo current_job_id) để có thể hủy job mà không hủy worker
+            context_token = current_job_id.set(request_id)
+            execution = asyncio.create_task(self._execute(handler, job["input_data"], request_id))
+            current_job_id.reset(context_token)
+            self._running[request_id] = execution
+            heartbeat = asyncio.create_task(self._heartbeat_loop(request_id, worker_id, execution))
+            started_at = time.perf_counter()
+            try:
+                payload = await execution
+            except asyncio.CancelledError:
+                if request_id not in self._aborted:
+                    raise
+                # Bị hủy qua API / mất lease: không lưu kết quả, không gửi webhook
+                logger.info(f"🛑 [Aborted] Đã dừng xử lý {request_id}")
+                return
+            finally:
+                heartbeat.cancel()
+                self._running.pop(request_id, None)
+                self._aborted.discard(request_id)
+            metrics.observe("job_run_seconds", time.perf_counter() - started_at, kind=job["kind"])
+
+        metrics.inc("jobs_finished_total", kind=job["kind"], status=payload.status)
+        await self._settle(job, payload)
+
+    async def _settle(self, job: Dict[str, Any], payload: WebhookPayload):
+        """
+        Lưu kết quả của job (và các job đã gộp vào nó) rồi chuyển webhook cho dispatcher.
+        Lưu job chính trước: job trùng nội dung tới sau đó sẽ không còn gộp vào job đã xong.
+        """
+        targets = [(job, payload)]
+        for index, (target, target_payload) in enumerate(targets):
+            # Lưu kết quả trước khi gửi webhook: webhook lỗi không làm mất kết quả chấm
+            if target_payload.status == "success":
+                saved = await run_in_threadpool(self.store.complete, target["request_id"], target_payload.model_dump())
+            else:
+                error = target_payload.system_error or (target_payload.data.error if target_payload.data else None) or "unknown error"
+                saved = await run_in_threadpool(self.store.fail, target["request_id"], error, target_payload.model_dump())
+            if not saved:
+                # Job đã bị hủy trong lúc đang hoàn tất -> bỏ kết quả
+                continue
+            job_events.publish(
+                target["request_id"],
+                "done" if target_payload.status == "success" else "failed",
+                result=target_payload.model_dump()
+            )
+
+            if index == 0:
+                followers = await run_in_threadpool(self.store.followers_of, job["request_id"])
+                targets.extend(
+                    (follower, payload.model_copy(update={"request_id": follower["request_id"]}))
+                    for follower in followers
                 )
 
-        # 5. Gửi Webhook (Nằm ngoài Semaphore để giải phóng slot xử lý sớm)
-        await self._send_webhook_with_retry(callback_url, payload)
+            # Gửi Webhook qua hàng đợi riêng: worker không phải chờ Moodle
+            if not await self._notify_batch(target.get("batch_id")):
+                await webhook_dispatcher.submit(target["callback_url"], target_payload.model_dump(), target["request_id"])
+
+    async def seal_batch(self, batch_id: str):
+        """Gọi sau khi enqueue xong toàn bộ job của batch (job xong sớm có thể đang chờ gửi nốt)."""
+        await run_in_threadpool(self.store.seal_batch, batch_id)
+        await self._notify_batch(batch_id)
 
-    async def _send_webhook_with_retry(self, url: str, payload: WebhookPayload, max_retries: int = 3):
+    async def _notify_batch(self, batch_id: Optional[str]) -> bool:
         """
-        Gửi webhook với cơ chế thử lại (Retry) nếu thất bại.
+        Batch gom callback: gửi 1 webhook cho mỗi callback_batch_size kết quả (và phần còn lại khi batch xong).
+        Trả về False nếu job không thuộc batch gom callback (gửi webhook riêng như bình thường).
         """
-        headers = {
-            "Content-Type": "application/json",
-            "User-Agent": "FastAPI-Grader/1.0"
-        }
-        
-        # Thêm bảo mật Bearer Token nếu có cấu hình
-        if settings.SHARED_SECRET_KEY:
-            headers["Authorization"] = f"Bearer {settings.SHARED_SECRET_KEY}"
+        if not batch_id:
+            return False
+        batch = await run_in_threadpool(self.store.get_batch, batch_id)
+        if batch is None or not batch["callback_batch_size"]:
+            return False
+
+        jobs, remaining = await run_in_threadpool(
+            self.store.collect_batch_results, batch_id, batch["callback_batch_size"]
+        )
+        if jobs:
+            logger.info(f"📦 [Batch] {batch_id}: gửi {len(jobs)} kết quả, còn {remaining} job")
+            await webhook_dispatcher.submit(batch["callback_url"], {
+                "batch_id": batch_id,
+                "status": "complete" if remaining == 0 else "partial",
+                "timestamp": datetime.utcnow().isoformat(),
+                "total": batch["total"],
+                "remaining": remaining,
+                "results": [job["result"] for job in jobs],
+            }, batch_id)
+        return True
+
+    @staticmethod
+    def _error_payload(request_id: str, system_error: str) -> WebhookPayload:
+        return WebhookPayload(
+            request_id=request_id,
+            status="error",
+            timestamp=datetime.utcnow().isoformat(),
+            data=None,
+            system_error=system_error
+        )
 
-        print("Secret key ", settings.SHARED_SECRET_KEY[:5])
+    async def _execute(self, handler: JobHandler, input_data: Dict[str, Any], request_id: str) -> WebhookPayload:
+        circuit_breaker = handler.circuit_breaker
+        try:
+            input_data = await self._resolve_prepared_input(handler, input_data)
+            if handler.prepare is not None:
+                job_events.stage("preparing")
+                prepare_started_at = time.perf_counter()
+                input_data = await handler.prepare(input_data, request_id)
+                metrics.observe("job_prepare_seconds", time.perf_counter() - prepare_started_at)
+        except ValueError as e:
+            # Đầu vào không hợp lệ (thiếu nội dung, ngữ cảnh không tồn tại...)
+            logger.warning(f"⚠️ [Invalid Input] {request_id}: {e}")
+            return self._error_payload(request_id, str(e))
+        except Exception as e:
+            logger.error(f"❌ [Prepare Error] {request_id}: {str(e)}", exc_info=True)
+            return self._error_payload(request_id, f"Internal Server Error: {str(e)}")
 
-        # Chuyển Pydantic model sang Dict
-        json_body = payload.model_dump()
+        # 0. Cache hit -> bỏ qua hàng đợi + LLM
+        if handler.cache_lookup is not None:
+            # Tra cứu SQLite đồng bộ -> chạy trong thread pool như mọi truy cập store khác
+            cached_result = await run_in_threadpool(handler.cache_lookup, input_data)
+            if cached_result is not None:
+                logger.info(f"⚡ [Cache Hit] {request_id} - Score: {cached_result.score}")
+                job_events.stage("cache_hit")
+                return WebhookPayload(
+                    request_id=request_id,
+                    status="success",
+                    timestamp=datetime.utcnow().isoformat(),
+                    data=cached_result
+                )
+
+        logger.info(f"⏳ [Queue] Request {request_id} đang chờ slot xử lý...")
+
+        while True:
+            # Ollama đang bị ngắt mạch -> "đỗ" job ở đây, không chiếm slot xử lý
+            if circuit_breaker is not None and settings.CIRCUIT_BREAKER_PARK_JOBS:
+                if not circuit_breaker.is_available:
+                    job_events.stage("parked")
+                await circuit_breaker.wait_until_available()
+
+            # Giới hạn concurrency tự điều chỉnh theo sức khỏe Ollama (AIMD) trong tiến trình,
+            # sau đó slot dùng chung giữa các tiến trình (nếu bật)
+            async with adaptive_limiter.slot(), llm_slot_pool.slot():
+                logger.info(f"▶️ [Start] Bắt đầu xử lý {request_id}")
+                job_events.stage("processing")
 
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            for attempt in range(1, max_retries + 1):
                 try:
-                    logger.info(f"🚀 [Callback] Gửi tới {url} (Lần {attempt})")
-                    response = await client.post(url, json=json_body, headers=headers)
-                    
-                    # Nếu status code là 2xx (200, 201, 202...)
-                    if response.is_success:
-                        logger.info(f"✅ [Callback Done] Webhook nhận thành công: {response.status_code}")
-                        return
+                    # 1. Thực thi Logic chính (AI Grading)
+                    # Lưu ý: Hàm processing_function phải trả về object GradingResponse
+                    service_started_at = time.perf_counter()
+                    result: GradingResponse = await handler.processing_function(input_data)
+                    self._record_service_time(time.perf_counter() - service_started_at)
+
+                    # 2. Kiểm tra kết quả logic
+                    if result.error:
+                        status = "error"
+                        logger.warning(f"⚠️ [Logic Error] {request_id}: {result.error}")
                     else:
-                        logger.warning(f"⚠️ [Callback Fail] Server trả về {response.status_code}. Thử lại...")
+                        status = "success"
+                        logger.info(f"✅ [Success] {request_id} - Score: {result.score}")
+
+                    # 3. Đóng gói Payload thành công
+                    return WebhookPayload(
+                        request_id=request_id,
+                        status=status,
+                        timestamp=datetime.utcnow().isoformat(),
+                        data=result
+                    )
+
+                except CircuitOpenError as e:
+                    if circuit_breaker is not None and settings.CIRCUIT_BREAKER_PARK_JOBS:
+                        # Nhả slot, quay lại chờ mạch đóng rồi chạy lại
+                        logger.warning(f"🅿️ [Parked] {request_id}: Ollama đang bị ngắt mạch, chờ thăm dò lại...")
+                        continue
 
-                except httpx.RequestError as e:
-                    logger.warning(f"⚠️ [Callback Network Error] Lỗi mạng: {e}. Thử lại...")
-                
-                # Chờ tăng dần trước khi thử lại (Exponential Backoff: 2s, 4s, 8s...)
-                if attempt < max_retries:
-                    sleep_time = 2 ** attempt
-                    await asyncio.sleep(sleep_time)
+                    logger.error(f"❌ [Circuit Open] {request_id}: {str(e)}")
+                    return self._error_payload(request_id, f"AI backend unavailable: {str(e)}")
 
-        logger.error(f"❌ [Callback GiveUp] Đã thử {max_retries} lần nhưng thất bại. Request ID: {payload.request_id}")
+                except Exception as e:
+                    # 4. Xử lý lỗi hệ thống (Crash code, AI service down, v.v.)
+                    logger.error(f"❌ [System Error] {request_id}: {str(e)}", exc_info=True)
+                    return self._error_payload(request_id, f"Internal Server Error: {str(e)}")
+
+    async def _recover_expired(self):
+        failed_jobs = await run_in_threadpool(self.store.recover_expired, settings.JOB_MAX_ATTEMPTS)
+        # Đánh thức worker nếu có job vừa được đưa lại hàng đợi
+        self._get_wakeup().set()
+        for job in failed_jobs:
+            await self._settle(job, self._error_payload(job["request_id"], f"Internal Server Error: {job['error']}"))
+
+    async def _purge_finished(self):
+        """Xóa job / batch / ngữ cảnh bài tập đã hết thời gian lưu giữ (DB không phình mãi)."""
+        now = time.time()
+        if now - self._last_purge_at < settings.JOB_RETENTION_SWEEP_INTERVAL:
+            return
+        self._last_purge_at = now
+        removed = await run_in_threadpool(self.store.purge_finished, now - settings.JOB_IDEMPOTENCY_RETENTION_SECONDS)
+        if any(removed.values()):
+            logger.info(
+                f"🧹 [Retention] Đã xóa {removed['jobs']} job, {removed['batches']} batch,"
+                f" {removed['contexts']} ngữ cảnh bài tập quá hạn"
+            )
+            metrics.inc("jobs_purged_total", removed["jobs"])
+
+    async def _reaper_loop(self):
+        while True:
+            await asyncio.sleep(settings.JOB_LEASE_SECONDS / 2)
+            try:
+                await self._recover_expired()
+            except Exception as e:
+                logger.error(f"❌ [Reaper] Lỗi khôi phục job: {e}", exc_info=True)
+            try:
+                await self._purge_finished()
+            except Exception as e:
+                logger.error(f"❌ [Retention] Lỗi xóa job quá hạn: {e}", exc_info=True)
+
+    def _record_service_time(self, seconds: float):
+        self._service_seconds = seconds if self._service_seconds is None else 0.9 * self._service_seconds + 0.1 * seconds
+
+    def queue_estimate(self) -> Dict[str, Any]:
+        """
+        Ước lượng độ sâu hàng đợi + thời gian chờ cho job mới:
+        số job đang chờ x thời gian xử lý trung bình / concurrency hiện tại.
+        """
+        counts = self.store.count_by_status()
+        queued = counts.get(STATUS_QUEUED, 0)
+        concurrency = max(adaptive_limiter.limit, 1)
+        service_seconds = self._service_seconds or settings.JOB_DEFAULT_SERVICE_SECONDS
+        return {
+            "queued": queued,
+            "running": counts.get(STATUS_RUNNING, 0),
+            "concurrency_limit": concurrency,
+            "avg_service_seconds": service_seconds,
+            "estimated_wait_seconds": queued * service_seconds / concurrency,
+            "max_queue_depth": settings.JOB_MAX_QUEUE_DEPTH,
+            "max_estimated_wait_seconds": settings.JOB_MAX_ESTIMATED_WAIT_SECONDS,
+        }
+
+    def retry_after(self, estimate: Dict[str, Any], incoming: int = 1) -> Optional[int]:
+        """
+        Hàng đợi quá tải -> số giây Moodle nên chờ trước khi gửi lại (Retry-After); còn nhận -> None.
+        incoming: số job sắp thêm (cả batch) - xét độ sâu / thời gian chờ sau khi thêm hết.
+        Thời gian chờ = thời gian để hàng đợi rút xuống dưới ngưỡng với tốc độ xử lý hiện tại.
+        """
+        per_job = estimate["avg_service_seconds"] / estimate["concurrency_limit"]
+        depth = estimate["queued"] + incoming
+        # Job cuối của batch chờ sau (incoming - 1) job cùng batch
+        estimated_wait = estimate["estimated_wait_seconds"] + (incoming - 1) * per_job
+        waits = []
+        if settings.JOB_MAX_QUEUE_DEPTH and depth > settings.JOB_MAX_QUEUE_DEPTH:
+            waits.append((depth - settings.JOB_MAX_QUEUE_DEPTH) * per_job)
+        if settings.JOB_MAX_ESTIMATED_WAIT_SECONDS and estimated_wait > settings.JOB_MAX_ESTIMATED_WAIT_SECONDS:
+            waits.append(estimated_wait - settings.JOB_MAX_ESTIMATED_WAIT_SECONDS + per_job)
+        if not waits:
+            return None
+        return int(min(max(max(waits), 1.0), settings.JOB_MAX_RETRY_AFTER_SECONDS)) + 1
+
+    async def admission_retry_after(self, request_id: str, priority: int) -> Optional[int]:
+        """
+        Kiểm soát tiếp nhận cho endpoint: trả về Retry-After nếu phải từ chối request này.
+        Không áp dụng cho job interactive và request_id đã có trong hàng đợi (Moodle gửi lại).
+        """
+        if priority != PRIORITY_BULK:
+            return None
+        if await run_in_threadpool(self.store.get, request_id) is not None:
+            return None
+        retry_after = self.retry_after(await run_in_threadpool(self.queue_estimate))
+        if retry_after is not None:
+            metrics.inc("jobs_rejected_total", reason="backpressure")
+        return retry_after
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.time()
+        queues = [
+            {
+                "course_id": q["course_id"] or DEFAULT_QUEUE,
+                "priority": q["priority"],
+                "weight": self.scheduler.weight_of(q["course_id"] or DEFAULT_QUEUE),
+                "depth": q["depth"],
+                "oldest_wait_seconds": max(now - q["oldest_created_at"], 0.0),
+            }
+            for q in self.store.queued_summary()
+        ]
+        for queue in queues:
+            metrics.set_gauge("job_queue_depth", queue["depth"], course_id=queue["course_id"], priority=queue["priority"])
+        return {
+            "workers": len(self._workers),
+            "concurrency": adaptive_limiter.snapshot(),
+            "llm_slots": llm_slot_pool.snapshot(),
+            "jobs": self.store.count_by_status(),
+            "queues": sorted(queues, key=lambda q: (-q["priority"], -q["depth"])),
+        }
 
 # Khởi tạo singleton
-task_runner = TaskRunner()
\ No newline at end of file
+task_runner = TaskRunner(job_store, fair_scheduler)
\ No newline at end of file
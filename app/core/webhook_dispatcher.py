@@ -0,0 +1,415 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Dict, Any, List
+from urllib.parse import urlsplit
+import httpx
+from fastapi.concurrency import run_in_threadpool
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger("webhook_dispatcher")
+
+
+@dataclass
+class WebhookDelivery:
+    url: str
+    payload: Dict[str, Any]
+    request_id: str
+    attempts: int = 0
+    created_at: float = field(default_factory=time.time)
+    last_error: Optional[str] = None
+    outbox_id: Optional[int] = None  # Dòng trong webhook_outbox (xóa khi gửi xong / chuyển sang dead-letter)
+
+    @property
+    def host(self) -> str:
+        parts = urlsplit(self.url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+
+class DeadLetterStore:
+    """
+    Lưu webhook trên SQLite (cùng file với hàng đợi job):
+    - webhook_outbox: webhook chưa gửi xong, ghi trước khi đưa vào hàng đợi trong RAM -> tiến trình
+      chết (crash / SIGKILL) thì lần khởi động sau gửi lại, không mất callback.
+    - webhook_dead_letters: webhook không gửi được sau khi đã thử hết số lần, lưu lại để replay thủ công
+      thay vì chỉ ghi log rồi mất.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_dead_letters ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " request_id TEXT NOT NULL,"
+                " url TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL,"
+                " last_error TEXT,"
+                " created_at REAL NOT NULL,"
+                " failed_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS webhook_outbox ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " request_id TEXT NOT NULL,"
+                " url TEXT NOT NULL,"
+                " payload TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " last_error TEXT,"
+                " owner TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    @staticmethod
+    def _insert_pending(conn: sqlite3.Connection, delivery: WebhookDelivery, owner: str):
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO webhook_outbox (request_id, url, payload, attempts, last_error, owner, created_at, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (delivery.request_id, delivery.url, json.dumps(delivery.payload, ensure_ascii=False),
+             delivery.attempts, delivery.last_error, owner, delivery.created_at, now),
+        )
+        delivery.outbox_id = cursor.lastrowid
+
+    def add_pending(self, delivery: WebhookDelivery, owner: str):
+        """Ghi webhook vào outbox (gán delivery.outbox_id)."""
+        with self._lock:
+            self._insert_pending(self._get_conn(), delivery, owner)
+
+    def touch_pending(self, delivery: WebhookDelivery):
+        """Lưu số lần đã thử: khởi động lại thì đếm tiếp, không thử lại từ đầu."""
+        with self._lock:
+            self._get_conn().execute(
+                "UPDATE webhook_outbox SET attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                (delivery.attempts, delivery.last_error, time.time(), delivery.outbox_id),
+            )
+
+    def remove_pending(self, outbox_id: int):
+        with self._lock:
+            self._get_conn().execute("DELETE FROM webhook_outbox WHERE id = ?", (outbox_id,))
+
+    def claim_pending(self, owner: str, started_at: float, stale_before: float) -> List[WebhookDelivery]:
+        """
+        Nhận lại webhook còn trong outbox: của owner này nhưng ghi trước started_at (tiến trình trước
+        cùng host:pid đã chết, VD container khởi động lại) hoặc không được cập nhật từ trước
+        stale_before (tiến trình sở hữu đã chết).
+        """
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    "SELECT * FROM webhook_outbox WHERE (owner = ? AND updated_at < ?) OR updated_at < ? ORDER BY id",
+                    (owner, started_at, stale_before),
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE webhook_outbox SET owner = ?, updated_at = ? WHERE id = ?",
+                    [(owner, time.time(), row["id"]) for row in rows],
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return [
+            WebhookDelivery(
+                url=row["url"], payload=json.loads(row["payload"]), request_id=row["request_id"],
+                attempts=row["attempts"], created_at=row["created_at"], last_error=row["last_error"], outbox_id=row["id"],
+            )
+            for row in rows
+        ]
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._get_conn().execute("SELECT COUNT(*) FROM webhook_outbox").fetchone()[0]
+
+    def add(self, delivery: WebhookDelivery):
+        """Chuyển webhook sang dead-letter (xóa khỏi outbox trong cùng transaction)."""
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT INTO webhook_dead_letters (request_id, url, payload, attempts, last_error, created_at, failed_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (delivery.request_id, delivery.url, json.dumps(delivery.payload, ensure_ascii=False),
+                     delivery.attempts, delivery.last_error, delivery.created_at, time.time()),
+                )
+                if delivery.outbox_id is not None:
+                    conn.execute("DELETE FROM webhook_outbox WHERE id = ?", (delivery.outbox_id,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        delivery.outbox_id = None
+
+    def list(self, limit: int = 100) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._get_conn().execute(
+                "SELECT id, request_id, url, attempts, last_error, created_at, failed_at"
+                " FROM webhook_dead_letters ORDER BY id LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def pop(self, owner: str, ids: Optional[List[int]] = None, limit: int = 100) -> List[WebhookDelivery]:
+        """Chuyển các bản ghi từ dead-letter về outbox để gửi lại. ids=None -> các bản ghi cũ nhất."""
+        with self._lock:
+            conn = self._get_conn()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if ids:
+                    placeholders = ",".join("?" for _ in ids)
+                    rows = conn.execute(f"SELECT * FROM webhook_dead_letters WHERE id IN ({placeholders})", ids).fetchall()
+                else:
+                    rows = conn.execute("SELECT * FROM webhook_dead_letters ORDER BY id LIMIT ?", (limit,)).fetchall()
+                deliveries = [
+                    WebhookDelivery(url=row["url"], payload=json.loads(row["payload"]), request_id=row["request_id"], created_at=row["created_at"])
+                    for row in rows
+                ]
+                if rows:
+                    placeholders = ",".join("?" for _ in rows)
+                    conn.execute(f"DELETE FROM webhook_dead_letters WHERE id IN ({placeholders})", [row["id"] for row in rows])
+                for delivery in deliveries:
+                    self._insert_pending(conn, delivery, owner)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return deliveries
+
+    def count(self) -> int:
+        with self._lock:
+            return self._get_conn().execute("SELECT COUNT(*) FROM webhook_dead_letters").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class WebhookDispatcher:
+    """
+    Gửi webhook tách khỏi worker chấm bài:
+    1. Worker chỉ submit() vào hàng đợi rồi đi lấy job tiếp theo (không chờ Moodle).
+    2. Mỗi host callback có client keep-alive riêng + giới hạn số request đang gửi.
+    3. Lỗi -> thử lại với backoff ngẫu nhiên (full jitter) mà không chiếm task gửi.
+    4. Hết số lần thử / lỗi 4xx vĩnh viễn -> ghi vào dead-letter, replay qua API.
+    5. Webhook được ghi vào outbox trước khi vào hàng đợi, xóa khi gửi xong; khởi động lại -> gửi nốt.
+    """
+
+    def __init__(self, dead_letters: DeadLetterStore):
+        self.dead_letters = dead_letters
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._started_at = time.time()
+        self._queue: Optional[asyncio.Queue] = None
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+        self._global_limit: Optional[asyncio.Semaphore] = None
+        self._dispatch_task: Optional[asyncio.Task] = None
+        self._delivery_tasks: Dict[asyncio.Task, WebhookDelivery] = {}
+        # Task đang chờ backoff -> delivery tương ứng (để không mất khi shutdown)
+        self._retry_tasks: Dict[asyncio.Task, WebhookDelivery] = {}
+
+    def _get_queue(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def _client_for(self, host: str) -> httpx.AsyncClient:
+        client = self._clients.get(host)
+        if client is None or client.is_closed:
+            limit = settings.WEBHOOK_MAX_IN_FLIGHT_PER_HOST
+            client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=limit,
+                    max_keepalive_connections=limit,
+                    keepalive_expiry=settings.HTTP_KEEPALIVE_EXPIRY,
+                ),
+                timeout=settings.WEBHOOK_TIMEOUT,
+            )
+            self._clients[host] = client
+        return client
+
+    def _host_limit(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(settings.WEBHOOK_MAX_IN_FLIGHT_PER_HOST)
+        return self._host_limits[host]
+
+    @staticmethod
+    def _headers() -> Dict[str, str]:
+        headers = {
+            "Content-Type": "application/json",
+            "User-Agent": "FastAPI-Grader/1.0"
+        }
+        # Thêm bảo mật Bearer Token nếu có cấu hình
+        if settings.SHARED_SECRET_KEY:
+            headers["Authorization"] = f"Bearer {settings.SHARED_SECRET_KEY}"
+        return headers
+
+    async def submit(self, url: str, payload: Dict[str, Any], request_id: str):
+        """Ghi webhook vào outbox rồi đưa vào hàng đợi gửi, trả về ngay (không chờ gửi)."""
+        delivery = WebhookDelivery(url=url, payload=payload, request_id=request_id)
+        await run_in_threadpool(self.dead_letters.add_pending, delivery, self.owner)
+        self._get_queue().put_nowait(delivery)
+        metrics.inc("webhook_submitted_total")
+        metrics.set_gauge("webhook_queue_depth", self._get_queue().qsize())
+
+    async def _deliver(self, delivery: WebhookDelivery):
+        delivery.attempts += 1
+        host = delivery.host
+        retryable = True
+        if self._global_limit is None:
+            self._global_limit = asyncio.Semaphore(settings.WEBHOOK_MAX_IN_FLIGHT)
+        # Chờ slot của host trước: 1 host chậm không chiếm slot gửi của các host khác
+        async with self._host_limit(host), self._global_limit:
+            try:
+                logger.info(f"🚀 [Callback] Gửi {delivery.request_id} tới {delivery.url} (Lần {delivery.attempts})")
+                response = await self._client_for(host).post(delivery.url, json=delivery.payload, headers=self._headers())
+                if response.is_success:
+                    logger.info(f"✅ [Callback Done] Webhook nhận thành công: {response.status_code}")
+                    metrics.inc("webhook_delivered_total", host=host)
+                    metrics.observe("webhook_delivery_seconds", time.time() - delivery.created_at, host=host)
+                    if delivery.outbox_id is not None:
+                        await run_in_threadpool(self.dead_letters.remove_pending, delivery.outbox_id)
+                    return
+                delivery.last_error = f"HTTP {response.status_code}"
+                # 4xx (trừ 408/429) là lỗi phía nhận, gửi lại cũng không khác
+                retryable = response.status_code >= 500 or response.status_code in (408, 429)
+                logger.warning(f"⚠️ [Callback Fail] {delivery.request_id}: Server trả về {response.status_code}")
+            except httpx.RequestError as e:
+                delivery.last_error = f"{type(e).__name__}: {e}"
+                logger.warning(f"⚠️ [Callback Network Error] {delivery.request_id}: {e}")
+
+        metrics.inc("webhook_failures_total", host=host)
+        if retryable and delivery.attempts < settings.WEBHOOK_MAX_ATTEMPTS:
+            if delivery.outbox_id is not None:
+                await run_in_threadpool(self.dead_letters.touch_pending, delivery)
+            # Full jitter: tránh cả loạt webhook cùng dội lại Moodle một lúc
+            delay = random.uniform(0, min(settings.WEBHOOK_BACKOFF_MAX, settings.WEBHOOK_BACKOFF_BASE * 2 ** delivery.attempts))
+            task = asyncio.create_task(self._retry_later(delivery, delay))
+            self._retry_tasks[task] = delivery
+            task.add_done_callback(lambda done: self._retry_tasks.pop(done, None))
+            return
+
+        await self._dead_letter(delivery)
+
+    async def _retry_later(self, delivery: WebhookDelivery, delay: float):
+        await asyncio.sleep(delay)
+        self._get_queue().put_nowait(delivery)
+
+    async def _dead_letter(self, delivery: WebhookDelivery):
+        logger.error(f"❌ [Callback GiveUp] {delivery.request_id} sau {delivery.attempts} lần: {delivery.last_error} -> dead-letter")
+        metrics.inc("webhook_dead_letters_total", host=delivery.host)
+        await run_in_threadpool(self.dead_letters.add, delivery)
+
+    async def _recover_pending(self):
+        """Webhook còn trong outbox từ lần chạy trước (crash / SIGKILL / shutdown) -> gửi lại."""
+        stale_before = time.time() - settings.WEBHOOK_OUTBOX_STALE_SECONDS
+        deliveries = await run_in_threadpool(self.dead_letters.claim_pending, self.owner, self._started_at, stale_before)
+        for delivery in deliveries:
+            self._get_queue().put_nowait(delivery)
+        if deliveries:
+            logger.info(f"📮 [Webhook Dispatcher] Gửi lại {len(deliveries)} webhook còn trong outbox")
+
+    async def _dispatch_loop(self):
+        try:
+            await self._recover_pending()
+        except Exception as e:
+            logger.error(f"❌ [Webhook Dispatcher] Không đọc được outbox: {e}", exc_info=True)
+        queue = self._get_queue()
+        while True:
+            delivery = await queue.get()
+            queue.task_done()
+            metrics.set_gauge("webhook_queue_depth", queue.qsize())
+            task = asyncio.create_task(self._deliver_safely(delivery))
+            self._delivery_tasks[task] = delivery
+            task.add_done_callback(lambda done: self._delivery_tasks.pop(done, None))
+
+    async def _deliver_safely(self, delivery: WebhookDelivery):
+        try:
+            await self._deliver(delivery)
+        except Exception as e:
+            # Lỗi không phải lỗi mạng (URL sai định dạng, payload không serialize được...): gửi lại cũng
+            # không khác -> dead-letter luôn, không để dòng outbox bị nhận lại và lỗi lại mỗi lần khởi động
+            logger.error(f"❌ [Webhook Dispatcher] {delivery.request_id}: {e}", exc_info=True)
+            delivery.last_error = f"{type(e).__name__}: {e}"
+            try:
+                await self._dead_letter(delivery)
+            except Exception as store_error:
+                logger.error(f"❌ [Webhook Dispatcher] Không ghi được dead-letter {delivery.request_id}: {store_error}")
+
+    async def replay(self, ids: Optional[List[int]] = None, limit: int = 100) -> int:
+        deliveries = await run_in_threadpool(self.dead_letters.pop, self.owner, ids, limit)
+        for delivery in deliveries:
+            self._get_queue().put_nowait(delivery)
+        if deliveries:
+            logger.info(f"🔁 [Webhook Replay] Gửi lại {len(deliveries)} webhook từ dead-letter")
+        return len(deliveries)
+
+    def start(self):
+        if self._dispatch_task is None or self._dispatch_task.done():
+            self._started_at = time.time()
+            self._dispatch_task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self, drain_timeout: float = 10.0):
+        if self._dispatch_task is not None:
+            self._dispatch_task.cancel()
+            await asyncio.gather(self._dispatch_task, return_exceptions=True)
+            self._dispatch_task = None
+        # Cho các lần gửi đang chạy hoàn tất (có giới hạn thời gian)
+        if self._delivery_tasks:
+            await asyncio.wait(list(self._delivery_tasks), timeout=drain_timeout)
+
+        pending = len(self._retry_tasks) + len(self._delivery_tasks)
+        tasks = list(self._retry_tasks) + list(self._delivery_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._retry_tasks.clear()
+
+        # Webhook chưa gửi kịp vẫn nằm trong outbox -> gửi lại khi khởi động lại
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait()
+                pending += 1
+        if pending:
+            logger.warning(f"📮 [Webhook Dispatcher] {pending} webhook chưa gửi được giữ trong outbox")
+
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self.dead_letters.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": len(self._delivery_tasks),
+            "retrying": len(self._retry_tasks),
+            "outbox": self.dead_letters.pending_count(),
+            "dead_letters": self.dead_letters.count(),
+            "hosts": sorted(self._clients),
+        }
+
+# Khởi tạo singleton
+webhook_dispatcher = WebhookDispatcher(DeadLetterStore(settings.JOB_DB_PATH))
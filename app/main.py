@@ -3,6 +3,15 @@ import sys
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.core.config import settings
+from app.core.http_client import http_client_manager
+from app.core.job_store import job_store
+from app.core.task_runner import task_runner
+from app.core.slot_pool import llm_slot_pool
+from app.core.webhook_dispatcher import webhook_dispatcher
+from app.services.ollama_pool import ollama_pool
+from app.services.result_cache import result_cache
+from app.services.file_parser import file_parser
+from app.services.warmup_service import warmup_manager
 from app.api.api_v1.api import api_router
 
 # --- CẤU HÌNH LOGGING TẬP TRUNG ---
@@ -36,5 +45,30 @@ app.include_router(api_router, prefix=settings.API_V1_STR)
 
 @app.on_event("startup")
 async def startup_event():
+    # Mở connection pool dùng chung (Ollama, Webhook)
+    await http_client_manager.startup()
+    # Vòng probe nhận lại các node Ollama bị loại
+    ollama_pool.start()
+    # Nạp sẵn model trên mọi node (chạy nền), readiness xem tại /utils/ready
+    if settings.WARMUP_ENABLED:
+        warmup_manager.start()
+    # Hàng đợi gửi webhook (tách khỏi worker chấm bài)
+    webhook_dispatcher.start()
+    # Worker pool xử lý hàng đợi job (khôi phục job dang dở của lần chạy trước)
+    await task_runner.start()
     logger.info("🚀 AI Middleware đã khởi động thành công!")
-    logger.info(f"🔧 Cấu hình: Model={settings.MODEL_NAME}, Max Tokens={settings.MAX_INPUT_TOKENS}")
\ No newline at end of file
+    logger.info(f"🔧 Cấu hình: Model={settings.MODEL_NAME}, Max Tokens={settings.MAX_INPUT_TOKENS}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await task_runner.stop()
+    await webhook_dispatcher.stop()
+    await warmup_manager.stop()
+    await ollama_pool.stop()
+    result_cache.close()
+    file_parser.cache.close()
+    file_parser.pdf_extractor.shutdown()
+    llm_slot_pool.close()
+    job_store.close()
+    await http_client_manager.shutdown()
+    logger.info("🛑 AI Middleware đã dừng.")
\ No newline at end of file
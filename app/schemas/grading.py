@@ -1,6 +1,11 @@
 from pydantic import BaseModel, Field
 from typing import Optional
 
+class GradingOutput(BaseModel):
+    """Cấu trúc JSON model bắt buộc phải trả về (gửi cho Ollama làm structured-output schema)"""
+    score: float = Field(..., ge=0, description="Điểm số do AI chấm")
+    feedback: str = Field(..., min_length=1, description="Nhận xét chi tiết bằng tiếng Việt")
+
 class GradingResponse(BaseModel):
     score: Optional[float] = Field(None, description="Điểm số (Null nếu lỗi)")
     feedback: Optional[str] = Field(None, description="Nhận xét (Null nếu lỗi)")
@@ -0,0 +1,167 @@
+import json
+import re
+import logging
+from dataclasses import dataclass, field
+from typing import List, Dict, Any
+from app.services.token_service import token_service
+
+logger = logging.getLogger("context_packer")
+
+# Khối file đính kèm do FileParserService sinh ra
+ATTACHMENT_PATTERN = re.compile(r"(<file_attachment\b[^>]*>\n?)(.*?)(\n?</file_attachment>)", re.DOTALL)
+_PLACEHOLDER = "\x00ATTACHMENT_{}\x00"
+_PLACEHOLDER_PATTERN = re.compile(r"\x00ATTACHMENT_(\d+)\x00")
+
+
+@dataclass
+class PromptSection:
+    """
+    Một phần của prompt cần đóng gói theo ngân sách token.
+    - priority: càng thấp càng bị cắt trước.
+    - share: tỉ lệ tối đa của tổng ngân sách mà phần này được giữ khi buộc phải cắt.
+    - kind: "text" | "attachments" (danh sách khối <file_attachment>) | "references" (kết quả RAG).
+    """
+    name: str
+    priority: int
+    share: float
+    content: str = ""
+    items: List[Any] = field(default_factory=list)
+    kind: str = "text"
+    min_tokens: int = 0
+
+
+@dataclass
+class PackResult:
+    sections: Dict[str, PromptSection]
+    token_count: int
+    trimmed: List[str]
+
+
+def split_attachments(text: str):
+    """
+    Tách các khối <file_attachment> ra khỏi văn bản, thay bằng placeholder để ghép lại đúng vị trí.
+    Trả về (văn bản có placeholder, danh sách khối).
+    """
+    blocks = []
+
+    def _replace(match):
+        blocks.append(match.group(0))
+        return _PLACEHOLDER.format(len(blocks) - 1)
+
+    return ATTACHMENT_PATTERN.sub(_replace, text or ""), blocks
+
+
+def join_attachments(text: str, blocks: List[str]) -> str:
+    """
+    Thay placeholder bằng khối tương ứng. Khối nào mất placeholder (phần văn bản bị cắt)
+    được gắn lại ở cuối: file đính kèm đã được tính vào ngân sách thì không được biến mất khỏi prompt.
+    """
+    restored = set()
+
+    def _restore(match):
+        index = int(match.group(1))
+        restored.add(index)
+        return blocks[index]
+
+    joined = _PLACEHOLDER_PATTERN.sub(_restore, text or "")
+    missing = [block for index, block in enumerate(blocks) if index not in restored]
+    return "\n".join(part for part in [joined] + missing if part)
+
+
+class ContextPacker:
+    """
+    Đóng gói các phần của prompt vào ngân sách token:
+    1. Nếu tổng đã vừa -> giữ nguyên.
+    2. Vượt -> cắt lần lượt từ phần ưu tiên thấp nhất (RAG -> file đính kèm -> ...),
+       mỗi phần chỉ cắt xuống tới hạn mức share * ngân sách.
+    3. Vẫn vượt -> cắt tiếp xuống min_tokens theo cùng thứ tự. Tổng min_tokens lớn hơn ngân sách
+       (VD system instruction rất dài) -> các mức sàn được hạ theo cùng tỉ lệ để kết quả luôn vừa ngân sách.
+    """
+
+    def count(self, section: PromptSection) -> int:
+        if section.kind == "attachments":
+            return sum(token_service.count_tokens(block) for block in section.items)
+        if section.kind == "references":
+            return token_service.count_tokens(self.render_references(section.items)) if section.items else 0
+        return token_service.count_tokens(section.content)
+
+    @staticmethod
+    def render_references(items: List[Dict[str, Any]]) -> str:
+        return json.dumps(items, ensure_ascii=False, indent=2) if items else ""
+
+    def _shrink(self, section: PromptSection, target: int):
+        target = max(target, 0)
+        if section.kind == "references":
+            # Bỏ các kết quả kém liên quan nhất trước (score của Chroma là khoảng cách: càng lớn càng xa)
+            items = sorted(section.items, key=lambda r: r.get("score", 0))
+            while items and token_service.count_tokens(self.render_references(items)) > target:
+                if len(items) == 1:
+                    overhead = token_service.count_tokens(self.render_references([{**items[0], "content": ""}]))
+                    content_budget = target - overhead
+                    if content_budget <= 0:
+                        items = []
+                        break
+                    items = [{**items[0], "content": token_service.truncate_to_tokens(items[0]["content"], content_budget)}]
+                    break
+                items.pop()
+            section.items = items
+
+        elif section.kind == "attachments":
+            if not section.items:
+                return
+            per_block = target // len(section.items)
+            shrunk = []
+            for block in section.items:
+                match = ATTACHMENT_PATTERN.fullmatch(block)
+                if not match:
+                    shrunk.append(token_service.truncate_to_tokens(block, per_block))
+                    continue
+                head, body, tail = match.groups()
+                body_budget = per_block - token_service.count_tokens(head + tail)
+                body = token_service.truncate_to_tokens(body, body_budget) if body_budget > 0 else "[... đã lược bớt toàn bộ nội dung ...]"
+                shrunk.append(f"{head}{body}{tail}")
+            section.items = shrunk
+
+        else:
+            # Placeholder của file đính kèm không được cắt (mất / đứt đôi -> file biến mất khỏi prompt):
+            # tách ra, chỉ cắt phần chữ rồi gắn lại ở cuối
+            placeholders = [match.group(0) for match in _PLACEHOLDER_PATTERN.finditer(section.content)]
+            text = _PLACEHOLDER_PATTERN.sub("", section.content)
+            reserved = token_service.count_tokens("".join(placeholders))
+            section.content = token_service.truncate_to_tokens(text, target - reserved) + "".join(placeholders)
+
+    def pack(self, sections: List[PromptSection], budget: int) -> PackResult:
+        costs = {s.name: self.count(s) for s in sections}
+        total = sum(costs.values())
+        trimmed = []
+        ordered = sorted(sections, key=lambda s: s.priority)
+
+        if total > budget:
+            min_total = sum(s.min_tokens for s in sections)
+            scale = min(budget / min_total, 1.0) if min_total else 1.0
+            min_floors = {s.name: int(s.min_tokens * scale) for s in sections}
+            # Lượt cuối lặp lại: cắt theo token rồi decode có thể lệch vài token so với mục tiêu
+            for floor_to_min in (False, True, True):
+                for section in ordered:
+                    overflow = total - budget
+                    if overflow <= 0:
+                        break
+                    min_floor = min_floors[section.name]
+                    floor = min_floor if floor_to_min else max(min_floor, int(budget * section.share))
+                    target = max(floor, costs[section.name] - overflow)
+                    if target >= costs[section.name]:
+                        continue
+                    self._shrink(section, target)
+                    new_cost = self.count(section)
+                    total -= costs[section.name] - new_cost
+                    costs[section.name] = new_cost
+                    if section.name not in trimmed:
+                        trimmed.append(section.name)
+
+        if trimmed:
+            logger.info(f"✂️ [Context Packer] Đã cắt {trimmed} để vừa ngân sách {budget} token (còn {total})")
+
+        return PackResult(sections={s.name: s for s in sections}, token_count=total, trimmed=trimmed)
+
+# Khởi tạo singleton
+context_packer = ContextPacker()
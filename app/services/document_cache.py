@@ -0,0 +1,211 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any, Tuple
+from app.core.metrics import metrics
+
+logger = logging.getLogger("document_cache")
+
+
+def hash_content(content_bytes: bytes) -> str:
+    return hashlib.sha256(content_bytes).hexdigest()
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Cùng giá trị với hash_content(toàn bộ file) nhưng đọc từng đoạn, không giữ cả file trong RAM."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DocumentCache:
+    """
+    Cache văn bản đã parse + vệ sinh của file đính kèm (đề bài, đáp án dùng chung cho cả lớp):
+    - Key = SHA-256 nội dung file + loại file (parser được chọn theo đuôi file).
+    - Đường tắt: (path, size, mtime) -> hash, không cần đọc lại file.
+    - Tầng 1: LRU trong RAM. Tầng 2: SQLite trên đĩa, giới hạn tổng dung lượng (xóa bản ít dùng nhất).
+    - parser_version đổi (nâng cấp parser / PyMuPDF / luật vệ sinh) -> toàn bộ bản ghi cũ bị bỏ.
+    """
+
+    def __init__(self, db_path: str, parser_version: str, memory_size: int, max_disk_bytes: int, enabled: bool = True):
+        self.db_path = db_path
+        self.parser_version = parser_version
+        self.memory_size = memory_size
+        self.max_disk_bytes = max_disk_bytes
+        self.enabled = enabled
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        # path -> (size, mtime_ns, key)
+        self._stat_index: "OrderedDict[str, Tuple[int, int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, content_hash: str, kind: str) -> str:
+        return f"{kind}:{content_hash}"
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS parsed_documents ("
+                " key TEXT PRIMARY KEY, parser_version TEXT NOT NULL, text TEXT NOT NULL,"
+                " size_bytes INTEGER NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS parsed_document_paths ("
+                " path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, key TEXT NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_parsed_documents_access ON parsed_documents(last_access)")
+            # Parser đã đổi -> văn bản cũ không còn đúng
+            removed = conn.execute(
+                "DELETE FROM parsed_documents WHERE parser_version != ?", (self.parser_version,)
+            ).rowcount
+            if removed:
+                logger.info(f"🧹 [Document Cache] Xóa {removed} bản parse của phiên bản parser cũ")
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _remember(self, key: str, text: str):
+        self._memory[key] = text
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _remember_path(self, path: str, size: int, mtime_ns: int, key: str):
+        self._stat_index[path] = (size, mtime_ns, key)
+        self._stat_index.move_to_end(path)
+        while len(self._stat_index) > self.memory_size * 4:
+            self._stat_index.popitem(last=False)
+
+    def _lookup(self, key: str) -> Tuple[Optional[str], Optional[str]]:
+        """(văn bản, tầng) - gọi khi đang giữ lock."""
+        text = self._memory.get(key)
+        if text is not None:
+            self._memory.move_to_end(key)
+            return text, "memory"
+        conn = self._get_conn()
+        row = conn.execute(
+            "SELECT text FROM parsed_documents WHERE key = ? AND parser_version = ?", (key, self.parser_version)
+        ).fetchone()
+        if row is None:
+            return None, None
+        conn.execute("UPDATE parsed_documents SET last_access = ? WHERE key = ?", (time.time(), key))
+        conn.commit()
+        self._remember(key, row[0])
+        return row[0], "disk"
+
+    def get_by_path(self, path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """Đường tắt: file không đổi (cùng size + mtime) -> văn bản đã parse, không cần đọc file."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                entry = self._stat_index.get(path)
+                if entry is None:
+                    row = self._get_conn().execute(
+                        "SELECT size, mtime_ns, key FROM parsed_document_paths WHERE path = ?", (path,)
+                    ).fetchone()
+                    entry = tuple(row) if row else None
+                if entry is None or entry[0] != size or entry[1] != mtime_ns:
+                    return None
+                text, tier = self._lookup(entry[2])
+            except sqlite3.Error as e:
+                logger.error(f"Document cache read error: {e}")
+                return None
+            if text is not None:
+                self._remember_path(path, size, mtime_ns, entry[2])
+                return self._record_hit(text, f"path_{tier}")
+            return None
+
+    def get(self, key: str, path: Optional[str] = None, size: int = 0, mtime_ns: int = 0) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            try:
+                text, tier = self._lookup(key)
+                if text is not None and path:
+                    self._store_path(path, size, mtime_ns, key)
+            except sqlite3.Error as e:
+                logger.error(f"Document cache read error: {e}")
+                text, tier = None, None
+            if text is not None:
+                return self._record_hit(text, tier)
+            self.misses += 1
+            metrics.inc("document_cache_misses_total")
+            return None
+
+    def _record_hit(self, text: str, tier: str) -> str:
+        self.hits += 1
+        metrics.inc("document_cache_hits_total", tier=tier)
+        return text
+
+    def _store_path(self, path: str, size: int, mtime_ns: int, key: str):
+        self._remember_path(path, size, mtime_ns, key)
+        conn = self._get_conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO parsed_document_paths (path, size, mtime_ns, key) VALUES (?, ?, ?, ?)",
+            (path, size, mtime_ns, key),
+        )
+        conn.commit()
+
+    def set(self, key: str, text: str, path: Optional[str] = None, size: int = 0, mtime_ns: int = 0):
+        if not self.enabled:
+            return
+        now = time.time()
+        with self._lock:
+            self._remember(key, text)
+            try:
+                conn = self._get_conn()
+                conn.execute(
+                    "INSERT OR REPLACE INTO parsed_documents (key, parser_version, text, size_bytes, created_at, last_access)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, self.parser_version, text, len(text.encode("utf-8")), now, now),
+                )
+                conn.commit()
+                if path:
+                    self._store_path(path, size, mtime_ns, key)
+                self._evict(conn)
+            except sqlite3.Error as e:
+                logger.error(f"Document cache write error: {e}")
+
+    def _evict(self, conn: sqlite3.Connection):
+        # Vượt dung lượng -> xóa các bản lâu không được dùng tới khi về dưới giới hạn
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM parsed_documents").fetchone()[0]
+        if total > self.max_disk_bytes:
+            rows = conn.execute("SELECT key, size_bytes FROM parsed_documents ORDER BY last_access ASC").fetchall()
+            victims = []
+            for key, size_bytes in rows:
+                if total <= self.max_disk_bytes:
+                    break
+                victims.append((key,))
+                total -= size_bytes
+            conn.executemany("DELETE FROM parsed_documents WHERE key = ?", victims)
+            conn.execute("DELETE FROM parsed_document_paths WHERE key NOT IN (SELECT key FROM parsed_documents)")
+            conn.commit()
+        metrics.set_gauge("document_cache_disk_bytes", total)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "parser_version": self.parser_version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
@@ -1,19 +1,34 @@
+import asyncio
 import io
 import os
 import logging
 import re
+from typing import Dict, Generator, List, Optional, Tuple
 import fitz  # PyMuPDF
-import aiofiles
 from fastapi import UploadFile
 from fastapi.concurrency import run_in_threadpool
 from docx import Document
 
 # IMPORT SERVICE BẢO MẬT (Giả sử file prompt_security_service.py nằm cùng thư mục)
 from app.services.prompt_security_service import PromptSecurityService
+from app.core.config import settings
+from app.services.document_cache import DocumentCache, hash_file
+from app.services.pdf_extractor import PdfExtractor
 
 logger = logging.getLogger("file_parser")
 logger.setLevel(logging.INFO)
 
+# Tăng khi đổi cách trích xuất / làm sạch / vệ sinh văn bản -> cache parse cũ tự bị bỏ
+PARSER_VERSION = "2"
+
+TEXT_EXTENSIONS = (".txt", ".md", ".py", ".java", ".cpp", ".json", ".html", ".css", ".js", ".php")
+
+# Ước lượng token theo ký tự khi đọc dần (giống estimate_file_tokens); context packer cắt chính xác sau
+CHARS_PER_TOKEN = 4
+
+# Văn bản file đã được escape (< >) nên thẻ này chỉ có thể do parser thêm vào
+TRUNCATION_TAG = "<truncation_notice>"
+
 class FileParserService:
     def __init__(self):
         # Pre-compile regex để tối ưu hiệu năng
@@ -25,6 +40,27 @@ class FileParserService:
         # Khởi tạo security service một lần duy nhất
         self.security_service = PromptSecurityService()
 
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+        # PDF local: trích xuất theo trang trong process pool (file upload vẫn parse từ bytes)
+        self.pdf_extractor = PdfExtractor(
+            max_workers=settings.PDF_EXTRACT_WORKERS,
+            pages_per_task=settings.PDF_PAGES_PER_TASK,
+        )
+
+        # Cache văn bản đã parse theo nội dung file (đề bài / đáp án dùng chung cả lớp chỉ parse 1 lần)
+        self.cache = DocumentCache(
+            db_path=settings.DOCUMENT_CACHE_DB_PATH,
+            # Giới hạn trích xuất đổi -> văn bản đã cắt theo giới hạn cũ không còn đúng
+            parser_version=(
+                f"{PARSER_VERSION}:pymupdf-{fitz.VersionBind}"
+                f":tokens-{settings.FILE_TOKEN_BUDGET}:pages-{settings.PDF_MAX_PAGES}"
+            ),
+            memory_size=settings.DOCUMENT_CACHE_MEMORY_SIZE,
+            max_disk_bytes=settings.DOCUMENT_CACHE_MAX_DISK_MB * 1024 * 1024,
+            enabled=settings.DOCUMENT_CACHE_ENABLED,
+        )
+
     def _clean_text(self, text: str) -> str:
         if not text: return ""
         
@@ -52,60 +88,164 @@ class FileParserService:
             return f'<file_attachment name="{safe_filename}">\n[SYSTEM ERROR: {error_msg}]\n</file_attachment>'
             
         # Lưu ý: content ở đây đã được Sanitize (escape HTML) bởi security service
-        return f'<file_attachment name="{safe_filename}">\n{content}\n</file_attachment>'
-
-    def _parse_pdf(self, content_bytes: bytes) -> str:
-        text = ""
-        # fitz mở file từ memory cực nhanh và an toàn
-        with fitz.open(stream=content_bytes, filetype="pdf") as doc:
-            for page in doc:
-                # flags=~fitz.TEXT_PRESERVE_IMAGES giúp bỏ qua ảnh, tránh lỗi crash
-                text += page.get_text(sort=True) + "\n"
-        return text
-
-    def _parse_docx(self, content_bytes: bytes) -> str:
+        truncated = ' truncated="true"' if TRUNCATION_TAG in content else ""
+        return f'<file_attachment name="{safe_filename}"{truncated}>\n{content}\n</file_attachment>'
+
+    def _iter_text(self, content_bytes: Optional[bytes], path: Optional[str]) -> Generator[str, None, None]:
+        chunk_chars = max(settings.FILE_TEXT_CHUNK_CHARS, 1)
+        if path:
+            # Đọc từng đoạn: dừng sớm khi đủ ngân sách token, không nạp cả file log khổng lồ vào RAM
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                yield from iter(lambda: f.read(chunk_chars), "")
+            return
+        text = content_bytes.decode("utf-8", errors="ignore")
+        for start in range(0, len(text), chunk_chars):
+            yield text[start:start + chunk_chars]
+
+    def _iter_pdf(self, content_bytes: Optional[bytes], path: Optional[str], notes: List[str]) -> Generator[str, None, None]:
+        max_pages = settings.PDF_MAX_PAGES
+        if path:
+            with fitz.open(path) as doc:
+                page_count = doc.page_count
+            for page in self.pdf_extractor.iter_pages(path, max_pages):
+                yield page + "\n"
+        else:
+            # fitz mở file từ memory cực nhanh và an toàn
+            with fitz.open(stream=content_bytes, filetype="pdf") as doc:
+                page_count = doc.page_count
+                for index in range(min(page_count, max_pages)):
+                    yield doc[index].get_text(sort=True) + "\n"
+        if page_count > max_pages:
+            notes.append(f"chỉ trích xuất {max_pages}/{page_count} trang đầu")
+
+    def _iter_docx(self, content_bytes: bytes) -> Generator[str, None, None]:
         doc = Document(io.BytesIO(content_bytes))
-        return "\n".join([para.text for para in doc.paragraphs])
+        for para in doc.paragraphs:
+            yield para.text + "\n"
+
+    def _take_within_budget(self, pieces: Generator[str, None, None]) -> Tuple[str, bool]:
+        """
+        Ghép dần từng đoạn văn bản, dừng khi đạt FILE_TOKEN_BUDGET (các đoạn sau không bị đọc / trích xuất).
+        Trả về (văn bản, có bị cắt không).
+        """
+        if settings.FILE_TOKEN_BUDGET is None:
+            return "".join(pieces), False
+        remaining = settings.FILE_TOKEN_BUDGET * CHARS_PER_TOKEN
+        collected = []
+        try:
+            for piece in pieces:
+                if len(piece) > remaining:
+                    collected.append(piece[:remaining])
+                    return "".join(collected), True
+                collected.append(piece)
+                remaining -= len(piece)
+            return "".join(collected), False
+        finally:
+            # Đóng file / hủy các đoạn PDF đang chờ trong process pool
+            pieces.close()
+
+    def _extract_safe_text(self, content_bytes: Optional[bytes], filename: str, path: Optional[str] = None) -> str:
+        """
+        Trích xuất + làm sạch + vệ sinh văn bản (CPU bound). Lỗi -> exception.
+        path: file local -> file văn bản được đọc từng đoạn, PDF được trích xuất trong process pool
+        (content_bytes chỉ cần cho .docx).
+        Vượt FILE_TOKEN_BUDGET / PDF_MAX_PAGES -> dừng trích xuất, kết quả kèm <truncation_notice>.
+        """
+        notes: List[str] = []
+        if filename.endswith(TEXT_EXTENSIONS):
+            raw_text, truncated = self._take_within_budget(self._iter_text(content_bytes, path))
+
+        elif filename.endswith(".pdf"):
+            raw_text, truncated = self._take_within_budget(self._iter_pdf(content_bytes, path, notes))
+            if not raw_text.strip():
+                raise ValueError("PDF không chứa văn bản (có thể là file scan/ảnh)")
+
+        elif filename.endswith(".docx"):
+            raw_text, truncated = self._take_within_budget(self._iter_docx(content_bytes))
+
+        else:
+            raise ValueError("Định dạng file không được hỗ trợ")
+
+        if truncated:
+            notes.append(f"dừng trích xuất khi đạt ~{settings.FILE_TOKEN_BUDGET} token")
+
+        # 1. Làm sạch cơ bản (xóa khoảng trắng thừa)
+        cleaned_text = self._clean_text(raw_text)
+
+        # --- BƯỚC BẢO MẬT QUAN TRỌNG ---
+        # 2. Quét Injection & Vệ sinh HTML tags (Sanitize)
+        # Hàm này sẽ trả về văn bản sạch (đã escape < >) hoặc thông báo lỗi nếu gian lận
+        safe_text = self.security_service.validate_and_sanitize(cleaned_text)
+        if notes:
+            # Thêm sau bước vệ sinh: ghi chú của hệ thống, không phải nội dung sinh viên
+            safe_text += (
+                f"\n{TRUNCATION_TAG}File đã bị cắt bớt ({'; '.join(notes)}), "
+                f"phần còn lại không được đưa vào.</truncation_notice>"
+            )
+        return safe_text
 
     def _process_content_sync(self, content_bytes: bytes, filename: str) -> str:
         """Hàm xử lý logic nặng (CPU bound), sẽ chạy trong thread pool"""
         filename = filename.lower()
-        raw_text = ""
-        
         try:
-            if filename.endswith((".txt", ".md", ".py", ".java", ".cpp", ".json", ".html", ".css", ".js", ".php")):
-                raw_text = content_bytes.decode("utf-8", errors="ignore")
-            
-            elif filename.endswith(".pdf"):
-                raw_text = self._parse_pdf(content_bytes)
-                if not raw_text.strip():
-                    raise ValueError("PDF không chứa văn bản (có thể là file scan/ảnh)")
+            safe_text = self._extract_safe_text(content_bytes, filename)
+            # 3. Đóng gói vào XML (Lúc này safe_text đã an toàn để nhúng vào XML)
+            return self._format_response(filename, safe_text, None)
 
-            elif filename.endswith(".docx"):
-                raw_text = self._parse_docx(content_bytes)
-            
-            else:
-                return self._format_response(filename, "", "Định dạng file không được hỗ trợ")
+        except Exception as e:
+            logger.error(f"Error parsing {filename}: {e}")
+            return self._format_response(filename, "", str(e))
 
-            # 1. Làm sạch cơ bản (xóa khoảng trắng thừa)
-            cleaned_text = self._clean_text(raw_text)
-            
-            # --- BƯỚC BẢO MẬT QUAN TRỌNG ---
-            # 2. Quét Injection & Vệ sinh HTML tags (Sanitize)
-            # Hàm này sẽ trả về văn bản sạch (đã escape < >) hoặc thông báo lỗi nếu gian lận
-            safe_text = self.security_service.validate_and_sanitize(cleaned_text)
-            
-            # 3. Đóng gói vào XML (Lúc này safe_text đã an toàn để nhúng vào XML)
+    def _parse_local_file_sync(self, file_path: str) -> str:
+        """
+        Đọc + parse file local có cache:
+        1. (path, size, mtime) không đổi -> lấy văn bản đã parse, không đọc file.
+        2. Cùng nội dung (hash) đã parse trước đó (file khác đường dẫn) -> không parse lại.
+        3. Còn lại -> parse và lưu cache (chỉ lưu kết quả thành công).
+        """
+        filename = os.path.basename(file_path).lower()
+        kind = os.path.splitext(filename)[1]
+        if not filename.endswith(TEXT_EXTENSIONS + (".pdf", ".docx")):
+            return self._format_response(filename, "", "Định dạng file không được hỗ trợ")
+        try:
+            stat = os.stat(file_path)
+            if stat.st_size > settings.FILE_MAX_BYTES:
+                return self._format_response(filename, "", self._too_large_message(stat.st_size))
+            cached = self.cache.get_by_path(file_path, stat.st_size, stat.st_mtime_ns)
+            if cached is not None:
+                return self._format_response(filename, cached, None)
+
+            key = self.cache.make_key(hash_file(file_path), kind)
+            cached = self.cache.get(key, file_path, stat.st_size, stat.st_mtime_ns)
+            if cached is not None:
+                return self._format_response(filename, cached, None)
+
+            # Chỉ .docx cần nạp cả file; văn bản đọc từng đoạn, PDF mở theo đường dẫn
+            content = None
+            if kind == ".docx":
+                with open(file_path, "rb") as f:
+                    content = f.read()
+            safe_text = self._extract_safe_text(content, filename, file_path)
+            self.cache.set(key, safe_text, file_path, stat.st_size, stat.st_mtime_ns)
             return self._format_response(filename, safe_text, None)
 
+        except OSError as e:
+            return self._format_response(filename, "", f"Lỗi đọc file local: {str(e)}")
         except Exception as e:
             logger.error(f"Error parsing {filename}: {e}")
             return self._format_response(filename, "", str(e))
 
+    def _too_large_message(self, size: int) -> str:
+        return f"File quá lớn ({size / 1024 / 1024:.1f} MB, tối đa {settings.FILE_MAX_BYTES / 1024 / 1024:.0f} MB)"
+
     async def parse_upload_file(self, file: UploadFile) -> str:
         if not file: return ""
         try:
-            content = await file.read()
+            # Đọc tối đa giới hạn + 1 byte: đủ để biết file quá lớn mà không nạp hết vào RAM
+            content = await file.read(settings.FILE_MAX_BYTES + 1)
+            if len(content) > settings.FILE_MAX_BYTES:
+                await file.seek(0)
+                return self._format_response(file.filename, "", self._too_large_message(file.size or len(content)))
             # Đẩy việc xử lý nặng sang thread khác để không chặn API
             result = await run_in_threadpool(self._process_content_sync, content, file.filename)
             await file.seek(0)
@@ -116,13 +256,14 @@ class FileParserService:
     async def parse_local_file(self, file_path: str) -> str:
         if not os.path.exists(file_path):
             return ""
-        filename = os.path.basename(file_path)
-        try:
-            async with aiofiles.open(file_path, mode='rb') as f:
-                content = await f.read()
-            # Tái sử dụng logic qua thread pool
-            return await run_in_threadpool(self._process_content_sync, content, filename)
-        except Exception as e:
-            return self._format_response(filename, "", f"Lỗi đọc file local: {str(e)}")
+        # Nhiều job cùng parse 1 file (đề bài của cả lớp) cùng lúc -> chỉ 1 lần parse, các job khác chờ kết quả
+        task = self._inflight.get(file_path)
+        if task is None:
+            # Đọc file + parse + cache (SQLite) đều chạy trong thread pool
+            task = asyncio.ensure_future(run_in_threadpool(self._parse_local_file_sync, file_path))
+            self._inflight[file_path] = task
+            task.add_done_callback(lambda _: self._inflight.pop(file_path, None))
+        # shield: 1 job bị hủy không làm hỏng lần parse dùng chung
+        return await asyncio.shield(task)
 
 file_parser = FileParserService()
\ No newline at end of file
@@ -30,6 +30,13 @@ class InstructionManager:
         except:
             return self.default_data["instruction"]
 
+    def get_version(self) -> int:
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("version", 1)
+        except:
+            return self.default_data["version"]
+
     def update_instruction(self, content: str):
         try:
             with open(self.file_path, "r", encoding="utf-8") as f:
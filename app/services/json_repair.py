@@ -0,0 +1,122 @@
+import json
+import re
+from typing import Any
+from app.services.json_stream_parser import IncrementalJSONParser
+
+# Dấu phẩy thừa trước } hoặc ]
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+# Key bị cắt cụt ở cuối object (vd: `, "feedb` hoặc `, "feedback":`)
+_DANGLING_KEY = re.compile(r',?\s*"[^"]*"\s*:?\s*$')
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _extract_object(text: str) -> str:
+    """
+    Cắt bỏ phần văn xuôi bao quanh, giữ object cấp cao nhất đầu tiên (đếm ngoặc, bỏ qua ngoặc trong chuỗi)
+    -> văn xuôi có ngoặc {} phía sau object không làm hỏng việc parse.
+    """
+    if "{" not in text:
+        raise json.JSONDecodeError("No JSON object found", text, 0)
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    # Nếu object bị cắt cụt (chưa đóng ngoặc) thì lấy tới hết chuỗi
+    return parser.result() or parser.partial()
+
+
+def _normalize(text: str) -> str:
+    """
+    Quét từng ký tự để sửa các lỗi phổ biến của LLM:
+    - Chuỗi dùng nháy đơn -> nháy kép.
+    - Xuống dòng / tab thô trong chuỗi -> escape.
+    - True/False/None kiểu Python -> true/false/null.
+    - Chuỗi hoặc ngoặc chưa đóng (output bị cắt cụt) -> tự đóng.
+    """
+    out = []
+    stack = []
+    quote = None  # Ký tự mở chuỗi hiện tại (' hoặc "), None nếu ngoài chuỗi
+    escape = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if escape:
+                escape = False
+                if ch == "'":
+                    # \' không hợp lệ trong JSON -> bỏ dấu \
+                    out.pop()
+                out.append(ch)
+            elif ch == "\\":
+                escape = True
+                out.append(ch)
+            elif ch == quote:
+                quote = None
+                out.append('"')
+            elif ch == '"':
+                # Nháy kép bên trong chuỗi nháy đơn
+                out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\r":
+                out.append("\\r")
+            elif ch == "\t":
+                out.append("\\t")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch in ('"', "'"):
+            quote = ch
+            out.append('"')
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+            out.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            out.append(ch)
+        else:
+            literal = next((k for k in _PY_LITERALS if text.startswith(k, i)), None)
+            if literal:
+                out.append(_PY_LITERALS[literal])
+                i += len(literal)
+                continue
+            out.append(ch)
+        i += 1
+
+    if quote:
+        if escape:
+            out.pop()
+        out.append('"')
+
+    repaired = "".join(out).rstrip()
+    if stack:
+        repaired = repaired.rstrip(",")
+        if stack[-1] == "}" and repaired.endswith(":"):
+            repaired += " null"
+    repaired += "".join(reversed(stack))
+    return repaired
+
+
+def repair_json(text: str) -> Any:
+    """
+    Cố gắng khôi phục JSON hỏng từ output của LLM mà không cần gọi lại model.
+    Ném json.JSONDecodeError nếu thực sự không thể khôi phục.
+    """
+    candidate = _extract_object(text.strip())
+    try:
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        pass
+
+    repaired = _TRAILING_COMMA.sub(r"\1", _normalize(candidate))
+    try:
+        return json.loads(repaired)
+    except json.JSONDecodeError:
+        pass
+
+    # Lần cuối: bỏ key bị cắt cụt ở cuối rồi đóng object
+    body = repaired.rstrip("}]").rstrip()
+    closers = repaired[len(body):]
+    trimmed = _DANGLING_KEY.sub("", body)
+    return json.loads(_TRAILING_COMMA.sub(r"\1", trimmed + closers))
@@ -0,0 +1,68 @@
+from typing import Optional
+
+class IncrementalJSONParser:
+    """
+    Parser tăng dần cho luồng token của Ollama (NDJSON stream).
+    Nhận từng mảnh văn bản qua feed(), theo dõi độ sâu ngoặc {} (có tính đến chuỗi
+    và ký tự escape) và báo hiệu ngay khi object JSON cấp cao nhất đã đóng,
+    để phía gọi có thể ngắt request, bỏ qua phần "lảm nhảm" phía sau.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._started = False
+        self._complete = False
+
+    @property
+    def is_complete(self) -> bool:
+        return self._complete
+
+    def feed(self, chunk: str) -> bool:
+        """
+        Nạp thêm một mảnh văn bản. Trả về True khi đã có một object JSON hoàn chỉnh.
+        Văn bản trước dấu '{' đầu tiên (markdown ```json, lời dẫn...) bị bỏ qua.
+        """
+        if self._complete or not chunk:
+            return self._complete
+
+        for ch in chunk:
+            if not self._started:
+                if ch != "{":
+                    continue
+                self._started = True
+
+            self._buffer.append(ch)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+
+            if ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._complete = True
+                    break
+
+        return self._complete
+
+    def result(self) -> Optional[str]:
+        """Chuỗi JSON hoàn chỉnh (None nếu object chưa đóng)."""
+        if not self._complete:
+            return None
+        return "".join(self._buffer)
+
+    def partial(self) -> str:
+        """Phần đã nhận được (kể cả khi chưa hoàn chỉnh)."""
+        return "".join(self._buffer)
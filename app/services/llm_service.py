@@ -2,6 +2,10 @@ import httpx
 import json
 import logging
 import re
+import time
+from contextlib import asynccontextmanager
+from typing import Optional, Type
+from pydantic import BaseModel, ValidationError
 from tenacity import (
     retry,
     stop_after_attempt,
@@ -10,9 +14,20 @@ from tenacity import (
     before_sleep_log
 )
 from app.core.config import settings
-from app.schemas.grading import GradingResponse
+from app.core.http_client import http_client_manager
+from app.core.metrics import metrics
+from app.core.circuit_breaker import CircuitBreaker, CircuitOpenError
+from app.core.concurrency import adaptive_limiter
+from app.core.job_events import job_events
+from app.schemas.grading import GradingResponse, GradingOutput
 from app.services.prompt_service import prompt_service
 from app.services.token_service import token_service
+from app.core.common import grading_input_parts, file_identity, estimate_file_tokens
+from app.services.json_stream_parser import IncrementalJSONParser
+from app.services.json_repair import repair_json
+from app.services.ollama_pool import ollama_pool, OllamaPool
+from app.services.result_cache import result_cache
+from app.services.instruction_manager import instruction_manager
 
 # Cấu hình logger
 logger = logging.getLogger("ai_engine")
@@ -20,8 +35,33 @@ logger.setLevel(logging.INFO)
 
 class LLMService:
     def __init__(self):
-        self.base_url = settings.OLLAMA_HOST
+        # Pool nhiều node Ollama (mặc định 1 node = OLLAMA_HOST)
+        self.pool = ollama_pool
         self.model = settings.MODEL_NAME
+        # Ngắt mạch khi Ollama sập: từ chối ngay thay vì retry + backoff trong khi giữ slot
+        self.circuit_breaker = CircuitBreaker(
+            name="ollama",
+            failure_threshold=settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+            recovery_timeout=settings.CIRCUIT_BREAKER_RECOVERY_TIMEOUT,
+            half_open_max_calls=settings.CIRCUIT_BREAKER_HALF_OPEN_MAX_CALLS,
+            is_failure=OllamaPool._is_node_failure,
+        )
+
+    @asynccontextmanager
+    async def _acquire_backend(self, affinity_key: Optional[str] = None):
+        """
+        Qua circuit breaker rồi giữ 1 slot trên node Ollama phù hợp nhất.
+        Mạch đang mở -> CircuitOpenError ngay (không bị Tenacity retry).
+        Timeout / 5xx / mất kết nối -> báo AdaptiveLimiter giảm concurrency.
+        """
+        async with self.circuit_breaker.guard():
+            async with self.pool.acquire(affinity_key) as node:
+                try:
+                    yield node
+                except Exception as e:
+                    if OllamaPool._is_node_failure(e):
+                        adaptive_limiter.record_overload("timeout" if isinstance(e, httpx.TimeoutException) else "error")
+                    raise
 
     # --- HÀM HELPER: Làm sạch chuỗi JSON từ AI ---
     def _clean_json_string(self, json_str: str) -> str:
@@ -35,46 +75,151 @@ class LLMService:
                 return match.group(1).strip()
         return json_str
 
+    # --- HÀM HELPER: Đọc luồng NDJSON của Ollama, dừng sớm khi đủ JSON ---
+    async def _stream_json_response(self, payload: dict, affinity_key: Optional[str] = None) -> str:
+        """
+        Gửi request với "stream": true, nạp từng token vào IncrementalJSONParser.
+        Ngay khi object JSON cấp cao nhất đóng lại -> đóng kết nối (Ollama ngừng sinh,
+        giải phóng slot sớm). Ghi nhận time-to-first-token vào metrics.
+        """
+        stream_payload = {**payload, "stream": True}
+        parser = IncrementalJSONParser()
+        chunks = []
+        started_at = time.perf_counter()
+        first_token_at = None
+        early_stop = False
+
+        client = http_client_manager.client
+        async with self._acquire_backend(affinity_key) as node:
+            async with client.stream("POST", f"{node.url}/api/generate", json=stream_payload) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line.strip():
+                        continue
+                    event = json.loads(line)
+                    if event.get("error"):
+                        raise RuntimeError(f"Ollama stream error: {event['error']}")
+
+                    token = event.get("response", "")
+                    if token:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            metrics.observe("llm_time_to_first_token_seconds", first_token_at - started_at, model=self.model)
+                        chunks.append(token)
+                        job_events.emit("token", delta=token)
+                        if parser.feed(token):
+                            # Đã có object hoàn chỉnh -> thoát khỏi context để đóng stream
+                            early_stop = not event.get("done", False)
+                            break
+
+                    if event.get("done"):
+                        break
+
+        finished_at = time.perf_counter()
+        metrics.observe("llm_generation_seconds", finished_at - started_at, model=self.model, mode="stream")
+        # TTFT phản ánh hàng đợi bên trong Ollama, tokens/sec phản ánh GPU đang bị chia sẻ
+        if first_token_at is not None:
+            decode_seconds = finished_at - first_token_at
+            tokens_per_second = (len(chunks) - 1) / decode_seconds if len(chunks) > 1 and decode_seconds > 0 else None
+            adaptive_limiter.record_sample(first_token_at - started_at, tokens_per_second)
+        if early_stop:
+            metrics.inc("llm_stream_early_stop_total", model=self.model)
+
+        return parser.result() or "".join(chunks)
+
     # --- CORE 1: Hàm xử lý JSON (Có Retry cả Mạng + Format JSON) ---
     # Dùng cho: Chấm điểm, Trích xuất thông tin cấu trúc
     @retry(
         stop=stop_after_attempt(3), # Thử tối đa 3 lần
         wait=wait_exponential(multiplier=1, min=2, max=10),
-        # Retry nếu: Mất mạng, Timeout, Server lỗi (500), HOẶC JSON lỗi
+        # Retry nếu: Mất mạng, Timeout, Server lỗi (500), JSON lỗi HOẶC sai schema
         retry=retry_if_exception_type((
             httpx.ConnectError, 
             httpx.ReadTimeout, 
             httpx.ConnectTimeout, 
             httpx.HTTPStatusError,
-            json.JSONDecodeError 
+            json.JSONDecodeError,
+            ValidationError
         )),
-        before_sleep=before_sleep_log(logger, logging.WARNING)
+        before_sleep=before_sleep_log(logger, logging.WARNING),
+        # Hết lượt thử -> ném lại lỗi gốc (JSONDecodeError / ValidationError) thay vì RetryError
+        reraise=True
     )
-    async def _generate_json_with_retry(self, payload: dict) -> dict:
+    async def _generate_json_with_retry(self, payload: dict, response_model: Optional[Type[BaseModel]] = None, affinity_key: Optional[str] = None) -> dict:
         """
         Gửi request và ép buộc trả về dict hợp lệ. 
         Nếu parse lỗi -> Ném ngoại lệ -> Tenacity bắt -> Retry lại từ đầu.
+        Nếu có response_model: validate bằng Pydantic, chỉ retry khi thiếu/sai trường.
         """
-        # 1. Kiểm tra Token limit
+        metrics.inc("llm_json_attempts_total", model=self.model)
+
+        # 1. Kiểm tra Token limit: prompt phải vừa num_ctx gửi kèm (trừ phần output),
+        #    không so với MAX_INPUT_TOKENS - đó chỉ là ngân sách đóng gói, phần template không bị cắt
         prompt_text = payload.get("prompt", "")
         if prompt_text:
-            check = token_service.check_token_limit(prompt_text)
+            num_ctx = payload.get("options", {}).get("num_ctx") or settings.OLLAMA_MAX_NUM_CTX
+            check = token_service.check_token_limit(prompt_text, limit=token_service.prompt_capacity(num_ctx))
             if not check["is_valid"]:
                 # Token quá lớn thì không retry làm gì, ném lỗi thẳng
                 raise ValueError(f"Token limit exceeded: {check['count']}/{check['limit']}")
 
-        # 2. Gửi Request
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(f"{self.base_url}/api/generate", json=payload)
-            response.raise_for_status() # Ném lỗi nếu status code >= 400
-            result = response.json()
+        # 2. Gửi Request (dùng connection pool chung, giữ keep-alive)
+        if payload.get("stream"):
+            raw_response = await self._stream_json_response(payload, affinity_key) or "{}"
+        else:
+            started_at = time.perf_counter()
+            async with self._acquire_backend(affinity_key) as node:
+                response = await http_client_manager.client.post(f"{node.url}/api/generate", json=payload)
+                response.raise_for_status() # Ném lỗi nếu status code >= 400
+                result = response.json()
+            elapsed = time.perf_counter() - started_at
+            metrics.observe("llm_generation_seconds", elapsed, model=self.model, mode="blocking")
+            eval_seconds = (result.get("eval_duration") or 0) / 1e9
+            adaptive_limiter.record_sample(elapsed, result.get("eval_count", 0) / eval_seconds if eval_seconds > 0 else None)
+            raw_response = result.get("response", "{}")
 
         # 3. Parse JSON (Điểm mấu chốt: Nếu lỗi ở đây, hàm sẽ retry lại bước 2)
-        raw_response = result.get("response", "{}")
         cleaned_response = self._clean_json_string(raw_response)
-        
-        # Nếu dòng này lỗi JSONDecodeError -> Tenacity sẽ kích hoạt retry
-        return json.loads(cleaned_response)
+        try:
+            return self._validate_output(json.loads(cleaned_response), response_model)
+        except json.JSONDecodeError:
+            pass
+
+        # 4. Sửa JSON cục bộ (dấu phẩy thừa, nháy đơn, chuỗi bị cắt...) thay vì gọi lại model
+        try:
+            repaired = repair_json(cleaned_response)
+        except json.JSONDecodeError:
+            # Không thể khôi phục -> Tenacity sẽ kích hoạt retry (sinh lại)
+            metrics.inc("llm_json_unrecoverable_total", model=self.model)
+            logger.warning(f"Unrecoverable JSON from model: {cleaned_response[:200]}")
+            raise
+
+        metrics.inc("llm_json_repairs_total", model=self.model)
+        logger.info("🔧 [JSON Repair] Đã sửa JSON lỗi cục bộ, không cần sinh lại")
+        return self._validate_output(repaired, response_model)
+
+    def _validate_output(self, content, response_model: Optional[Type[BaseModel]]) -> dict:
+        """
+        Validate output theo schema. Sai schema -> ValidationError -> Tenacity retry.
+        """
+        if response_model is None:
+            return content
+        try:
+            return response_model.model_validate(content).model_dump()
+        except ValidationError:
+            metrics.inc("llm_schema_validation_failures_total", model=self.model)
+            logger.warning(f"Model output does not match {response_model.__name__}: {str(content)[:200]}")
+            raise
+
+    def _record_output_rates(self):
+        """Cập nhật tỉ lệ retry / sai schema theo model (gauge, xem tại /utils/metrics)."""
+        requests = metrics.get_counter("llm_grading_requests_total", model=self.model)
+        if not requests:
+            return
+        attempts = metrics.get_counter("llm_json_attempts_total", model=self.model)
+        failures = metrics.get_counter("llm_schema_validation_failures_total", model=self.model)
+        metrics.set_gauge("llm_grading_retry_rate", max(attempts - requests, 0) / requests, model=self.model)
+        metrics.set_gauge("llm_schema_validation_failure_rate", failures / max(attempts, 1), model=self.model)
 
     # --- CORE 2: Hàm xử lý Text thường (Chỉ Retry Mạng) ---
     # Dùng cho: Chat, Làm phẳng Rubric, Tóm tắt
@@ -85,25 +230,81 @@ class LLMService:
         before_sleep=before_sleep_log(logger, logging.WARNING)
     )
     async def _generate_text_with_retry(self, payload: dict) -> str:
-        # Kiểm tra token
+        # Kiểm tra token: prompt tự do (rubric, ask-llm) không bị đóng gói theo MAX_INPUT_TOKENS,
+        # chỉ chặn khi chắc chắn vượt context window lớn nhất
         prompt_text = payload.get("prompt", "")
         if prompt_text:
-            check = token_service.check_token_limit(prompt_text)
+            check = token_service.check_token_limit(prompt_text, limit=settings.OLLAMA_MAX_NUM_CTX)
             if not check["is_valid"]:
                 raise ValueError(f"Token limit exceeded: {check['count']}/{check['limit']}")
 
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(f"{self.base_url}/api/generate", json=payload)
+        async with self._acquire_backend() as node:
+            response = await http_client_manager.client.post(f"{node.url}/api/generate", json=payload)
             response.raise_for_status()
             result = response.json()
-            
+
         return result.get("response", "").strip()
 
+    # --- HÀM HELPER: Cache kết quả chấm theo nội dung đầu vào ---
+    def _grading_options(self) -> dict:
+        # num_ctx được gắn riêng từ GradingPrompt (cố định, xem TokenService.grading_num_ctx)
+        return {
+            "temperature": 0.1
+        }
+
+    def grading_fingerprint(self, data: dict) -> str:
+        """Hash nội dung đầu vào chấm bài: cùng hash -> cùng kết quả (dùng cho cache + gộp job trùng)."""
+        return result_cache.make_key({
+            "course_id": data.get("course_id"),
+            "question": data.get("question"),
+            "submission": data.get("submission"),
+            "reference": data.get("reference"),
+            "rubric": data.get("rubric"),
+            "teacher_instruction": data.get("teacher_instruction"),
+            "max_score": data.get("max_score"),
+            "system_instruction_version": instruction_manager.get_version(),
+            "model": self.model,
+            "options": self._grading_options(),
+            "structured_output": settings.OLLAMA_STRUCTURED_OUTPUT,
+            "prompt_layout": settings.PROMPT_LAYOUT,
+        })
+
+    def grading_request_fingerprint(self, data: dict) -> str:
+        """
+        Hash đầu vào lúc enqueue (file chưa được parse): nội dung văn bản + định danh file
+        (đường dẫn, kích thước, thời điểm sửa). Dùng để gộp job trùng đang chờ / đang chạy.
+        """
+        texts, files = grading_input_parts(data)
+        return result_cache.make_key({
+            "input": self.grading_fingerprint({**data, **texts}),
+            "files": [file_identity(path) for path in files],
+        })
+
+    def estimate_grading_tokens(self, data: dict) -> int:
+        """
+        Kích thước job chấm bài (token đầu vào) để scheduler ưu tiên bài ngắn.
+        File chưa parse được ước lượng theo kích thước. Prompt bị cắt theo MAX_INPUT_TOKENS
+        nên ước lượng cũng bị chặn ở đó.
+        """
+        texts, files = grading_input_parts(data)
+        total = sum(token_service.count_tokens(text) for text in texts.values())
+        total += sum(estimate_file_tokens(path) for path in files)
+        return min(total, settings.MAX_INPUT_TOKENS)
+
+    def get_cached_grade(self, data: dict):
+        """
+        Trả về GradingResponse đã lưu nếu cùng đầu vào đã được chấm trước đó (None nếu chưa có).
+        """
+        if not settings.RESULT_CACHE_ENABLED or not data.get("use_cache", True):
+            return None
+        cached = result_cache.get(self.grading_fingerprint(data))
+        return GradingResponse(**cached) if cached else None
+
     # --- CHỨC NĂNG 1: Chấm điểm bài làm (Dùng Core 1) ---
     async def grade_submission(self, data: dict) -> GradingResponse:
         try:
-            # 1. Tạo Prompt
-            prompt = prompt_service.build_grading_prompt(
+            # 1. Tạo Prompt (đã đóng gói theo ngân sách token)
+            grading_prompt = prompt_service.build_grading_prompt(
                 course_id=data.get('course_id'),
                 question=data['question'],
                 submission=data['submission'],
@@ -116,37 +317,69 @@ class LLMService:
             # 2. Cấu hình payload
             payload = {
                 "model": self.model,
-                "prompt": prompt,
-                "stream": False,
-                "format": "json", # Bắt buộc JSON mode của Ollama
+                "prompt": grading_prompt.text,
+                "stream": settings.OLLAMA_STREAM_GRADING, # Stream + dừng sớm khi JSON đã đủ
+                "keep_alive": settings.OLLAMA_KEEP_ALIVE, # Giữ model (và KV cache tiền tố) trong bộ nhớ
+                # Structured output: ép Ollama sinh đúng schema GradingOutput (hoặc JSON mode lỏng)
+                "format": GradingOutput.model_json_schema() if settings.OLLAMA_STRUCTURED_OUTPUT else "json",
                 "options": {
-                    "temperature": 0.1,
-                    "num_ctx": 4096
+                    **self._grading_options(),
+                    "num_ctx": grading_prompt.num_ctx
                 }
             }
+            metrics.observe("grading_prompt_tokens", grading_prompt.token_count, model=self.model)
+            if grading_prompt.trimmed_sections:
+                metrics.inc("grading_prompt_trimmed_total", model=self.model)
+            job_events.stage("prompt_built", token_count=grading_prompt.token_count)
 
             # 3. Gọi hàm có Retry JSON (Core 1)
             # Không cần try-catch JSONDecodeError ở đây nữa vì Core 1 đã lo rồi
             # Nếu Core 1 vẫn fail sau 3 lần, nó sẽ ném lỗi ra ngoài -> vào except Exception bên dưới
-            ai_content = await self._generate_json_with_retry(payload)
-            
-            # 4. Xử lý Logic điểm số
-            raw_score = float(ai_content.get("score", 0))
+            metrics.inc("llm_grading_requests_total", model=self.model)
+            job_events.stage("generating")
+            try:
+                # Sticky routing: cùng tiền tố prompt (cùng bài tập) -> cùng node Ollama
+                ai_content = await self._generate_json_with_retry(
+                    payload,
+                    response_model=GradingOutput,
+                    affinity_key=grading_prompt.prefix_key
+                )
+            finally:
+                self._record_output_rates()
+
+            # 4. Xử lý Logic điểm số (ai_content đã được validate theo GradingOutput)
+            raw_score = float(ai_content["score"])
             max_allowed = float(data.get('max_score', 10))
             final_score = min(raw_score, max_allowed)
 
-            return GradingResponse(
+            grading_result = GradingResponse(
                 score=final_score,
-                feedback=ai_content.get("feedback", "Không có nhận xét chi tiết."),
+                feedback=ai_content["feedback"],
                 ai_model=self.model,
                 error=None
             )
 
-        except ValueError as ve:
-            # Lỗi Token quá lớn hoặc lỗi logic
-            logger.error(f"Validation Error: {ve}")
-            return GradingResponse(score=0, feedback=None, error=str(ve), ai_model=self.model)
-            
+            # 5. Lưu cache (chỉ lưu kết quả thành công)
+            if settings.RESULT_CACHE_ENABLED and data.get("use_cache", True):
+                result_cache.set(self.grading_fingerprint(data), grading_result.model_dump())
+
+            return grading_result
+
+        except CircuitOpenError:
+            # Để TaskRunner quyết định: "đỗ" job chờ mạch đóng hoặc báo lỗi ngay
+            raise
+
+        # ValidationError và JSONDecodeError đều là lớp con của ValueError -> phải bắt trước
+        except ValidationError:
+            # Sau nhiều lần retry mà output vẫn thiếu/sai trường score, feedback
+            logger.error("Model output failed schema validation after retries")
+            return GradingResponse(
+                score=0,
+                feedback=None,
+                error="AI Error: Output did not match the grading schema after multiple attempts.",
+                ai_model=self.model
+            )
+
         except json.JSONDecodeError:
             # Lỗi này chỉ xảy ra nếu sau 3 lần retry mà AI vẫn trả về rác
             logger.error("Failed to parse JSON after retries")
@@ -157,6 +390,11 @@ class LLMService:
                 ai_model=self.model
             )
 
+        except ValueError as ve:
+            # Lỗi Token quá lớn hoặc lỗi logic
+            logger.error(f"Validation Error: {ve}")
+            return GradingResponse(score=0, feedback=None, error=str(ve), ai_model=self.model)
+
         except Exception as e:
             # Các lỗi hệ thống khác
             logger.error(f"System Error in Grading: {e}", exc_info=True)
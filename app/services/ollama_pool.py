@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import httpx
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional, Dict, Any, Tuple
+from app.core.config import settings
+from app.core.http_client import http_client_manager
+from app.core.metrics import metrics
+
+logger = logging.getLogger("ollama_pool")
+
+class OllamaNode:
+    """
+    Một backend Ollama: giới hạn concurrency riêng + trạng thái sức khỏe bị động.
+    """
+
+    def __init__(self, url: str, max_concurrency: int):
+        self.url = url.rstrip("/")
+        self.max_concurrency = max(1, max_concurrency)
+        self.in_flight = 0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.total_requests = 0
+        self.total_failures = 0
+        self.ewma_latency: Optional[float] = None
+        self.last_used_at: Optional[float] = None
+        self.ejected_at: Optional[float] = None
+
+    @property
+    def has_capacity(self) -> bool:
+        return self.in_flight < self.max_concurrency
+
+    def record_success(self, latency: float):
+        self.total_requests += 1
+        self.consecutive_failures = 0
+        self.last_used_at = time.time()
+        # EWMA để theo dõi xu hướng latency của từng node
+        self.ewma_latency = latency if self.ewma_latency is None else 0.8 * self.ewma_latency + 0.2 * latency
+
+    def record_failure(self, eject_after: int) -> bool:
+        """Trả về True nếu lần lỗi này khiến node bị loại khỏi pool."""
+        self.total_requests += 1
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        self.last_used_at = time.time()
+        if self.healthy and self.consecutive_failures >= eject_after:
+            self.healthy = False
+            self.ejected_at = time.time()
+            return True
+        return False
+
+    def readmit(self):
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_at = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "consecutive_failures": self.consecutive_failures,
+            "total_requests": self.total_requests,
+            "total_failures": self.total_failures,
+            "ewma_latency_seconds": self.ewma_latency,
+            "last_used_at": self.last_used_at,
+            "ejected_at": self.ejected_at,
+        }
+
+
+def parse_ollama_hosts(raw_hosts: Optional[str], default_host: str, default_concurrency: int) -> List[Tuple[str, int]]:
+    """
+    Đọc cấu hình OLLAMA_HOSTS dạng "http://gpu1:11434=2,http://gpu2:11434".
+    Hậu tố "=N" là concurrency riêng của node (mặc định default_concurrency).
+    """
+    if not raw_hosts or not raw_hosts.strip():
+        return [(default_host, default_concurrency)]
+
+    nodes = []
+    for item in raw_hosts.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, sep, limit = item.rpartition("=")
+        if sep and limit.strip().isdigit():
+            nodes.append((url.strip(), int(limit)))
+        else:
+            nodes.append((item, default_concurrency))
+    return nodes or [(default_host, default_concurrency)]
+
+
+class OllamaPool:
+    """
+    Cân bằng tải nhiều node Ollama:
+    1. Định tuyến least-outstanding-requests (node ít request đang chạy nhất, theo tỉ lệ slot).
+    2. Mỗi node có slot riêng (thay cho semaphore toàn cục duy nhất).
+    3. Health tracking bị động: lỗi liên tiếp -> loại node; vòng probe định kỳ -> nhận lại.
+    """
+
+    def __init__(self, nodes: List[OllamaNode], eject_after: int = 3, probe_interval: float = 15.0):
+        self.nodes = nodes
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self._condition: Optional[asyncio.Condition] = None
+        self._probe_task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_settings(cls) -> "OllamaPool":
+        node_concurrency = settings.OLLAMA_NODE_MAX_CONCURRENCY
+        if not node_concurrency:
+            # Bật adaptive: slot của node là trần, AdaptiveLimiter quyết định số request thực chạy
+            node_concurrency = settings.MAX_CONCURRENT_REQUESTS
+            if settings.ADAPTIVE_CONCURRENCY_ENABLED:
+                node_concurrency = max(settings.ADAPTIVE_CONCURRENCY_MAX_PER_NODE, settings.MAX_CONCURRENT_REQUESTS)
+        hosts = parse_ollama_hosts(settings.OLLAMA_HOSTS, settings.OLLAMA_HOST, node_concurrency)
+        return cls(
+            nodes=[OllamaNode(url, limit) for url, limit in hosts],
+            eject_after=settings.OLLAMA_EJECT_AFTER_FAILURES,
+            probe_interval=settings.OLLAMA_PROBE_INTERVAL,
+        )
+
+    @property
+    def total_capacity(self) -> int:
+        return sum(node.max_concurrency for node in self.nodes)
+
+    def _get_condition(self) -> asyncio.Condition:
+        # Tạo lazy để gắn đúng event loop đang chạy
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    @staticmethod
+    def _affinity_rank(node: OllamaNode, affinity_key: str) -> str:
+        # Rendezvous hashing: mỗi key có 1 node "nhà" ổn định, ít xáo trộn khi thêm/bớt node
+        return hashlib.sha256(f"{affinity_key}|{node.url}".encode("utf-8")).hexdigest()
+
+    def _pick_node(self, affinity_key: Optional[str] = None) -> Optional[OllamaNode]:
+        candidates = [n for n in self.nodes if n.healthy]
+        if not candidates:
+            # Toàn bộ node đều bị loại -> chạy chế độ suy giảm, vẫn thử trên mọi node
+            candidates = self.nodes
+
+        available = [n for n in candidates if n.has_capacity]
+        if not available:
+            return None
+
+        if affinity_key and settings.OLLAMA_STICKY_ROUTING and len(candidates) > 1:
+            home = max(candidates, key=lambda n: self._affinity_rank(n, affinity_key))
+            if home.has_capacity:
+                metrics.inc("ollama_sticky_hits_total")
+                return home
+            metrics.inc("ollama_sticky_misses_total")
+
+        return min(available, key=lambda n: (n.in_flight / n.max_concurrency, n.in_flight))
+
+    @staticmethod
+    def _is_node_failure(exc: BaseException) -> bool:
+        if isinstance(exc, httpx.HTTPStatusError):
+            return exc.response.status_code >= 500
+        return isinstance(exc, httpx.TransportError)
+
+    @asynccontextmanager
+    async def acquire(self, affinity_key: Optional[str] = None):
+        """
+        Giữ 1 slot trên node phù hợp nhất trong suốt lời gọi Ollama.
+        affinity_key (vd: hash tiền tố prompt của bài tập) -> ưu tiên node "nhà" nếu còn slot.
+        Ví dụ: async with ollama_pool.acquire() as node: client.post(f"{node.url}/api/generate", ...)
+        """
+        condition = self._get_condition()
+        async with condition:
+            node = self._pick_node(affinity_key)
+            while node is None:
+                await condition.wait()
+                node = self._pick_node(affinity_key)
+            node.in_flight += 1
+
+        metrics.set_gauge("ollama_node_in_flight", node.in_flight, node=node.url)
+        started_at = time.perf_counter()
+        try:
+            yield node
+        except BaseException as e:
+            if self._is_node_failure(e):
+                metrics.inc("ollama_node_failures_total", node=node.url)
+                if node.record_failure(self.eject_after):
+                    logger.warning(f"⛔ [Pool] Loại node {node.url} sau {node.consecutive_failures} lỗi liên tiếp")
+            raise
+        else:
+            latency = time.perf_counter() - started_at
+            node.record_success(latency)
+            metrics.observe("ollama_node_latency_seconds", latency, node=node.url)
+        finally:
+            metrics.inc("ollama_node_requests_total", node=node.url)
+            async with condition:
+                node.in_flight -= 1
+                condition.notify_all()
+            metrics.set_gauge("ollama_node_in_flight", node.in_flight, node=node.url)
+
+    async def probe_node(self, node: OllamaNode) -> bool:
+        try:
+            response = await http_client_manager.client.get(f"{node.url}/", timeout=5.0)
+            return response.status_code == 200
+        except httpx.HTTPError:
+            return False
+
+    async def _probe_loop(self):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for node in self.nodes:
+                if node.healthy:
+                    continue
+                if await self.probe_node(node):
+                    logger.info(f"✅ [Pool] Node {node.url} đã hoạt động trở lại, nhận lại vào pool")
+                    condition = self._get_condition()
+                    async with condition:
+                        node.readmit()
+                        condition.notify_all()
+
+    def start(self):
+        if self._probe_task is None or self._probe_task.done():
+            self._probe_task = asyncio.create_task(self._probe_loop())
+
+    async def stop(self):
+        if self._probe_task is not None:
+            self._probe_task.cancel()
+            try:
+                await self._probe_task
+            except asyncio.CancelledError:
+                pass
+            self._probe_task = None
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        return [node.stats() for node in self.nodes]
+
+# Khởi tạo singleton
+ollama_pool = OllamaPool.from_settings()
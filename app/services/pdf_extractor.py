@@ -0,0 +1,97 @@
+import logging
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, List, Optional
+import fitz  # PyMuPDF
+
+logger = logging.getLogger("pdf_extractor")
+
+
+def _extract_page_range(path: str, start: int, stop: int) -> List[str]:
+    """Chạy trong tiến trình con: tự mở file theo đường dẫn (không truyền bytes qua pickle)."""
+    with fitz.open(path) as doc:
+        return [doc[index].get_text(sort=True) for index in range(start, min(stop, doc.page_count))]
+
+
+class PdfExtractor:
+    """
+    Trích xuất văn bản PDF trong process pool (không tranh GIL với event loop / thread pool):
+    - File lớn được chia thành các đoạn pages_per_task trang, xử lý song song trên nhiều tiến trình.
+    - Tiến trình con mở file theo đường dẫn, chỉ trả về văn bản.
+    - Kết quả trả về theo đúng thứ tự trang (iter_pages yield dần khi từng đoạn xong).
+    max_workers = 0 -> trích xuất ngay trong thread hiện tại (như trước).
+    """
+
+    def __init__(self, max_workers: int, pages_per_task: int):
+        self.max_workers = max_workers
+        self.pages_per_task = max(pages_per_task, 1)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: tiến trình cha có nhiều thread (event loop, thread pool) -> fork không an toàn
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+                )
+                logger.info(f"🧩 [PDF Pool] Khởi động {self.max_workers} tiến trình trích xuất PDF")
+            return self._executor
+
+    def _reset_executor(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def iter_pages(self, path: str, max_pages: Optional[int] = None) -> Iterator[str]:
+        """
+        Văn bản từng trang theo thứ tự (chỉ max_pages trang đầu nếu có giới hạn).
+        Chỉ gửi trước vài đoạn (theo số tiến trình): bên gọi dừng sớm -> các trang sau không bị trích xuất.
+        """
+        with fitz.open(path) as doc:
+            page_count = doc.page_count if max_pages is None else min(doc.page_count, max_pages)
+            if self.max_workers <= 0:
+                for index in range(page_count):
+                    yield doc[index].get_text(sort=True)
+                return
+
+        ranges = iter([
+            (start, min(start + self.pages_per_task, page_count))
+            for start in range(0, page_count, self.pages_per_task)
+        ])
+        futures = deque()
+
+        def submit_next(executor: ProcessPoolExecutor):
+            next_range = next(ranges, None)
+            if next_range is not None:
+                futures.append(executor.submit(_extract_page_range, path, *next_range))
+
+        try:
+            executor = self._get_executor()
+            for _ in range(self.max_workers + 1):
+                submit_next(executor)
+            while futures:
+                pages = futures.popleft().result()
+                submit_next(executor)
+                yield from pages
+        except BrokenProcessPool:
+            # Tiến trình con chết (PDF hỏng làm crash MuPDF...) -> tạo pool mới cho lần sau
+            logger.error(f"❌ [PDF Pool] Tiến trình trích xuất bị dừng đột ngột khi xử lý {path}")
+            self._reset_executor()
+            raise
+        finally:
+            for future in futures:
+                future.cancel()
+
+    def extract(self, path: str, max_pages: Optional[int] = None) -> str:
+        return "".join(page + "\n" for page in self.iter_pages(path, max_pages))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
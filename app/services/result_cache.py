@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Any
+from app.core.config import settings
+from app.core.metrics import metrics
+
+logger = logging.getLogger("result_cache")
+
+class ResultCache:
+    """
+    Cache kết quả chấm điểm theo nội dung (content-addressed):
+    - Key = SHA-256 của toàn bộ đầu vào prompt (đề, bài làm, rubric, model, options...).
+    - Tầng 1: LRU trong RAM (OrderedDict).
+    - Tầng 2: SQLite trên đĩa, có TTL và giới hạn số bản ghi (xóa bản ít dùng nhất).
+    """
+
+    def __init__(self, db_path: str, memory_size: int, ttl_seconds: int, max_entries: int):
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(parts: Dict[str, Any]) -> str:
+        raw = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _get_conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS grading_cache ("
+                " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON grading_cache(last_access)")
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, key: str, value: Dict[str, Any], created_at: float):
+        self._memory[key] = (value, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl_seconds:
+                self._memory.move_to_end(key)
+                return self._record_hit(entry[0], tier="memory")
+
+            try:
+                conn = self._get_conn()
+                row = conn.execute(
+                    "SELECT value, created_at FROM grading_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl_seconds:
+                    conn.execute("UPDATE grading_cache SET last_access = ? WHERE key = ?", (now, key))
+                    conn.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, value, row[1])
+                    return self._record_hit(value, tier="disk")
+            except sqlite3.Error as e:
+                logger.error(f"Cache read error: {e}")
+
+            self._memory.pop(key, None)
+            self.misses += 1
+            metrics.inc("grading_cache_misses_total")
+            return None
+
+    def _record_hit(self, value: Dict[str, Any], tier: str) -> Dict[str, Any]:
+        self.hits += 1
+        metrics.inc("grading_cache_hits_total", tier=tier)
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        now = time.time()
+        with self._lock:
+            self._remember(key, value, now)
+            try:
+                conn = self._get_conn()
+                conn.execute(
+                    "INSERT OR REPLACE INTO grading_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                    (key, json.dumps(value, ensure_ascii=False), now, now),
+                )
+                conn.commit()
+                self._evict(conn, now)
+            except sqlite3.Error as e:
+                logger.error(f"Cache write error: {e}")
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        # 1. Xóa bản ghi hết hạn (TTL)
+        conn.execute("DELETE FROM grading_cache WHERE created_at < ?", (now - self.ttl_seconds,))
+        # 2. Vượt giới hạn kích thước -> xóa các bản ghi lâu không được truy cập
+        total = conn.execute("SELECT COUNT(*) FROM grading_cache").fetchone()[0]
+        if total > self.max_entries:
+            conn.execute(
+                "DELETE FROM grading_cache WHERE key IN ("
+                " SELECT key FROM grading_cache ORDER BY last_access ASC LIMIT ?)",
+                (total - self.max_entries,),
+            )
+        conn.commit()
+        metrics.set_gauge("grading_cache_entries", min(total, self.max_entries))
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "memory_entries": len(self._memory),
+        }
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# Khởi tạo singleton
+result_cache = ResultCache(
+    db_path=settings.RESULT_CACHE_DB_PATH,
+    memory_size=settings.RESULT_CACHE_MEMORY_SIZE,
+    ttl_seconds=settings.RESULT_CACHE_TTL_SECONDS,
+    max_entries=settings.RESULT_CACHE_MAX_ENTRIES,
+)
@@ -1,5 +1,7 @@
+import math
 import tiktoken
 import logging
+from typing import Optional
 from app.core.config import settings
 
 logger = logging.getLogger("token_service")
@@ -30,16 +32,61 @@ class TokenService:
             # Trả về ước lượng an toàn
             return len(text) // 3
 
-    def check_token_limit(self, text: str) -> dict:
+    def truncate_to_tokens(self, text: str, max_tokens: int) -> str:
         """
-        Kiểm tra xem text có vượt quá giới hạn không.
+        Cắt văn bản về tối đa max_tokens, giữ phần đầu và phần cuối (phần kết luận thường nằm cuối),
+        chèn ghi chú ở giữa để model biết nội dung đã bị lược bớt.
+        """
+        if not text or max_tokens <= 0:
+            return ""
+        try:
+            tokens = self.encoder.encode(text)
+        except Exception as e:
+            logger.error(f"Error encoding tokens: {e}")
+            return text[: max_tokens * 3]
+
+        if len(tokens) <= max_tokens:
+            return text
+
+        marker = f"\n[... đã lược bớt {len(tokens) - max_tokens} token ...]\n"
+        keep = max(max_tokens - self.count_tokens(marker), 0)
+        head = int(keep * 0.7)
+        tail = keep - head
+        return self.encoder.decode(tokens[:head]) + marker + (self.encoder.decode(tokens[-tail:]) if tail else "")
+
+    def recommend_num_ctx(self, prompt_tokens: int) -> int:
+        """
+        Tính num_ctx cho Ollama từ kích thước prompt thực tế:
+        prompt (nhân hệ số an toàn vì tokenizer khác Qwen) + phần dành cho output,
+        làm tròn lên theo bậc OLLAMA_NUM_CTX_STEP để hạn chế việc Ollama nạp lại model.
+        """
+        needed = int(prompt_tokens * settings.TOKEN_SAFETY_MARGIN) + settings.RESPONSE_TOKEN_RESERVE
+        step = max(settings.OLLAMA_NUM_CTX_STEP, 1)
+        num_ctx = math.ceil(needed / step) * step
+        return max(settings.OLLAMA_MIN_NUM_CTX, min(num_ctx, settings.OLLAMA_MAX_NUM_CTX))
+
+    def grading_num_ctx(self) -> int:
+        """
+        num_ctx cố định cho mọi request chấm điểm (và warm-up): đủ cho prompt lớn nhất sau khi đóng gói.
+        Không tính theo từng prompt vì Ollama nạp lại runner mỗi khi num_ctx đổi.
+        """
+        return self.recommend_num_ctx(settings.MAX_INPUT_TOKENS)
+
+    def prompt_capacity(self, num_ctx: int) -> int:
+        """Số token prompt tối đa vừa num_ctx (nghịch đảo của recommend_num_ctx: trừ phần output + hệ số an toàn)."""
+        return max(int((num_ctx - settings.RESPONSE_TOKEN_RESERVE) / settings.TOKEN_SAFETY_MARGIN), 0)
+
+    def check_token_limit(self, text: str, limit: Optional[int] = None) -> dict:
+        """
+        Kiểm tra xem text có vượt quá giới hạn không (mặc định MAX_INPUT_TOKENS - ngân sách prompt chấm điểm).
         Trả về: { "is_valid": bool, "count": int, "limit": int }
         """
         count = self.count_tokens(text)
-        limit = settings.MAX_INPUT_TOKENS
+        if limit is None:
+            limit = settings.MAX_INPUT_TOKENS
         
         return {
-            "is_valid": True,
+            "is_valid": count <= limit,
             "count": count,
             "limit": limit,
             "message": f"Token count: {count}/{limit}"
@@ -0,0 +1,106 @@
+import asyncio
+import httpx
+import logging
+import time
+from typing import Optional, Dict, Any
+from app.core.config import settings
+from app.core.http_client import http_client_manager
+from app.core.metrics import metrics
+from app.services.ollama_pool import ollama_pool, OllamaPool, OllamaNode
+from app.services.token_service import token_service
+
+logger = logging.getLogger("warmup_service")
+
+class WarmupManager:
+    """
+    Giữ model luôn nằm sẵn trong bộ nhớ của các node Ollama:
+    1. Khi khởi động: gọi generate rất nhỏ (1 token) với keep_alive dài để nạp model.
+    2. Định kỳ: ping lại các node đang rảnh để Ollama không unload model.
+    3. Readiness: chỉ báo "ready" khi model đã được nạp xong trên các node khỏe.
+    """
+
+    def __init__(self, pool: OllamaPool, model: str):
+        self.pool = pool
+        self.model = model
+        self._state: Dict[str, Dict[str, Any]] = {
+            node.url: {"loaded": False, "last_warmed_at": None, "load_seconds": None, "error": None}
+            for node in pool.nodes
+        }
+        self._task: Optional[asyncio.Task] = None
+
+    async def warm_node(self, node: OllamaNode) -> bool:
+        state = self._state[node.url]
+        payload = {
+            "model": self.model,
+            "prompt": "ping",
+            "stream": False,
+            "keep_alive": settings.WARMUP_KEEP_ALIVE,
+            "options": {
+                "num_predict": 1,
+                # Nạp với đúng num_ctx mà request chấm điểm dùng (cố định), tránh Ollama nạp lại model ở request đầu tiên
+                "num_ctx": token_service.grading_num_ctx()
+            }
+        }
+        started_at = time.perf_counter()
+        try:
+            response = await http_client_manager.client.post(
+                f"{node.url}/api/generate", json=payload, timeout=settings.WARMUP_TIMEOUT
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            state.update(loaded=False, error=str(e))
+            metrics.inc("ollama_warmup_failures_total", node=node.url)
+            logger.warning(f"⚠️ [Warmup] Không nạp được model trên {node.url}: {e}")
+            return False
+
+        elapsed = time.perf_counter() - started_at
+        state.update(loaded=True, last_warmed_at=time.time(), load_seconds=elapsed, error=None)
+        metrics.observe("ollama_warmup_seconds", elapsed, node=node.url)
+        logger.info(f"🔥 [Warmup] Model {self.model} sẵn sàng trên {node.url} ({elapsed:.1f}s)")
+        return True
+
+    async def warm_all(self):
+        await asyncio.gather(*(self.warm_node(node) for node in self.pool.nodes))
+
+    def _needs_ping(self, node: OllamaNode, now: float) -> bool:
+        state = self._state[node.url]
+        if not state["loaded"]:
+            return True
+        last_activity = max(node.last_used_at or 0, state["last_warmed_at"] or 0)
+        return now - last_activity >= settings.WARMUP_PING_INTERVAL
+
+    async def _run(self):
+        await self.warm_all()
+        while True:
+            await asyncio.sleep(settings.WARMUP_PING_INTERVAL)
+            now = time.time()
+            idle_nodes = [node for node in self.pool.nodes if node.healthy and self._needs_ping(node, now)]
+            if idle_nodes:
+                await asyncio.gather(*(self.warm_node(node) for node in idle_nodes))
+
+    @property
+    def is_ready(self) -> bool:
+        healthy = [node for node in self.pool.nodes if node.healthy]
+        if not healthy:
+            return False
+        return all(self._state[node.url]["loaded"] for node in healthy)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"ready": self.is_ready, "model": self.model, "nodes": self._state}
+
+    def start(self):
+        if self._task is None or self._task.done():
+            # Chạy nền: việc nạp model có thể mất vài phút, không chặn startup của API
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+# Khởi tạo singleton
+warmup_manager = WarmupManager(ollama_pool, settings.MODEL_NAME)
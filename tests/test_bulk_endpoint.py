@@ -0,0 +1,110 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import pytest
+
+pytest.importorskip("langchain_community")
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.api.api_v1.endpoints import grading
+from app.core import common
+from app.core.config import settings
+from app.core.job_store import JobStore
+from app.core.scheduler import FairScheduler
+from app.core.task_runner import TaskRunner
+
+
+@pytest.fixture
+def bulk(tmp_path, monkeypatch):
+    """App chỉ gồm router chấm bài, hàng đợi riêng trong tmp_path (không chạy worker)."""
+    store = JobStore(str(tmp_path / "jobs.db"))
+    runner = TaskRunner(store, FairScheduler(weights={}))
+    runner.handlers = grading.task_runner.handlers
+    monkeypatch.setattr(grading, "task_runner", runner)
+    monkeypatch.setattr(grading, "job_store", store)
+    monkeypatch.setattr(settings, "JOB_MAX_ESTIMATED_WAIT_SECONDS", None)
+
+    async def no_parsing(*args, **kwargs):
+        raise AssertionError("File không được parse trên đường request")
+
+    monkeypatch.setattr(common.file_parser, "parse_local_file", no_parsing)
+
+    app = FastAPI()
+    app.include_router(grading.router, prefix="/grading")
+    return TestClient(app), store
+
+
+def bulk_payload(tmp_path, count):
+    reference = tmp_path / "dap_an.txt"
+    reference.write_text("Đáp án mẫu", encoding="utf-8")
+    return {
+        "callback_url": "http://moodle.test/callback",
+        "batch_id": "b1",
+        "assignment_content": "Giải thích tính đóng gói trong OOP.",
+        "reference_answer_file": str(reference),
+        "grading_criteria": "Đúng khái niệm: 10 điểm",
+        "submissions": [
+            {"request_id": f"s{index}", "student_submission_text": f"Bài làm {index}"} for index in range(count)
+        ],
+    }
+
+
+def test_bulk_stores_raw_context_and_enqueues_jobs(bulk, tmp_path):
+    client, store = bulk
+    payload = bulk_payload(tmp_path, 3)
+    payload["submissions"].append({"request_id": "empty", "student_submission_text": "  "})
+
+    response = client.post("/grading/bulk", json=payload)
+
+    assert response.status_code == 202
+    body = response.json()
+    assert body["accepted"] == 3
+    assert [item["request_id"] for item in body["rejected"]] == ["empty"]
+    assert store.count_by_status() == {"queued": 3}
+    # Ngữ cảnh giữ đường dẫn file (worker parse), chưa có bản đã parse
+    context = store.get_context(body["context_id"])
+    assert context["reference_answer_file"] == payload["reference_answer_file"]
+    assert store.get_prepared_context(body["context_id"]) is None
+    assert store.get("s0")["input_data"]["context_id"] == body["context_id"]
+    assert store.get_batch("b1")["total"] == 3
+
+
+def test_bulk_backpressure_counts_whole_batch(bulk, tmp_path, monkeypatch):
+    client, store = bulk
+    monkeypatch.setattr(settings, "JOB_MAX_QUEUE_DEPTH", 5)
+    for index in range(3):
+        store.enqueue(f"old{index}", "grading", {}, "http://cb")
+
+    response = client.post("/grading/bulk", json=bulk_payload(tmp_path, 3))
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert store.count_by_status() == {"queued": 3}
+
+    response = client.post("/grading/bulk", json=bulk_payload(tmp_path, 2))
+    assert response.status_code == 202
+    assert store.count_by_status() == {"queued": 5}
+
+
+def test_bulk_rejects_batch_larger_than_queue(bulk, tmp_path, monkeypatch):
+    client, store = bulk
+    monkeypatch.setattr(settings, "JOB_MAX_QUEUE_DEPTH", 2)
+
+    response = client.post("/grading/bulk", json=bulk_payload(tmp_path, 3))
+
+    assert response.status_code == 413
+    assert store.count_by_status() == {}
+
+
+def test_bulk_without_valid_submissions(bulk, tmp_path):
+    client, store = bulk
+    payload = bulk_payload(tmp_path, 0)
+    assert client.post("/grading/bulk", json=payload).status_code == 400
+
+    payload["submissions"] = [{"request_id": "s0", "student_submission_text": ""}]
+    response = client.post("/grading/bulk", json=payload)
+    assert response.status_code == 400
+    assert store.count_by_status() == {}
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from app.core.circuit_breaker import CircuitBreaker, CircuitOpenError
+
+
+class BackendDown(Exception):
+    pass
+
+
+def make_breaker(**kwargs):
+    options = {"failure_threshold": 2, "recovery_timeout": 0.05}
+    options.update(kwargs)
+    return CircuitBreaker("test", is_failure=lambda e: isinstance(e, BackendDown), **options)
+
+
+async def call(breaker, exc=None):
+    async with breaker.guard():
+        if exc:
+            raise exc
+
+
+def test_opens_after_threshold_and_fails_fast():
+    async def scenario():
+        breaker = make_breaker()
+        for _ in range(2):
+            with pytest.raises(BackendDown):
+                await call(breaker, BackendDown())
+        assert breaker.state == CircuitBreaker.OPEN
+        with pytest.raises(CircuitOpenError):
+            await call(breaker)
+
+    asyncio.run(scenario())
+
+
+def test_half_open_probe_closes_or_reopens():
+    async def scenario():
+        breaker = make_breaker(failure_threshold=1)
+        with pytest.raises(BackendDown):
+            await call(breaker, BackendDown())
+        await asyncio.sleep(0.06)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        with pytest.raises(BackendDown):
+            await call(breaker, BackendDown())
+        assert breaker.state == CircuitBreaker.OPEN
+
+        await breaker.wait_until_available()
+        await call(breaker)
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
+
+
+def test_non_backend_errors_do_not_open():
+    async def scenario():
+        breaker = make_breaker(failure_threshold=1)
+        with pytest.raises(ValueError):
+            await call(breaker, ValueError("bad json"))
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    asyncio.run(scenario())
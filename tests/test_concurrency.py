@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.concurrency import AdaptiveLimiter
+
+
+def test_grows_while_healthy_and_saturated():
+    limiter = AdaptiveLimiter("t", min_limit=1, max_limit=4)
+    for _ in range(50):
+        limiter.in_flight = limiter.limit
+        limiter.record_sample(1.0, tokens_per_second=30.0)
+    assert limiter.limit == 4
+
+    # Không dùng hết slot -> không tăng
+    idle = AdaptiveLimiter("t", min_limit=1, max_limit=4, initial_limit=2)
+    for _ in range(50):
+        idle.record_sample(1.0, tokens_per_second=30.0)
+    assert idle.limit == 2
+
+
+def test_shrinks_on_latency_spike_and_overload():
+    limiter = AdaptiveLimiter("t", min_limit=1, max_limit=8, initial_limit=8)
+    for _ in range(20):
+        limiter.record_sample(1.0)
+    for _ in range(5):
+        limiter.record_sample(10.0)
+    assert limiter.limit < 8
+
+    overloaded = AdaptiveLimiter("t", min_limit=2, max_limit=8, initial_limit=8)
+    overloaded.record_overload("timeout")
+    assert overloaded.limit == 5
+    # Cùng 1 đợt quá tải chỉ giảm 1 lần
+    overloaded.record_overload("timeout")
+    assert overloaded.limit == 5
+    overloaded._last_decrease_at = 0.0
+    overloaded.record_overload("error")
+    overloaded._last_decrease_at = 0.0
+    overloaded.record_overload("error")
+    assert overloaded.limit == 2
+
+
+def test_fixed_limit_blocks_like_semaphore():
+    limiter = AdaptiveLimiter("t", min_limit=2, max_limit=2)
+    limiter.record_overload()
+    assert limiter.limit == 2
+
+    async def scenario():
+        peak = 0
+
+        async def job():
+            nonlocal peak
+            async with limiter.slot():
+                peak = max(peak, limiter.in_flight)
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(job() for _ in range(6)))
+        return peak
+
+    assert asyncio.run(scenario()) == 2
@@ -0,0 +1,56 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.services.context_packer import PromptSection, context_packer, join_attachments, split_attachments
+
+ATTACHMENT = '<file_attachment name="main.py">\n' + "def tinh_tong(a, b): return a + b\n" * 300 + "</file_attachment>"
+
+
+def pack_submission(submission, budget):
+    text, blocks = split_attachments(submission)
+    sections = [
+        PromptSection("submission", priority=80, share=0.35, content=text, min_tokens=300),
+        PromptSection("submission_files", priority=40, share=0.25, items=blocks, kind="attachments"),
+    ]
+    packed = context_packer.pack(sections, budget)
+    return packed, join_attachments(packed.sections["submission"].content, packed.sections["submission_files"].items)
+
+
+def test_trimmed_text_keeps_attachment():
+    submission = "Bài làm của sinh viên. " * 600 + "\n--- File: main.py ---\n" + ATTACHMENT + "\nKết luận cuối bài."
+    packed, joined = pack_submission(submission, 1500)
+
+    assert packed.trimmed == ["submission_files", "submission"]
+    assert joined.count('<file_attachment name="main.py">') == 1
+    assert joined.count("</file_attachment>") == 1
+    assert "\x00" not in joined
+    assert packed.token_count <= 1500
+
+
+def test_untrimmed_attachment_stays_in_place():
+    packed, joined = pack_submission("Đầu bài\n" + ATTACHMENT + "\nCuối bài", 100000)
+    assert packed.trimmed == []
+    assert joined == "Đầu bài\n" + ATTACHMENT + "\nCuối bài"
+
+
+def test_join_reappends_blocks_whose_placeholder_was_lost():
+    _, blocks = split_attachments("a " + ATTACHMENT)
+    assert join_attachments("chỉ còn chữ", blocks) == "chỉ còn chữ\n" + ATTACHMENT
+
+
+def test_min_tokens_scaled_down_when_budget_is_smaller():
+    # Tổng min_tokens 700 > ngân sách 400 (VD system instruction chiếm gần hết MAX_INPUT_TOKENS)
+    sections = [
+        PromptSection("teacher_instruction", priority=90, share=0.10, content="Yêu cầu. " * 200, min_tokens=50),
+        PromptSection("question", priority=70, share=0.20, content="Đề bài. " * 600, min_tokens=200),
+        PromptSection("criteria", priority=60, share=0.20, content="Tiêu chí. " * 600, min_tokens=150),
+        PromptSection("submission", priority=80, share=0.35, content="Bài làm. " * 900, min_tokens=300),
+    ]
+    packed = context_packer.pack(sections, 400)
+
+    assert packed.token_count <= 400
+    assert sum(context_packer.count(s) for s in packed.sections.values()) == packed.token_count
+    # Vẫn giữ lại một phần của mọi mục
+    assert all(s.content for s in packed.sections.values())
@@ -0,0 +1,53 @@
+import os
+import shutil
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.services.document_cache import DocumentCache
+from app.services.file_parser import file_parser
+
+
+def make_cache(tmp_path, version="v1", max_disk_bytes=1 << 20):
+    return DocumentCache(str(tmp_path / "docs.db"), version, memory_size=4, max_disk_bytes=max_disk_bytes)
+
+
+def test_parse_once_per_content(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_parser, "cache", make_cache(tmp_path))
+    calls = []
+    extract = file_parser._extract_safe_text
+    monkeypatch.setattr(
+        file_parser, "_extract_safe_text", lambda data, name, path=None: calls.append(name) or extract(data, name, path)
+    )
+
+    original = tmp_path / "de_bai.txt"
+    original.write_text("Đề bài chung cho cả lớp")
+    copy = tmp_path / "ban_sao.txt"
+    shutil.copy(original, copy)
+
+    first = file_parser._parse_local_file_sync(str(original))
+    assert file_parser._parse_local_file_sync(str(original)) == first  # (path, size, mtime)
+    assert "Đề bài chung" in file_parser._parse_local_file_sync(str(copy))  # cùng nội dung, khác đường dẫn
+    assert calls == ["de_bai.txt"]
+    assert file_parser.cache.stats()["hits"] == 2
+
+    # Nội dung đổi -> parse lại
+    original.write_text("Đề bài đã sửa")
+    assert "đã sửa" in file_parser._parse_local_file_sync(str(original))
+    assert len(calls) == 2
+
+
+def test_parser_version_and_disk_cap(tmp_path):
+    cache = make_cache(tmp_path, max_disk_bytes=10)
+    cache.set("txt:a", "12345678")
+    cache.set("txt:b", "abcdefgh")  # vượt 10 byte -> "a" (ít dùng nhất) bị xóa khỏi đĩa
+    cache.close()
+
+    reopened = make_cache(tmp_path, max_disk_bytes=10)
+    assert reopened.get("txt:a") is None
+    assert reopened.get("txt:b") == "abcdefgh"
+    reopened.close()
+
+    upgraded = make_cache(tmp_path, version="v2")
+    assert upgraded.get("txt:b") is None
+    assert upgraded.stats()["hit_ratio"] == 0.0
@@ -0,0 +1,73 @@
+import os
+import asyncio
+
+import pytest
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.common import grading_input_parts, prepare_grading_input
+
+
+def test_prepare_parses_attachments_in_worker(tmp_path, monkeypatch):
+    from app.services.document_cache import DocumentCache
+    from app.services.file_parser import file_parser
+
+    monkeypatch.setattr(file_parser, "cache", DocumentCache(str(tmp_path / "docs.db"), "test", 8, 1 << 20))
+    attachment = tmp_path / "answer.py"
+    attachment.write_text("def f(): return 1")
+    raw = {
+        "assignment_content": "Viết hàm f",
+        "student_submission_text": "Bài làm",
+        "student_submission_files": [str(attachment)],
+        "reference_answer_text": "return 1",
+        "rubric": "Đúng kết quả",
+        "max_score": 10,
+    }
+    texts, files = grading_input_parts(raw)
+    assert texts["submission"] == "Bài làm" and files == [str(attachment)]
+
+    prepared = asyncio.run(prepare_grading_input(raw, "r1"))
+    assert prepared["question"] == "Viết hàm f"
+    assert prepared["reference"] == "return 1"
+    assert prepared["submission"].startswith("Bài làm")
+    assert '<file_attachment name="answer.py">' in prepared["submission"]
+    assert "student_submission_files" not in prepared
+
+
+def test_prepare_keeps_parsed_context_and_rejects_empty_submission():
+    context = {"question": "Q đã parse", "reference": "R đã parse"}
+    prepared = asyncio.run(prepare_grading_input({**context, "student_submission_text": "x"}, "r1"))
+    assert prepared["question"] == "Q đã parse" and prepared["reference"] == "R đã parse"
+
+    with pytest.raises(ValueError):
+        asyncio.run(prepare_grading_input({**context, "student_submission_text": "  "}, "r2"))
+
+
+def test_files_are_parsed_concurrently_in_order(tmp_path, monkeypatch):
+    from app.core import common
+
+    paths = []
+    for name, delay in (("slow.txt", 0.3), ("fast.txt", 0.0), ("mid.txt", 0.1)):
+        path = tmp_path / name
+        path.write_text(str(delay))
+        paths.append(str(path))
+
+    async def fake_parse(file_path):
+        await asyncio.sleep(float(open(file_path).read()))
+        return os.path.basename(file_path)
+
+    monkeypatch.setattr(common.file_parser, "parse_local_file", fake_parse)
+    monkeypatch.setattr(common, "_parse_semaphore", None)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        result = await common.process_upload_files(paths)
+        return result, loop.time() - started_at
+
+    result, elapsed = asyncio.run(run())
+    assert [line for line in result.splitlines() if line.startswith("---")] == [
+        "--- File: slow.txt ---", "--- File: fast.txt ---", "--- File: mid.txt ---"
+    ]
+    assert elapsed < 0.35
@@ -0,0 +1,44 @@
+import asyncio
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.config import settings
+from app.core.http_client import HttpClientManager
+
+
+def test_client_is_shared_and_closed_on_shutdown():
+    async def run():
+        manager = HttpClientManager()
+        await manager.startup()
+        client = manager.client
+        assert manager.client is client  # Cùng 1 pool cho mọi lần gọi
+        await manager.startup()
+        assert manager.client is client  # startup lần 2 không tạo pool mới
+
+        assert client.timeout.connect == settings.HTTP_CONNECT_TIMEOUT
+        assert client.timeout.read == settings.HTTP_READ_TIMEOUT
+        pool = client._transport._pool
+        assert pool._max_connections == settings.HTTP_POOL_MAX_CONNECTIONS
+        assert pool._max_keepalive_connections == settings.HTTP_POOL_MAX_KEEPALIVE
+
+        await manager.shutdown()
+        assert client.is_closed
+        await manager.shutdown()  # Gọi lại không lỗi
+        return client
+
+    asyncio.run(run())
+
+
+def test_client_recreated_outside_app_lifecycle():
+    async def run():
+        manager = HttpClientManager()
+        # Script / test không chạy startup -> tự khởi tạo
+        first = manager.client
+        await first.aclose()
+        second = manager.client
+        assert second is not first and not second.is_closed
+        await manager.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,133 @@
+import asyncio
+import json
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import pytest
+
+pytest.importorskip("langchain_community")
+
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.testclient import TestClient
+
+from app.api.api_v1.endpoints import grading
+from app.core import task_runner as task_runner_module
+from app.core.job_events import job_events, TERMINAL_EVENTS
+from app.core.job_store import JobStore
+from app.core.scheduler import FairScheduler
+from app.core.slot_pool import llm_slot_pool
+from app.core.task_runner import TaskRunner
+from app.schemas.grading import GradingResponse
+
+
+async def grade(data):
+    # Service bên dưới phát token qua job_events (current_job_id do task_runner gắn)
+    for token in ("Bài ", "làm ", "tốt"):
+        job_events.emit("token", text=token)
+        await asyncio.sleep(0)
+    return GradingResponse(score=9.0, feedback="Bài làm tốt", ai_model="test-model")
+
+
+@pytest.fixture
+def jobs(tmp_path, monkeypatch):
+    """App chỉ gồm router chấm bài; job chạy qua TaskRunner riêng trong event loop của TestClient."""
+    store = JobStore(str(tmp_path / "jobs.db"))
+    runner = TaskRunner(store, FairScheduler(weights={}))
+    runner.register_handler("grading", grade)
+    monkeypatch.setattr(grading, "task_runner", runner)
+    monkeypatch.setattr(grading, "job_store", store)
+    monkeypatch.setattr(llm_slot_pool, "enabled", False)
+    sent = []
+
+    async def record_webhook(*args):
+        sent.append(args)
+
+    monkeypatch.setattr(task_runner_module.webhook_dispatcher, "submit", record_webhook)
+
+    app = FastAPI()
+    app.include_router(grading.router, prefix="/grading")
+    with TestClient(app) as client:
+        yield client, runner, sent
+
+
+def parse_sse(body):
+    events = []
+    for chunk in body.split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in chunk.splitlines() if not line.startswith(":"))
+        if "event" in lines:
+            events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_events_stream_stages_tokens_and_closes_on_done(jobs):
+    client, runner, sent = jobs
+    runner.store.enqueue("r1", "grading", {"submission": "s", "question": "q"}, "http://cb")
+
+    async def run_job():
+        # Chạy job khi client SSE đã đăng ký
+        while "r1" not in job_events._subscribers:
+            await asyncio.sleep(0.01)
+        job = await run_in_threadpool(runner.store.lease_next, "w1", 60)
+        await runner._run_job(job, "w1")
+
+    running = client.portal.start_task_soon(run_job)
+    response = client.get("/grading/jobs/r1/events")
+    # Stream đóng ngay khi có "done", webhook được chuyển đi sau đó
+    running.result(timeout=2)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = parse_sse(response.text)
+    names = [name for name, _ in events]
+    assert names[0] == "snapshot" and events[0][1]["status"] == "queued"
+    stages = [data["stage"] for name, data in events if name == "stage"]
+    assert stages[:2] == ["running", "processing"]
+    assert [data["text"] for name, data in events if name == "token"] == ["Bài ", "làm ", "tốt"]
+    # Stream đóng ngay sau sự kiện kết thúc
+    assert names[-1] == "done" and sum(name in TERMINAL_EVENTS for name in names) == 1
+    assert events[-1][1]["result"]["data"]["score"] == 9.0
+    assert len(sent) == 1
+
+
+def test_events_stream_for_finished_job_sends_snapshot_only(jobs):
+    client, runner, _ = jobs
+    runner.store.enqueue("r1", "grading", {"submission": "s"}, "http://cb")
+    runner.store.cancel("r1")
+
+    events = parse_sse(client.get("/grading/jobs/r1/events").text)
+
+    assert [name for name, _ in events] == ["snapshot"]
+    assert events[0][1]["status"] == "cancelled"
+    assert client.get("/grading/jobs/missing/events").status_code == 404
+
+
+def test_delete_running_job_via_api(jobs):
+    client, runner, sent = jobs
+    started, runs = [], []
+
+    async def slow_grade(data):
+        started.append(True)
+        await asyncio.sleep(60)
+
+    runner.register_handler("grading", slow_grade)
+    runner.store.enqueue("r1", "grading", {"submission": "s", "question": "q"}, "http://cb")
+
+    async def start_job():
+        job = await run_in_threadpool(runner.store.lease_next, "w1", 60)
+        runs.append(asyncio.create_task(runner._run_job(job, "w1")))
+        while not started:
+            await asyncio.sleep(0.01)
+
+    client.portal.call(start_job)
+    response = client.delete("/grading/jobs/r1")
+
+    assert response.status_code == 200
+    assert response.json()["previous_status"] == "running"
+    client.portal.call(asyncio.wait_for, runs[0], 2)
+    assert runner.store.get("r1")["status"] == "cancelled"
+    assert sent == []
+    # Hủy lần nữa -> job đã kết thúc
+    assert client.delete("/grading/jobs/r1").status_code == 409
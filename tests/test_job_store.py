@@ -0,0 +1,194 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.job_store import JobStore
+
+
+def make_store(tmp_path):
+    return JobStore(db_path=str(tmp_path / "jobs.db"))
+
+
+def test_lifecycle_queued_running_done(tmp_path):
+    store = make_store(tmp_path)
+    job = store.enqueue("r1", "grading", {"submission": "s"}, "http://cb", course_id="c1")
+    assert job["status"] == "queued"
+    assert job["input_data"] == {"submission": "s"}
+
+    leased = store.lease_next("w1", lease_seconds=60)
+    assert leased["request_id"] == "r1"
+    assert leased["status"] == "running"
+    assert leased["attempts"] == 1
+    assert store.lease_next("w2", lease_seconds=60) is None
+    assert store.heartbeat("r1", "w1", lease_seconds=60)
+    assert not store.heartbeat("r1", "w2", lease_seconds=60)
+
+    store.complete("r1", {"status": "success"})
+    done = store.get("r1")
+    assert done["status"] == "done"
+    assert done["result"] == {"status": "success"}
+    assert store.count_by_status() == {"done": 1}
+
+
+def test_enqueue_does_not_reset_active_job(tmp_path):
+    store = make_store(tmp_path)
+    store.enqueue("r1", "grading", {"v": 1}, "http://cb")
+    store.lease_next("w1", lease_seconds=60)
+    again = store.enqueue("r1", "grading", {"v": 2}, "http://cb")
+    assert again["status"] == "running"
+    assert again["input_data"] == {"v": 1}
+
+    store.fail("r1", "boom")
+    regrade = store.enqueue("r1", "grading", {"v": 2}, "http://cb")
+    assert regrade["status"] == "queued"
+    assert regrade["attempts"] == 0
+
+
+def test_expired_lease_is_recovered_then_failed(tmp_path):
+    store = make_store(tmp_path)
+    store.enqueue("r1", "grading", {}, "http://cb")
+
+    # Worker "chết": lease hết hạn ngay
+    store.lease_next("w1", lease_seconds=-1)
+    assert store.recover_expired(max_attempts=2) == []
+    assert store.get("r1")["status"] == "queued"
+
+    store.lease_next("w2", lease_seconds=-1)
+    failed = store.recover_expired(max_attempts=2)
+    assert [job["request_id"] for job in failed] == ["r1"]
+    assert store.get("r1")["status"] == "failed"
+
+
+def test_jobs_survive_reopen_and_requeue(tmp_path):
+    store = make_store(tmp_path)
+    store.enqueue("r1", "grading", {}, "http://cb")
+    store.lease_next("w1", lease_seconds=60)
+    store.requeue("r1", "w1")
+    store.close()
+
+    reopened = make_store(tmp_path)
+    job = reopened.get("r1")
+    assert job["status"] == "queued"
+    assert job["attempts"] == 0
+
+
+def test_idempotent_admission_and_coalescing(tmp_path):
+    store = make_store(tmp_path)
+    first = store.enqueue("r1", "grading", {}, "http://cb", content_hash="h1", retention_seconds=3600)
+    assert first["admission"] == "queued"
+    assert store.enqueue("r1", "grading", {}, "http://cb", content_hash="h1")["admission"] == "duplicate"
+
+    twin = store.enqueue("r2", "grading", {}, "http://cb2", content_hash="h1")
+    assert twin["admission"] == "coalesced"
+    assert twin["status"] == "coalesced"
+    assert twin["coalesced_into"] == "r1"
+    assert [job["request_id"] for job in store.followers_of("r1")] == ["r2"]
+    # Job gộp không bao giờ được worker lấy
+    assert store.lease_next("w1", lease_seconds=60)["request_id"] == "r1"
+    assert store.lease_next("w1", lease_seconds=60) is None
+
+    store.complete("r1", {"score": 7})
+    completed = store.enqueue("r1", "grading", {}, "http://cb", content_hash="h1", retention_seconds=3600)
+    assert completed["admission"] == "completed"
+    assert completed["result"] == {"score": 7}
+    # Ngoài thời gian lưu giữ -> chấm lại
+    assert store.enqueue("r1", "grading", {}, "http://cb", content_hash="h1", retention_seconds=-1)["admission"] == "queued"
+
+
+def test_cancel_promotes_coalesced_follower(tmp_path):
+    store = make_store(tmp_path)
+    store.enqueue("r1", "grading", {}, "http://cb", content_hash="h1")
+    store.enqueue("r2", "grading", {}, "http://cb", content_hash="h1")
+    store.enqueue("r3", "grading", {}, "http://cb", content_hash="h1")
+    store.lease_next("w1", lease_seconds=60)
+
+    cancelled = store.cancel("r1")
+    assert cancelled["cancelled"] and cancelled["previous_status"] == "running"
+    assert cancelled["status"] == "cancelled"
+    # Worker cũ không còn ghi được kết quả / gia hạn lease
+    assert not store.heartbeat("r1", "w1", lease_seconds=60)
+    assert not store.complete("r1", {"score": 1})
+    assert store.get("r1")["status"] == "cancelled"
+
+    # Job gộp đầu tiên thay thế, các job còn lại bám theo nó
+    assert store.get("r2")["status"] == "queued"
+    assert [job["request_id"] for job in store.followers_of("r2")] == ["r3"]
+    assert store.lease_next("w1", lease_seconds=60)["request_id"] == "r2"
+
+    assert not store.cancel("r1")["cancelled"]
+    assert store.cancel("missing") is None
+
+
+def test_shortest_first_with_aging(tmp_path):
+    store = make_store(tmp_path)
+    store.enqueue("long", "grading", {}, "http://cb", estimated_tokens=3000)
+    store.enqueue("short", "grading", {}, "http://cb", estimated_tokens=200)
+    store.enqueue("medium", "grading", {}, "http://cb", estimated_tokens=800)
+
+    order = [store.lease_next("w1", 60, shortest_first=True)["request_id"] for _ in range(3)]
+    assert order == ["short", "medium", "long"]
+
+    # Job lớn đã chờ đủ lâu được vượt lên trước job nhỏ mới tới
+    store.enqueue("old_long", "grading", {}, "http://cb", estimated_tokens=3000)
+    store._get_conn().execute("UPDATE jobs SET created_at = created_at - 600 WHERE request_id = 'old_long'")
+    store.enqueue("new_short", "grading", {}, "http://cb", estimated_tokens=200)
+    leased = store.lease_next("w1", 60, shortest_first=True, aging_tokens_per_second=5.0)
+    assert leased["request_id"] == "old_long"
+
+
+def test_batch_results_are_collected_once(tmp_path):
+    store = make_store(tmp_path)
+    store.save_context("ctx", {"question": "Q"})
+    assert store.get_context("ctx") == {"question": "Q"}
+
+    store.create_batch("b1", "ctx", "http://cb", callback_batch_size=2)
+    for request_id in ("s1", "s2", "s3"):
+        store.enqueue(request_id, "grading", {"context_id": "ctx"}, "http://cb", batch_id="b1")
+    store.complete("s1", {"score": 1})
+    # Chưa đủ 2 kết quả
+    assert store.collect_batch_results("b1", 2) == ([], 2)
+    store.complete("s2", {"score": 2})
+    jobs, remaining = store.collect_batch_results("b1", 2)
+    assert [job["request_id"] for job in jobs] == ["s1", "s2"] and remaining == 1
+
+    # Batch chưa seal -> chưa gửi phần lẻ còn lại
+    store.fail("s3", "boom")
+    assert store.collect_batch_results("b1", 2)[0] == []
+    store.seal_batch("b1")
+    assert store.get_batch("b1")["total"] == 3
+    jobs, remaining = store.collect_batch_results("b1", 2)
+    assert [job["request_id"] for job in jobs] == ["s3"] and remaining == 0
+    assert store.collect_batch_results("b1", 2)[0] == []
+
+
+def test_purge_finished_after_retention(tmp_path):
+    import time
+
+    store = make_store(tmp_path)
+    store.save_context("ctx", {"question": "Q"})
+    store.create_batch("b1", "ctx", "http://cb", None)
+    for request_id in ("old", "b-sent", "b-unsent"):
+        store.enqueue(request_id, "grading", {"submission": "s"}, "http://cb",
+                      batch_id=None if request_id == "old" else "b1")
+    store.enqueue("active", "grading", {"submission": "s"}, "http://cb")
+    store.seal_batch("b1")
+    store.complete("old", {"status": "success"})
+    store.complete("b-sent", {"status": "success"})
+    store.collect_batch_results("b1", min_results=1)  # b-sent đã gửi callback
+    store.fail("b-unsent", "lỗi")
+
+    assert store.purge_finished(older_than=0) == {"jobs": 0, "batches": 0, "contexts": 0}
+
+    cutoff = time.time() + 1
+    assert store.purge_finished(older_than=cutoff) == {"jobs": 2, "batches": 0, "contexts": 0}
+    assert store.get("old") is None and store.get("b-sent") is None
+    # Chưa gửi callback / chưa kết thúc -> giữ lại; batch + ngữ cảnh còn job dùng
+    assert store.get("b-unsent")["status"] == "failed"
+    assert store.get("active")["status"] == "queued"
+    assert store.get_context("ctx") is not None
+
+    store.collect_batch_results("b1", min_results=1)
+    assert store.purge_finished(older_than=cutoff) == {"jobs": 1, "batches": 1, "contexts": 1}
+    assert store.get_batch("b1") is None and store.get_context("ctx") is None
+    assert store.count_by_status() == {"queued": 1}
@@ -0,0 +1,27 @@
+import json
+
+import pytest
+
+from app.services.json_repair import repair_json
+
+
+@pytest.mark.parametrize(
+    "raw, expected",
+    [
+        ('{"score": 8, "feedback": "Tốt",}', {"score": 8, "feedback": "Tốt"}),
+        ("{'score': 7.5, 'feedback': 'Khá'}", {"score": 7.5, "feedback": "Khá"}),
+        ('{"score": 6, "feedback": "Dòng 1\nDòng 2"}', {"score": 6, "feedback": "Dòng 1\nDòng 2"}),
+        ('Kết quả: {"score": 9, "feedback": "Hay"} Cảm ơn!', {"score": 9, "feedback": "Hay"}),
+        ('Đây là kết quả: {"score": 7, "feedback": "ok"} và {"x":1}', {"score": 7, "feedback": "ok"}),
+        ('{"score": 6, "feedback": "dùng {} và }",} Ghi chú: {a}', {"score": 6, "feedback": "dùng {} và }"}),
+        ('{"score": 5, "feedback": "Bài làm bị cắt', {"score": 5, "feedback": "Bài làm bị cắt"}),
+        ('{"score": 5, "feedback": "ok", "deta', {"score": 5, "feedback": "ok"}),
+    ],
+)
+def test_repair_json_recovers_common_failures(raw, expected):
+    assert repair_json(raw) == expected
+
+
+def test_repair_json_raises_when_unrecoverable():
+    with pytest.raises(json.JSONDecodeError):
+        repair_json("Xin lỗi, tôi không thể chấm bài này.")
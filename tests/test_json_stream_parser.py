@@ -0,0 +1,18 @@
+import json
+
+from app.services.json_stream_parser import IncrementalJSONParser
+
+
+def test_parser_completes_on_top_level_close():
+    parser = IncrementalJSONParser()
+    chunks = ['```json\n{"score": 8', ', "feedback": "a {b}', ' \\"c\\""}', "\n``` trailing text"]
+    done = [parser.feed(c) for c in chunks]
+    assert done == [False, False, True, True]
+    assert json.loads(parser.result()) == {"score": 8, "feedback": 'a {b} "c"'}
+
+
+def test_parser_incomplete_object():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"score": 5, "feedback": "dang') is False
+    assert parser.result() is None
+    assert parser.partial() == '{"score": 5, "feedback": "dang'
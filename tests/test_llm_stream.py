@@ -0,0 +1,78 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+# llm_service -> prompt_service -> rag_service (langchain)
+pytest.importorskip("langchain_community")
+
+import httpx
+from app.core.http_client import http_client_manager
+from app.core.metrics import metrics
+from app.services.llm_service import llm_service
+
+
+def ndjson_response(frames, chunk_size, sent):
+    body = "".join(json.dumps(frame) + "\n" for frame in frames).encode("utf-8")
+
+    async def stream():
+        # Cắt theo byte cố định -> một dòng JSON bị tách qua nhiều chunk
+        for start in range(0, len(body), chunk_size):
+            sent.append(start)
+            yield body[start:start + chunk_size]
+
+    return httpx.Response(200, content=stream())
+
+
+def run_stream(monkeypatch, frames, chunk_size=7):
+    sent = []
+    requests = []
+
+    def handler(request):
+        requests.append(json.loads(request.content))
+        return ndjson_response(frames, chunk_size, sent)
+
+    monkeypatch.setattr(http_client_manager, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    result = asyncio.run(llm_service._stream_json_response({"model": "m", "prompt": "p"}))
+    return result, requests, sent
+
+
+def test_stream_stops_once_object_is_complete(monkeypatch):
+    frames = [
+        {"response": '{"score": 8'},
+        {"response": ', "feedback": "ok"}'},
+    ] + [{"response": " lảm nhảm"} for _ in range(50)] + [{"response": "", "done": True}]
+    early_stops = metrics.get_counter("llm_stream_early_stop_total", model=llm_service.model)
+
+    result, requests, sent = run_stream(monkeypatch, frames)
+    assert json.loads(result) == {"score": 8, "feedback": "ok"}
+    assert requests[0]["stream"] is True
+    # Không đọc hết phần sinh thừa phía sau
+    total_bytes = sum(len(json.dumps(frame)) + 1 for frame in frames)
+    assert len(sent) * 7 < total_bytes
+    assert metrics.get_counter("llm_stream_early_stop_total", model=llm_service.model) == early_stops + 1
+
+
+def test_stream_returns_partial_text_on_done_frame(monkeypatch):
+    frames = [
+        {"response": '{"score": 5, "feedback": "bị'},
+        {"response": " cắt", "done": True},
+        {"response": "không được đọc"},
+    ]
+    result, _, _ = run_stream(monkeypatch, frames, chunk_size=5)
+    # Object chưa đóng -> trả về văn bản thô để json_repair xử lý
+    assert result == '{"score": 5, "feedback": "bị cắt'
+
+
+def test_stream_error_frame_raises(monkeypatch):
+    frames = [
+        {"response": '{"score": '},
+        {"error": "model runner has unexpectedly stopped"},
+        {"response": "9}"},
+    ]
+    with pytest.raises(RuntimeError, match="unexpectedly stopped"):
+        run_stream(monkeypatch, frames)
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+
+import pytest
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+# llm_service -> prompt_service -> rag_service (langchain)
+pytest.importorskip("langchain_community")
+
+import httpx
+from tenacity import wait_none
+from app.core.config import settings
+from app.core.http_client import http_client_manager
+from app.schemas.grading import GradingOutput
+from app.services.llm_service import llm_service
+from app.services.prompt_service import prompt_service
+
+DATA = {"question": "Encapsulation là gì?", "submission": "Gom dữ liệu và hàm vào class.", "max_score": 10}
+
+
+@pytest.fixture
+def ollama(monkeypatch):
+    """Ollama giả trả về lần lượt các reply (không stream); trả về danh sách payload đã gửi."""
+    monkeypatch.setattr(settings, "OLLAMA_STREAM_GRADING", False)
+    monkeypatch.setattr(settings, "OLLAMA_STRUCTURED_OUTPUT", True)
+    monkeypatch.setattr(settings, "RESULT_CACHE_ENABLED", False)
+    monkeypatch.setattr(prompt_service, "_log_prompt_to_file", lambda *args: None)
+    monkeypatch.setattr(llm_service._generate_json_with_retry.retry, "wait", wait_none())
+    sent = []
+
+    def install(replies):
+        def handler(request):
+            sent.append(json.loads(request.content))
+            return httpx.Response(200, json={"response": replies[min(len(sent), len(replies)) - 1], "done": True})
+
+        monkeypatch.setattr(http_client_manager, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        return sent
+
+    return install
+
+
+def test_schema_is_sent_and_score_clamped(ollama):
+    sent = ollama(['{"score": 12, "feedback": "Tốt"}'])
+    result = asyncio.run(llm_service.grade_submission(DATA))
+    assert sent[0]["format"] == GradingOutput.model_json_schema()
+    assert result.error is None and result.score == 10 and result.feedback == "Tốt"
+
+
+def test_schema_mismatch_retries_then_reports_schema_error(ollama):
+    sent = ollama(['{"score": 5}'])
+    result = asyncio.run(llm_service.grade_submission(DATA))
+    assert len(sent) == 3
+    assert result.score == 0
+    assert result.error == "AI Error: Output did not match the grading schema after multiple attempts."
+
+
+def test_schema_mismatch_recovers_on_retry(ollama):
+    sent = ollama(['{"score": 5}', '{"score": 6, "feedback": "Khá"}'])
+    result = asyncio.run(llm_service.grade_submission(DATA))
+    assert len(sent) == 2 and result.score == 6
+
+
+def test_unparseable_reply_reports_json_error(ollama):
+    ollama(["Xin lỗi, tôi không thể chấm bài này."])
+    result = asyncio.run(llm_service.grade_submission(DATA))
+    assert result.error == "AI Error: Could not generate valid JSON format after multiple attempts."
@@ -0,0 +1,77 @@
+import asyncio
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import httpx
+import pytest
+
+from app.services.ollama_pool import OllamaNode, OllamaPool, parse_ollama_hosts
+
+
+def test_parse_ollama_hosts():
+    assert parse_ollama_hosts(None, "http://x:1", 2) == [("http://x:1", 2)]
+    assert parse_ollama_hosts("http://a:1=3, http://b:1", "http://x:1", 1) == [
+        ("http://a:1", 3),
+        ("http://b:1", 1),
+    ]
+
+
+def test_least_outstanding_routing_and_ejection():
+    async def scenario():
+        a, b = OllamaNode("http://a", 2), OllamaNode("http://b", 2)
+        pool = OllamaPool([a, b], eject_after=2)
+
+        async with pool.acquire() as first:
+            async with pool.acquire() as second:
+                assert {first.url, second.url} == {"http://a", "http://b"}
+
+        for _ in range(2):
+            async with pool.acquire() as busy:
+                assert busy is a
+                with pytest.raises(httpx.ConnectError):
+                    async with pool.acquire() as node:
+                        assert node is b
+                        raise httpx.ConnectError("down")
+
+        assert b.healthy is False
+        async with pool.acquire() as node:
+            assert node is a
+
+    asyncio.run(scenario())
+
+
+def test_sticky_routing_prefers_home_node(monkeypatch):
+    from app.core.config import settings
+
+    monkeypatch.setattr(settings, "OLLAMA_STICKY_ROUTING", True)
+    urls = ["http://a", "http://b", "http://c"]
+    pool = OllamaPool([OllamaNode(url, 2) for url in urls])
+    # Thứ tự node khác (VD tiến trình khác đọc cấu hình) vẫn ra cùng node "nhà"
+    reordered = OllamaPool([OllamaNode(url, 2) for url in reversed(urls)])
+
+    homes = set()
+    for key in (f"prefix-{index}" for index in range(20)):
+        home = pool._pick_node(key)
+        assert all(pool._pick_node(key) is home for _ in range(3))
+        assert reordered._pick_node(key).url == home.url
+        homes.add(home.url)
+    assert len(homes) > 1  # Các bài tập khác nhau được chia ra nhiều node
+
+
+def test_sticky_routing_falls_back_when_home_is_full(monkeypatch):
+    from app.core.config import settings
+
+    monkeypatch.setattr(settings, "OLLAMA_STICKY_ROUTING", True)
+    nodes = [OllamaNode(url, 2) for url in ("http://a", "http://b", "http://c")]
+    pool = OllamaPool(nodes)
+    home = pool._pick_node("prefix-1")
+    others = [node for node in nodes if node is not home]
+
+    home.in_flight = home.max_concurrency
+    others[0].in_flight = 1
+    assert pool._pick_node("prefix-1") is others[1]  # node ít tải nhất
+
+    others[1].in_flight = 2
+    assert pool._pick_node("prefix-1") is others[0]
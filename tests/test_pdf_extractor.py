@@ -0,0 +1,49 @@
+import os
+
+import fitz
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.services.pdf_extractor import PdfExtractor
+
+
+def make_pdf(path, pages):
+    with fitz.open() as doc:
+        for index in range(pages):
+            doc.new_page().insert_text((72, 72), f"Trang so {index + 1}")
+        doc.save(str(path))
+
+
+def test_page_ranges_are_joined_in_page_order(tmp_path):
+    path = tmp_path / "report.pdf"
+    make_pdf(path, 7)
+
+    extractor = PdfExtractor(max_workers=2, pages_per_task=2)
+    try:
+        pages = list(extractor.iter_pages(str(path)))
+    finally:
+        extractor.shutdown()
+    assert [page.strip() for page in pages] == [f"Trang so {index}" for index in range(1, 8)]
+
+    # Cùng định dạng với trích xuất trong thread
+    inline = PdfExtractor(max_workers=0, pages_per_task=2)
+    assert inline.extract(str(path)) == "".join(page + "\n" for page in pages)
+
+
+def test_max_pages_and_early_stop(tmp_path):
+    path = tmp_path / "long.pdf"
+    make_pdf(path, 9)
+
+    extractor = PdfExtractor(max_workers=1, pages_per_task=2)
+    try:
+        assert [page.strip() for page in extractor.iter_pages(str(path), max_pages=3)] == [
+            "Trang so 1", "Trang so 2", "Trang so 3"
+        ]
+        # Bên gọi dừng sớm -> các đoạn còn lại bị hủy, pool vẫn dùng tiếp được
+        pages = extractor.iter_pages(str(path))
+        assert next(pages).strip() == "Trang so 1"
+        pages.close()
+        assert len(list(extractor.iter_pages(str(path)))) == 9
+    finally:
+        extractor.shutdown()
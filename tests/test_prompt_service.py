@@ -0,0 +1,66 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import pytest
+
+pytest.importorskip("langchain_community")
+
+from app.core.config import settings
+from app.services import prompt_service as prompt_module
+from app.services.prompt_service import prompt_service
+from app.services.token_service import token_service
+
+
+@pytest.fixture
+def build(monkeypatch):
+    """build_grading_prompt không gọi RAG, không ghi file log."""
+    monkeypatch.setattr(prompt_service, "_collect_textbook_references", lambda course_id, question: [])
+    monkeypatch.setattr(prompt_service, "_log_prompt_to_file", lambda *args: None)
+
+    def _build(submission, question="Đề bài. " * 800, rubric="Tiêu chí. " * 800, instruction="Bạn là giảng viên."):
+        monkeypatch.setattr(prompt_module.instruction_manager, "get_instruction", lambda *args, **kwargs: instruction)
+        return prompt_service.build_grading_prompt(
+            course_id="c1", question=question, submission=submission, max_score=10,
+            rubric=rubric, teacher_instruction="Yêu cầu. " * 200,
+        )
+
+    return _build
+
+
+@pytest.mark.parametrize("layout", ["prefix_stable", "classic"])
+def test_large_system_instruction_still_fits_num_ctx(build, monkeypatch, layout):
+    monkeypatch.setattr(settings, "PROMPT_LAYOUT", layout)
+    instruction = "Quy tắc chấm điểm chi tiết. " * 320  # ~1.9k token, gần hết MAX_INPUT_TOKENS
+
+    prompt = build("Bài làm. " * 1500, instruction=instruction)
+
+    # Template (gồm system instruction) không bị cắt, các mục còn lại co lại để cả prompt vừa MAX_INPUT_TOKENS
+    assert prompt.token_count <= settings.MAX_INPUT_TOKENS
+    assert token_service.check_token_limit(prompt.text, limit=token_service.prompt_capacity(prompt.num_ctx))["is_valid"]
+
+
+def test_prefix_stable_prefix_is_identical_across_submissions(build, monkeypatch):
+    monkeypatch.setattr(settings, "PROMPT_LAYOUT", "prefix_stable")
+
+    short = build("Đóng gói là che giấu dữ liệu bằng private.")
+    long = build("Bài làm rất dài. " * 2000)
+
+    assert long.trimmed_sections  # bài làm dài bị cắt nhưng phần dùng chung giữ nguyên
+    assert short.prefix_key == long.prefix_key
+    short_prefix = short.text.split("<student_submission>\n")[0]
+    assert short_prefix.encode("utf-8") == long.text.split("<student_submission>\n")[0].encode("utf-8")
+    assert short.text != long.text
+
+
+def test_prefix_stable_submission_uses_remaining_budget(build, monkeypatch):
+    monkeypatch.setattr(settings, "PROMPT_LAYOUT", "prefix_stable")
+
+    # Phần dùng chung ngắn -> bài làm được dùng phần còn lại, không chỉ PROMPT_SUBMISSION_BUDGET_SHARE
+    prompt = build("Bài làm rất dài. " * 2000, question="Giải thích tính đóng gói.", rubric="Đúng khái niệm: 10 điểm")
+    submission = prompt.text.split("<student_submission>\n")[1].split("\n</student_submission>")[0]
+
+    assert "submission" in prompt.trimmed_sections
+    assert prompt.token_count <= settings.MAX_INPUT_TOKENS
+    assert token_service.count_tokens(submission) > settings.PROMPT_SUBMISSION_BUDGET_SHARE * settings.MAX_INPUT_TOKENS
@@ -0,0 +1,45 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.services.result_cache import ResultCache
+
+
+def make_cache(tmp_path, **kwargs):
+    options = {"memory_size": 2, "ttl_seconds": 3600, "max_entries": 100}
+    options.update(kwargs)
+    return ResultCache(db_path=str(tmp_path / "cache.db"), **options)
+
+
+def test_key_is_stable_and_content_addressed():
+    a = ResultCache.make_key({"question": "q", "submission": "s", "model": "m"})
+    b = ResultCache.make_key({"model": "m", "submission": "s", "question": "q"})
+    c = ResultCache.make_key({"question": "q", "submission": "s2", "model": "m"})
+    assert a == b
+    assert a != c
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("k1") is None
+    cache.set("k1", {"score": 5.0})
+    assert cache.get("k1") == {"score": 5.0}
+
+    # Instance mới chỉ còn tầng đĩa
+    reopened = make_cache(tmp_path)
+    assert reopened.get("k1") == {"score": 5.0}
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl_and_size_eviction(tmp_path):
+    expired = make_cache(tmp_path, ttl_seconds=-1)
+    expired.set("old", {"score": 1.0})
+    assert expired.get("old") is None
+
+    small = make_cache(tmp_path, max_entries=2, memory_size=0)
+    for key in ("a", "b", "c"):
+        small.set(key, {"key": key})
+    assert small.get("a") is None
+    assert small.get("c") == {"key": "c"}
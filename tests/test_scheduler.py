@@ -0,0 +1,39 @@
+import os
+from collections import Counter
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.scheduler import DeficitRoundRobin, FairScheduler, parse_course_weights, PRIORITY_BULK, PRIORITY_INTERACTIVE
+
+
+def test_parse_course_weights():
+    assert parse_course_weights("CS101=3, MATH2=0.5,bad,X=abc") == {"CS101": 3.0, "MATH2": 0.5}
+    assert parse_course_weights(None) == {}
+
+
+def test_drr_shares_by_weight():
+    weights = {"big": 1.0, "small": 1.0, "vip": 2.0}
+    drr = DeficitRoundRobin(lambda queue: weights[queue])
+    served = Counter(drr.pick(["big", "small", "vip"]) for _ in range(400))
+    assert served["big"] == served["small"] == 100
+    assert served["vip"] == 200
+
+
+def test_new_queue_is_served_without_waiting_for_backlog():
+    drr = DeficitRoundRobin(lambda queue: 1.0)
+    for _ in range(50):
+        assert drr.pick(["bulk_course"]) == "bulk_course"
+    picks = [drr.pick(["bulk_course", "other"]) for _ in range(4)]
+    assert "other" in picks[:2]
+
+
+def test_interactive_jumps_ahead_of_bulk():
+    scheduler = FairScheduler(weights={})
+    queued = [
+        {"priority": PRIORITY_BULK, "course_id": "c1", "depth": 500},
+        {"priority": PRIORITY_INTERACTIVE, "course_id": "c2", "depth": 1},
+    ]
+    assert scheduler.choose(queued) == (PRIORITY_INTERACTIVE, "c2")
+    assert scheduler.choose([{"priority": PRIORITY_BULK, "course_id": None, "depth": 2}]) == (PRIORITY_BULK, None)
+    assert scheduler.choose([]) is None
@@ -0,0 +1,96 @@
+import os
+import asyncio
+import subprocess
+import sys
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.slot_pool import SharedSlotPool
+
+
+def make_pool(tmp_path, **kwargs):
+    return SharedSlotPool(db_path=str(tmp_path / "jobs.db"), capacity=2, **kwargs)
+
+
+def test_capacity_is_shared_between_pools(tmp_path):
+    # 2 instance trên cùng file ~ 2 tiến trình worker
+    first, second = make_pool(tmp_path), make_pool(tmp_path)
+    assert first.try_acquire("a") == 0
+    assert second.try_acquire("b") == 1
+    assert first.try_acquire("c") is None
+    assert second.in_use() == 2
+
+    first.release(0, "a")
+    assert second.try_acquire("c") == 0
+
+
+def test_leaked_slots_are_reclaimed(tmp_path):
+    pool = make_pool(tmp_path, lease_seconds=-1)
+    assert pool.try_acquire("a") == 0
+    assert pool.try_acquire("b") == 0  # lease của "a" đã hết hạn
+
+    # Slot của tiến trình đã chết trên cùng máy được thu hồi ngay
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    pool = make_pool(tmp_path)
+    pool.release(0, "b")
+    pool.try_acquire("x")
+    pool.try_acquire("y")
+    pool._get_conn().execute("UPDATE llm_slots SET pid = ? WHERE owner = 'x'", (dead.pid,))
+    assert pool.reclaim() == 1
+    assert pool.try_acquire("z") == 0
+
+
+def test_slot_context_limits_concurrency(tmp_path):
+    pool = make_pool(tmp_path, poll_interval=0.01)
+    peak = in_flight = 0
+
+    async def job():
+        nonlocal peak, in_flight
+        async with pool.slot():
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.02)
+            in_flight -= 1
+
+    async def main():
+        await asyncio.gather(*(job() for _ in range(6)))
+
+    asyncio.run(main())
+    assert peak == 2
+    assert pool.in_use() == 0
+
+
+def test_cancel_during_acquire_releases_slot(tmp_path):
+    import threading
+    import time
+
+    pool = make_pool(tmp_path)
+    acquire = pool.try_acquire
+    inserted = threading.Event()
+
+    def slow_acquire(owner):
+        time.sleep(0.1)  # Job bị hủy trong lúc thread đang lấy slot
+        slot = acquire(owner)
+        inserted.set()
+        return slot
+
+    pool.try_acquire = slow_acquire
+
+    async def job():
+        async with pool.slot():
+            raise AssertionError("Không được chạy khi đã bị hủy")
+
+    async def main():
+        task = asyncio.create_task(job())
+        await asyncio.sleep(0.02)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    asyncio.run(main())
+    assert inserted.is_set()
+    assert pool.in_use() == 0
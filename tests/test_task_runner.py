@@ -0,0 +1,172 @@
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+from app.core.config import settings
+from app.core.job_store import JobStore
+from app.core.scheduler import FairScheduler
+from app.core.task_runner import TaskRunner
+
+
+def make_runner(tmp_path):
+    return TaskRunner(JobStore(str(tmp_path / "jobs.db")), FairScheduler(weights={}))
+
+
+def test_retry_after_follows_backlog(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_QUEUE_DEPTH", 3)
+    monkeypatch.setattr(settings, "JOB_MAX_ESTIMATED_WAIT_SECONDS", None)
+    runner = make_runner(tmp_path)
+    runner._record_service_time(20.0)
+
+    for index in range(2):
+        runner.store.enqueue(f"r{index}", "grading", {}, "http://cb")
+    estimate = runner.queue_estimate()
+    assert estimate["queued"] == 2
+    assert estimate["avg_service_seconds"] == 20.0
+    assert runner.retry_after(estimate) is None
+
+    for index in range(2, 5):
+        runner.store.enqueue(f"r{index}", "grading", {}, "http://cb")
+    estimate = runner.queue_estimate()
+    # 5 job chờ, ngưỡng 3 -> cần xử lý xong 3 job trước khi nhận tiếp
+    per_job = 20.0 / estimate["concurrency_limit"]
+    assert runner.retry_after(estimate) == int(3 * per_job) + 1
+
+
+def test_retry_after_on_estimated_wait(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_QUEUE_DEPTH", None)
+    monkeypatch.setattr(settings, "JOB_MAX_ESTIMATED_WAIT_SECONDS", 10.0)
+    runner = make_runner(tmp_path)
+    runner._record_service_time(100.0)
+    runner.store.enqueue("r1", "grading", {}, "http://cb")
+    estimate = runner.queue_estimate()
+    assert estimate["estimated_wait_seconds"] > 10.0
+    assert runner.retry_after(estimate) >= 1
+
+
+def test_retry_after_counts_whole_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "JOB_MAX_QUEUE_DEPTH", 5)
+    monkeypatch.setattr(settings, "JOB_MAX_ESTIMATED_WAIT_SECONDS", None)
+    runner = make_runner(tmp_path)
+    for index in range(3):
+        runner.store.enqueue(f"r{index}", "grading", {}, "http://cb")
+    estimate = runner.queue_estimate()
+
+    assert runner.retry_after(estimate) is None
+    assert runner.retry_after(estimate, incoming=2) is None
+    # 3 đang chờ + 3 job của batch > ngưỡng 5
+    assert runner.retry_after(estimate, incoming=3) is not None
+
+
+def test_shared_context_is_prepared_once(tmp_path):
+    import asyncio
+
+    calls = []
+
+    async def prepare_context(context):
+        calls.append(context)
+        await asyncio.sleep(0.01)
+        return {"question": context["assignment_content"] + " (parsed)", "max_score": context["max_score"]}
+
+    async def grade(data):
+        return None
+
+    runner = make_runner(tmp_path)
+    runner.register_handler("grading", grade, prepare_context=prepare_context)
+    runner.store.save_context("ctx", {"assignment_content": "Q", "assignment_attachments": ["q.pdf"], "max_score": 10})
+    handler = runner.handlers["grading"]
+
+    async def resolve_batch():
+        return await asyncio.gather(*(
+            runner._resolve_prepared_input(handler, {"context_id": "ctx", "student_submission_text": f"s{index}"})
+            for index in range(3)
+        ))
+
+    resolved = asyncio.run(resolve_batch())
+    assert len(calls) == 1
+    assert [data["student_submission_text"] for data in resolved] == ["s0", "s1", "s2"]
+    assert all(data["question"] == "Q (parsed)" and "assignment_attachments" not in data for data in resolved)
+
+    # Tiến trình khác (không có cache trong RAM) dùng lại kết quả đã lưu, không parse lại
+    other = make_runner(tmp_path)
+    other.register_handler("grading", grade, prepare_context=prepare_context)
+    data = asyncio.run(other._resolve_prepared_input(other.handlers["grading"], {"context_id": "ctx"}))
+    assert data["question"] == "Q (parsed)"
+    assert len(calls) == 1
+
+
+def test_cancel_running_job_aborts_worker(tmp_path, monkeypatch):
+    import asyncio
+
+    from app.core import task_runner as task_runner_module
+    from app.core.job_events import job_events
+    from app.core.slot_pool import llm_slot_pool
+
+    monkeypatch.setattr(llm_slot_pool, "enabled", False)
+    sent = []
+
+    async def record_webhook(*args):
+        sent.append(args)
+
+    monkeypatch.setattr(task_runner_module.webhook_dispatcher, "submit", record_webhook)
+
+    state = {}  # Event tạo trong event loop của scenario
+
+    async def grade(data):
+        state["started"].set()
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            state["aborted"] = True
+            raise
+
+    runner = make_runner(tmp_path)
+    runner.register_handler("grading", grade)
+
+    async def scenario():
+        state["started"] = asyncio.Event()
+        runner.store.enqueue("r1", "grading", {"submission": "s"}, "http://cb")
+        job = runner.store.lease_next("w1", 60)
+        with job_events.subscribe("r1") as events:
+            run = asyncio.create_task(runner._run_job(job, "w1"))
+            await asyncio.wait_for(state["started"].wait(), 2)
+            cancelled = await runner.cancel("r1")
+            await asyncio.wait_for(run, 2)
+            messages = []
+            while not events.empty():
+                messages.append(events.get_nowait())
+        return cancelled, messages
+
+    cancelled, messages = asyncio.run(scenario())
+
+    assert cancelled["cancelled"] is True and cancelled["previous_status"] == "running"
+    assert state.get("aborted") is True
+    assert runner.store.get("r1")["status"] == "cancelled"
+    assert messages[-1]["event"] == "cancelled"
+    assert not any(message["event"] in ("done", "failed") for message in messages)
+    assert "r1" not in runner._running
+    assert sent == []
+
+
+def test_cache_lookup_runs_off_event_loop(tmp_path):
+    import asyncio
+    import threading
+
+    from app.schemas.grading import GradingResponse
+
+    lookup_threads = []
+
+    def cache_lookup(data):
+        lookup_threads.append(threading.current_thread())
+        return GradingResponse(score=8.0, feedback="cached", ai_model="test-model")
+
+    async def grade(data):
+        raise AssertionError("Cache hit không được gọi LLM")
+
+    runner = make_runner(tmp_path)
+    runner.register_handler("grading", grade, cache_lookup=cache_lookup)
+    payload = asyncio.run(runner._execute(runner.handlers["grading"], {"submission": "s"}, "r1"))
+
+    assert payload.status == "success" and payload.data.score == 8.0
+    assert lookup_threads and lookup_threads[0] is not threading.main_thread()
@@ -0,0 +1,43 @@
+import asyncio
+import json
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import httpx
+from app.core.config import settings
+from app.core.http_client import http_client_manager
+from app.services.ollama_pool import OllamaNode, OllamaPool
+from app.services.token_service import token_service
+from app.services.warmup_service import WarmupManager
+
+
+def test_warmup_loads_runner_with_grading_num_ctx(monkeypatch):
+    sent = []
+
+    def handler(request):
+        sent.append(json.loads(request.content))
+        return httpx.Response(200, json={"response": "", "done": True})
+
+    monkeypatch.setattr(http_client_manager, "_client", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    manager = WarmupManager(OllamaPool([OllamaNode("http://a", 1), OllamaNode("http://b", 1)]), "test-model")
+
+    asyncio.run(manager.warm_all())
+    assert manager.is_ready
+    assert len(sent) == 2
+    for payload in sent:
+        assert payload["keep_alive"] == settings.WARMUP_KEEP_ALIVE
+        # Cùng num_ctx với request chấm điểm -> request đầu tiên không làm Ollama nạp lại runner
+        assert payload["options"] == {"num_predict": 1, "num_ctx": token_service.grading_num_ctx()}
+
+
+def test_warmup_failure_marks_node_not_ready(monkeypatch):
+    monkeypatch.setattr(
+        http_client_manager, "_client",
+        httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(500))),
+    )
+    manager = WarmupManager(OllamaPool([OllamaNode("http://a", 1)]), "test-model")
+    assert asyncio.run(manager.warm_all()) is None
+    assert not manager.is_ready
+    assert manager.snapshot()["nodes"]["http://a"]["error"]
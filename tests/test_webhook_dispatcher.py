@@ -0,0 +1,152 @@
+import asyncio
+import os
+
+os.environ.setdefault("OLLAMA_HOST", "http://localhost:11434")
+os.environ.setdefault("MODEL_NAME", "test-model")
+
+import httpx
+from app.core.config import settings
+from app.core.webhook_dispatcher import WebhookDispatcher, WebhookDelivery, DeadLetterStore
+
+HOST = "http://moodle.test"
+
+
+def make_dispatcher(tmp_path, handler):
+    dispatcher = WebhookDispatcher(DeadLetterStore(str(tmp_path / "jobs.db")))
+    dispatcher._clients[HOST] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return dispatcher
+
+
+async def wait_until(predicate, timeout=2.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate() and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_retries_then_delivers(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_BACKOFF_BASE", 0.001)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503 if len(calls) < 3 else 200)
+
+    async def scenario():
+        dispatcher = make_dispatcher(tmp_path, handler)
+        dispatcher.start()
+        await dispatcher.submit(f"{HOST}/callback", {"request_id": "r1"}, "r1")
+        await wait_until(lambda: len(calls) == 3 and not dispatcher._delivery_tasks)
+        stats = dispatcher.stats()
+        await dispatcher.stop()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert len(calls) == 3
+    assert stats["dead_letters"] == 0
+    assert stats["outbox"] == 0
+
+
+def test_permanent_failure_goes_to_dead_letter_and_replays(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_BACKOFF_BASE", 0.001)
+    responses = [400, 200]
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(responses[len(calls) - 1])
+
+    async def scenario():
+        dispatcher = make_dispatcher(tmp_path, handler)
+        dispatcher.start()
+        await dispatcher.submit(f"{HOST}/callback", {"request_id": "r1"}, "r1")
+        await wait_until(lambda: dispatcher.dead_letters.count() == 1)
+        dead = dispatcher.dead_letters.list()
+        replayed = await dispatcher.replay()
+        await wait_until(lambda: len(calls) == 2 and not dispatcher._delivery_tasks)
+        remaining = dispatcher.dead_letters.count()
+        assert dispatcher.dead_letters.pending_count() == 0
+        await dispatcher.stop()
+        return dead, replayed, remaining
+
+    dead, replayed, remaining = asyncio.run(scenario())
+    # 4xx không retry tự động
+    assert dead[0]["attempts"] == 1
+    assert dead[0]["last_error"] == "HTTP 400"
+    assert replayed == 1
+    assert remaining == 0
+    assert len(calls) == 2
+
+
+def test_undelivered_webhook_survives_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WEBHOOK_BACKOFF_BASE", 60.0)
+    calls = []
+
+    def failing(request):
+        calls.append(request)
+        return httpx.Response(503)
+
+    def ok(request):
+        calls.append(request)
+        return httpx.Response(200)
+
+    async def first_run():
+        dispatcher = make_dispatcher(tmp_path, failing)
+        dispatcher.start()
+        await dispatcher.submit(f"{HOST}/callback", {"request_id": "r1"}, "r1")
+        # Ghi outbox trước khi gửi
+        assert dispatcher.dead_letters.pending_count() == 1
+        await wait_until(lambda: len(calls) == 1 and not dispatcher._delivery_tasks)
+        await dispatcher.stop()
+        return dispatcher.dead_letters
+
+    async def second_run():
+        dispatcher = make_dispatcher(tmp_path, ok)
+        dispatcher.start()
+        await wait_until(lambda: len(calls) == 2 and not dispatcher._delivery_tasks)
+        pending = dispatcher.dead_letters.pending_count()
+        await dispatcher.stop()
+        return pending
+
+    store = asyncio.run(first_run())
+    # Đang chờ retry lúc shutdown -> vẫn trong outbox, không vào dead-letter
+    assert store.pending_count() == 1
+    assert store.count() == 0
+
+    # Tiến trình mới (cùng owner) gửi nốt khi khởi động
+    assert asyncio.run(second_run()) == 0
+    assert len(calls) == 2
+    assert calls[1].url == f"{HOST}/callback"
+
+
+def test_claim_pending_skips_live_owner(tmp_path, monkeypatch):
+    store = DeadLetterStore(str(tmp_path / "jobs.db"))
+    store.add_pending(WebhookDelivery(url=f"{HOST}/a", payload={"n": 1}, request_id="live"), "other:1")
+    store.add_pending(WebhookDelivery(url=f"{HOST}/b", payload={"n": 2}, request_id="dead", attempts=2), "other:2")
+    store._get_conn().execute("UPDATE webhook_outbox SET updated_at = 0 WHERE request_id = 'dead'")
+
+    claimed = store.claim_pending("me:1", started_at=0.0, stale_before=100.0)
+
+    assert [d.request_id for d in claimed] == ["dead"]
+    assert claimed[0].attempts == 2
+    assert claimed[0].payload == {"n": 2}
+    # Đã nhận -> tiến trình khác không nhận lại
+    assert store.claim_pending("me:2", started_at=0.0, stale_before=100.0) == []
+    store.close()
+
+
+def test_invalid_callback_url_goes_to_dead_letter(tmp_path):
+    async def scenario():
+        dispatcher = make_dispatcher(tmp_path, lambda request: httpx.Response(200))
+        dispatcher.start()
+        await dispatcher.submit("http://moodle.test:bad/callback", {"request_id": "r1"}, "r1")
+        await wait_until(lambda: dispatcher.dead_letters.count() == 1)
+        dead = dispatcher.dead_letters.list()
+        pending = dispatcher.dead_letters.pending_count()
+        await dispatcher.stop()
+        return dead, pending
+
+    dead, pending = asyncio.run(scenario())
+    # Không retry, không nằm lại trong outbox để lỗi lại mỗi lần khởi động
+    assert pending == 0
+    assert dead[0]["attempts"] == 1
+    assert dead[0]["last_error"].startswith("InvalidURL")